@@ -13,7 +13,10 @@ from azure.communication.callautomation import (
 )
 from azure.communication.callautomation.aio import CallAutomationClient
 from azure.eventgrid import EventGridEvent, SystemEventNames
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity import DefaultAzureCredential
+
+from httpclient import client_sessions
+from tokenmanager import AsyncTokenManager
 
 logger = logging.getLogger("acsClient")
 
@@ -21,15 +24,20 @@ class ACSClient:
     acsEndpoint: str
     callbackUriHost: str
     acs_client: CallAutomationClient
+    # What ACS streams to /realtimeForAcs, RTMiddleTierForAcs has to be set up for the same sample rate
+    audio_format: AudioFormat
 
-    def __init__(self, acsEndpoint: str, callbackUriHost: str, credentials: DefaultAzureCredential):
+    def __init__(self, acsEndpoint: str, callbackUriHost: str, credentials: AsyncTokenManager | DefaultAzureCredential,
+                 audio_format: AudioFormat = AudioFormat.PCM24_K_MONO):
         self.acsEndpoint = acsEndpoint
         self.callbackUriHost = callbackUriHost
+        self.audio_format = audio_format
 
-        self._token_provider = get_bearer_token_provider(credentials, "https://communication.azure.com/.default")
-        self._token_provider() # Warm up during startup so we have a token cached when the first request arrives
+        if not isinstance(credentials, AsyncTokenManager):
+            # The async call automation client would call a synchronous credential on the event loop
+            credentials = AsyncTokenManager(credentials)
 
-        self.acs_client = CallAutomationClient(endpoint=acsEndpoint, credential=credentials)
+        self.acs_client = CallAutomationClient(endpoint=acsEndpoint, credential=credentials, transport=client_sessions().transport())
 
     async def incomingCall(self, request: web.Request):
         logger.info("incoming event data")
@@ -67,7 +75,7 @@ class ACSClient:
                         audio_channel_type=MediaStreamingAudioChannelType.MIXED,
                         start_media_streaming=True,
                         enable_bidirectional=True,
-                        audio_format=AudioFormat.PCM24_K_MONO)
+                        audio_format=self.audio_format)
                 
                 answer_call_result = await self.acs_client.answer_call(incoming_call_context=incoming_call_context,
                                                             operation_context="incomingCall",
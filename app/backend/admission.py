@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Optional
+
+import metrics
+
+logger = logging.getLogger("voicerag")
+
+_queue_wait = metrics.histogram("voicerag_admission_wait_seconds", "Time new sessions waited for an upstream realtime slot, by deployment and outcome",
+                                buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+_rejections = metrics.counter("voicerag_admission_rejected_total", "Sessions turned away by admission control, by deployment and reason")
+_queued = metrics.gauge("voicerag_admission_queued", "Sessions waiting for an upstream realtime slot, by deployment")
+_admitted = metrics.gauge("voicerag_admission_active", "Sessions holding an upstream realtime slot, by deployment")
+_tokens = metrics.gauge("voicerag_admission_tokens_available", "Tokens left in the rate limit bucket, by deployment")
+
+class AdmissionRejected(Exception):
+    # reason is "queue_full" or "timeout"
+    reason: str
+
+    def __init__(self, reason: str, deployment: str):
+        super().__init__(f"No realtime capacity for {deployment} ({reason})")
+        self.reason = reason
+
+class AdmissionTicket:
+    # One admitted session. The tokens reserved when it was admitted are drawn down by the usage the
+    # realtime API reports, anything beyond that comes straight out of the bucket.
+    reserved: float
+    released: bool
+
+    def __init__(self, controller: "AdmissionController", reserved: float):
+        self._controller = controller
+        self.reserved = reserved
+        self.released = False
+
+    def consume(self, tokens: float) -> None:
+        covered = min(tokens, self.reserved)
+        self.reserved -= covered
+        self._controller._debit(tokens - covered)
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self._controller._release(self.reserved)
+        self.reserved = 0
+
+class AdmissionController:
+    # Keeps the sessions opened against one realtime deployment within its quota, instead of connecting
+    # anyway and having the call fail. A session is admitted while fewer than max_sessions are active and
+    # the token bucket (refilled at tokens_per_minute, holding at most a minute's worth) has at least
+    # session_tokens left, which the session reserves. Usage reported in response.done is charged against
+    # the reservation first and then the bucket, so heavy sessions slow down admission of new ones.
+    #
+    # Sessions that can't be admitted right away wait in FIFO order, at most max_queue of them and for at
+    # most queue_timeout seconds, after which AdmissionRejected is raised.
+    deployment: str
+    max_sessions: Optional[int]
+    tokens_per_minute: Optional[float]
+    session_tokens: float
+    max_queue: int
+    queue_timeout: float
+
+    def __init__(self,
+                 deployment: str,
+                 max_sessions: Optional[int] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 session_tokens: float = 2000,
+                 max_queue: int = 50,
+                 queue_timeout: float = 30.0):
+        if max_sessions is not None and max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1")
+        if tokens_per_minute is not None and tokens_per_minute < session_tokens:
+            raise ValueError("tokens_per_minute must be at least session_tokens")
+        self.deployment = deployment
+        self.max_sessions = max_sessions
+        self.tokens_per_minute = tokens_per_minute
+        self.session_tokens = session_tokens if tokens_per_minute is not None else 0
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._tokens = float(tokens_per_minute or 0)
+        self._refilled_at = time.monotonic()
+        self._waiters: deque[asyncio.Future] = deque()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    def stats(self) -> dict[str, float]:
+        self._refill()
+        return {"active": self._active, "queued": len(self._waiters), "tokens": self._tokens}
+
+    def _refill(self) -> None:
+        if self.tokens_per_minute is None:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.tokens_per_minute, self._tokens + (now - self._refilled_at) * self.tokens_per_minute / 60)
+        self._refilled_at = now
+        _tokens.set(self._tokens, deployment=self.deployment)
+
+    def _has_capacity(self) -> bool:
+        if self.max_sessions is not None and self._active >= self.max_sessions:
+            return False
+        self._refill()
+        return self.tokens_per_minute is None or self._tokens >= self.session_tokens
+
+    def _take(self) -> AdmissionTicket:
+        self._active += 1
+        if self.tokens_per_minute is not None:
+            self._tokens -= self.session_tokens
+            _tokens.set(self._tokens, deployment=self.deployment)
+        _admitted.set(self._active, deployment=self.deployment)
+        return AdmissionTicket(self, self.session_tokens)
+
+    async def acquire(self) -> AdmissionTicket:
+        start = time.monotonic()
+        # Nobody jumps the queue, even when a slot just opened up
+        if len(self._waiters) == 0 and self._has_capacity():
+            _queue_wait.observe(0, deployment=self.deployment, outcome="admitted")
+            return self._take()
+        if len(self._waiters) >= self.max_queue:
+            _rejections.inc(deployment=self.deployment, reason="queue_full")
+            raise AdmissionRejected("queue_full", self.deployment)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        _queued.set(len(self._waiters), deployment=self.deployment)
+        self._schedule_wakeup()
+        try:
+            ticket = await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                waiter.result().release()
+            _queue_wait.observe(time.monotonic() - start, deployment=self.deployment, outcome="timeout")
+            _rejections.inc(deployment=self.deployment, reason="timeout")
+            raise AdmissionRejected("timeout", self.deployment) from None
+        except asyncio.CancelledError:
+            # The caller hung up while waiting, hand back the slot if it was granted in the meantime
+            if waiter.done() and not waiter.cancelled():
+                waiter.result().release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            _queued.set(len(self._waiters), deployment=self.deployment)
+        _queue_wait.observe(time.monotonic() - start, deployment=self.deployment, outcome="admitted")
+        return ticket
+
+    def _dispatch(self) -> None:
+        self._wakeup = None
+        while len(self._waiters) > 0:
+            waiter = self._waiters[0]
+            if waiter.done():
+                self._waiters.popleft()
+                continue
+            if not self._has_capacity():
+                break
+            self._waiters.popleft()
+            waiter.set_result(self._take())
+        _queued.set(len(self._waiters), deployment=self.deployment)
+        self._schedule_wakeup()
+
+    def _schedule_wakeup(self) -> None:
+        # Sessions waiting only for tokens get woken up when the bucket will have enough, sessions
+        # waiting for a slot are woken up by _release
+        if self._wakeup is not None or len(self._waiters) == 0 or self.tokens_per_minute is None:
+            return
+        if self.max_sessions is not None and self._active >= self.max_sessions:
+            return
+        missing = self.session_tokens - self._tokens
+        delay = max(missing * 60 / self.tokens_per_minute, 0.01)
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _debit(self, tokens: float) -> None:
+        if tokens <= 0 or self.tokens_per_minute is None:
+            return
+        self._refill()
+        # The bucket can go negative, which holds back new sessions until the overuse is paid off
+        self._tokens -= tokens
+        _tokens.set(self._tokens, deployment=self.deployment)
+
+    def _release(self, unused_tokens: float) -> None:
+        self._active -= 1
+        _admitted.set(self._active, deployment=self.deployment)
+        if self.tokens_per_minute is not None and unused_tokens > 0:
+            self._refill()
+            self._tokens = min(self.tokens_per_minute, self._tokens + unused_tokens)
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        self._dispatch()
@@ -1,20 +1,44 @@
+import asyncio
 import logging
+import multiprocessing
 import os
 from pathlib import Path
 
 from aiohttp import web
+from azure.communication.callautomation import AudioFormat
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureDeveloperCliCredential, DefaultAzureCredential
 from dotenv import load_dotenv
 
+import codec
+import metrics
 from acsClient import ACSClient
-from ragtools import attach_rag_tools
+from admission import AdmissionController
+from embeddings import AzureOpenAIEmbedder, CachedEmbedder, HashingEmbedder
+from httpclient import client_sessions
+from localsearch import LocalSearchIndex, read_manifest
+from ragtools import attach_rag_tools, parse_shard_routes, watch_search_indexer
+from rtbackends import BackendSelector, RealtimeBackend
 from rtmt import RTMiddleTier
 from rtmtForAcs import RTMiddleTierForAcs
+from rtqueue import OverflowPolicy
+from searchcache import SearchCache
+from semanticcache import SemanticCache
+from serving import serve
+from tokenmanager import (
+    COGNITIVE_SERVICES_SCOPE,
+    COMMUNICATION_SCOPE,
+    SEARCH_SCOPE,
+    AsyncTokenManager,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("voicerag")
 
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render_prometheus().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
 async def create_app():
     if not os.environ.get("RUNNING_IN_PRODUCTION"):
         logger.info("Running in development mode, loading from .env file")
@@ -31,11 +55,27 @@ async def create_app():
         else:
             logger.info("Using DefaultAzureCredential")
             credential = DefaultAzureCredential()
-    llm_credential = AzureKeyCredential(llm_key) if llm_key else credential
-    search_credential = AzureKeyCredential(search_key) if search_key else credential
-    
+
     app = web.Application()
 
+    # One token manager serves every Entra ID token in the app, refreshing them in the background
+    # so no request ever waits on (or blocks the event loop for) a token refresh
+    token_manager = None
+    if credential is not None:
+        token_manager = AsyncTokenManager(credential)
+        scopes = [COMMUNICATION_SCOPE]
+        if not llm_key:
+            scopes.append(COGNITIVE_SERVICES_SCOPE)
+        if not search_key:
+            scopes.append(SEARCH_SCOPE)
+        await token_manager.start(*scopes)
+        async def close_token_manager(app):
+            await token_manager.close()
+        app.on_cleanup.append(close_token_manager)
+
+    llm_credential = AzureKeyCredential(llm_key) if llm_key else token_manager
+    search_credential = AzureKeyCredential(search_key) if search_key else token_manager
+
     rtmt = RTMiddleTier(
         credentials=llm_credential,
         endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
@@ -48,10 +88,71 @@ async def create_app():
         deployment=os.environ["AZURE_OPENAI_REALTIME_DEPLOYMENT"],
         voice_choice=os.environ.get("AZURE_OPENAI_REALTIME_VOICE_CHOICE") or "alloy"
         )
+    # Optionally spread sessions over more realtime deployments, in other regions for instance. Each new
+    # session goes to the one with the lowest latency and fails over when a handshake fails.
+    if extra_backends := os.environ.get("AZURE_OPENAI_REALTIME_BACKENDS"):
+        backends = BackendSelector(
+            [RealtimeBackend(os.environ["AZURE_OPENAI_ENDPOINT"], os.environ["AZURE_OPENAI_REALTIME_DEPLOYMENT"])] +
+            [RealtimeBackend(backend["endpoint"], backend.get("deployment") or os.environ["AZURE_OPENAI_REALTIME_DEPLOYMENT"],
+                             backend.get("key"), backend.get("name"))
+             for backend in codec.loads(extra_backends)],
+            in_flight_cost=float(os.environ.get("AZURE_OPENAI_REALTIME_IN_FLIGHT_COST") or 0.01))
+        logger.info("Routing realtime sessions across %s", ", ".join(backend.name for backend in backends.backends))
+        for middle_tier in (rtmt, rtmtForAcs):
+            middle_tier.use_backends(backends)
+    # Optionally keep upstream realtime connections open and authenticated ahead of time, which takes the
+    # TLS and websocket handshake out of the time to first greeting
+    pool_min_size = int(os.environ.get("AZURE_OPENAI_REALTIME_POOL_MIN_SIZE") or 0)
+    pool_max_size = 0
+    if pool_min_size > 0:
+        pool_max_size = int(os.environ.get("AZURE_OPENAI_REALTIME_POOL_MAX_SIZE") or pool_min_size * 4)
+        pool_idle_timeout = float(os.environ.get("AZURE_OPENAI_REALTIME_POOL_IDLE_TIMEOUT") or 60)
+        for middle_tier in (rtmt, rtmtForAcs):
+            middle_tier.use_connection_pool(pool_min_size, pool_max_size, pool_idle_timeout)
+    # Optionally keep the sessions opened against each deployment within its quota, callers over the
+    # limit wait in a queue instead of failing
+    max_sessions = int(os.environ.get("AZURE_OPENAI_REALTIME_MAX_SESSIONS") or 0) or None
+    tokens_per_minute = float(os.environ.get("AZURE_OPENAI_REALTIME_TOKENS_PER_MINUTE") or 0) or None
+    if max_sessions is not None and pool_max_size > 0:
+        # Idle pool connections are open against the deployment without an admission ticket, each tier's
+        # pool can hold up to pool_max_size of them, so that many sessions are kept back for them
+        pooled = pool_max_size * 2
+        if max_sessions <= pooled:
+            raise ValueError(f"AZURE_OPENAI_REALTIME_MAX_SESSIONS ({max_sessions}) must be larger than the {pooled} connections the pools can keep idle")
+        max_sessions -= pooled
+    if max_sessions is not None or tokens_per_minute is not None:
+        # Keyed by backend name, which is the same in both tiers
+        admission = {backend.name: AdmissionController(
+                         backend.name,
+                         max_sessions=max_sessions,
+                         tokens_per_minute=tokens_per_minute,
+                         session_tokens=float(os.environ.get("AZURE_OPENAI_REALTIME_SESSION_TOKENS") or 2000),
+                         max_queue=int(os.environ.get("AZURE_OPENAI_REALTIME_ADMISSION_QUEUE") or 50),
+                         queue_timeout=float(os.environ.get("AZURE_OPENAI_REALTIME_ADMISSION_TIMEOUT") or 30))
+                     for backend in rtmt.backends.backends}
+        for middle_tier in (rtmt, rtmtForAcs):
+            middle_tier.use_admission_control(admission)
+    # Record every session for replaying it later with benchmarks/replay.py
+    if trace_directory := os.environ.get("REALTIME_TRACE_DIR"):
+        for middle_tier in (rtmt, rtmtForAcs):
+            middle_tier.use_tracing(trace_directory)
+    # How much each call may buffer for a slow consumer, and what happens when that fills up
+    for middle_tier in (rtmt, rtmtForAcs):
+        middle_tier.use_queue_settings(
+            high_watermark=int(os.environ.get("REALTIME_QUEUE_HIGH_WATERMARK") or 200),
+            low_watermark=int(os.environ.get("REALTIME_QUEUE_LOW_WATERMARK") or 50),
+            client_overflow_policy=OverflowPolicy(os.environ.get("REALTIME_CLIENT_OVERFLOW_POLICY") or "backpressure"),
+            server_overflow_policy=OverflowPolicy(os.environ.get("REALTIME_SERVER_OVERFLOW_POLICY") or "backpressure"))
+    # Optionally have ACS stream 16 kHz audio, or the realtime API take G.711, converting in between
+    acs_audio_format = AudioFormat(os.environ.get("ACS_AUDIO_FORMAT") or AudioFormat.PCM24_K_MONO.value)
+    rtmtForAcs.use_audio_formats(
+        acs_sample_rate=16000 if acs_audio_format == AudioFormat.PCM16_K_MONO else 24000,
+        realtime_audio_format=os.environ.get("AZURE_OPENAI_REALTIME_AUDIO_FORMAT") or "pcm16")
     acs = ACSClient(
         acsEndpoint=os.environ["ACS_ENDPOINT"],
         callbackUriHost=os.environ["CALLBACK_URI_HOST"],
-        credentials=credential
+        credentials=token_manager,
+        audio_format=acs_audio_format
         )
     rtmt.system_message = """
         You are a helpful assistant. Only answer questions based on information you searched in the knowledge base, accessible with the 'search' tool. 
@@ -73,19 +174,93 @@ async def create_app():
         4. Make a 3s pause at the end of each answer.
     """.strip()
 
-    attach_rag_tools(rtmt,
-        credentials=search_credential,
-        search_endpoint=os.environ.get("AZURE_SEARCH_ENDPOINT"),
-        search_index=os.environ.get("AZURE_SEARCH_INDEX"),
-        semantic_configuration=os.environ.get("AZURE_SEARCH_SEMANTIC_CONFIGURATION") or None,
-        identifier_field=os.environ.get("AZURE_SEARCH_IDENTIFIER_FIELD") or "chunk_id",
-        content_field=os.environ.get("AZURE_SEARCH_CONTENT_FIELD") or "chunk",
-        embedding_field=os.environ.get("AZURE_SEARCH_EMBEDDING_FIELD") or "text_vector",
-        title_field=os.environ.get("AZURE_SEARCH_TITLE_FIELD") or "title",
-        use_vector_query=(os.environ.get("AZURE_SEARCH_USE_VECTOR_QUERY") == "true") or True
-        )
+    # Everything that embeds queries with Azure OpenAI shares one cache of their embeddings, optionally
+    # kept in a file so a restarted replica doesn't have to embed the frequent queries again
+    openai_embedder = None
+    if embedding_deployment := os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"):
+        embedding_cache_path = os.environ.get("AZURE_OPENAI_EMBEDDING_CACHE_PATH") or None
+        if embedding_cache_path is not None and multiprocessing.current_process().name != "MainProcess":
+            # Each worker process has its own cache file
+            embedding_cache_path += "." + multiprocessing.current_process().name
+        openai_embedder = CachedEmbedder(
+            AzureOpenAIEmbedder(
+                os.environ["AZURE_OPENAI_ENDPOINT"],
+                embedding_deployment,
+                credentials=llm_credential,
+                dimensions=int(os.environ.get("AZURE_OPENAI_EMBEDDING_DIMENSIONS") or 3072)),
+            max_entries=int(os.environ.get("AZURE_OPENAI_EMBEDDING_CACHE_SIZE") or 10000),
+            path=embedding_cache_path)
+        async def close_embedding_cache(app):
+            await openai_embedder.close()
+        app.on_cleanup.append(close_embedding_cache)
+
+    # Optionally serve the knowledge base from an index directory in the process instead of Azure AI Search
+    search_backend = None
+    if local_index := os.environ.get("LOCAL_SEARCH_INDEX"):
+        manifest = read_manifest(local_index)
+        if manifest["embedder"] == "hashing":
+            index_embedder = HashingEmbedder(manifest["dimensions"])
+        elif openai_embedder is not None and openai_embedder.dimensions == manifest["dimensions"]:
+            index_embedder = openai_embedder
+        else:
+            index_embedder = AzureOpenAIEmbedder(
+                os.environ["AZURE_OPENAI_ENDPOINT"],
+                os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"],
+                credentials=llm_credential,
+                dimensions=manifest["dimensions"])
+        search_backend = LocalSearchIndex(local_index, index_embedder)
+        logger.info("Searching %d chunks from %s in process", len(search_backend), local_index)
+
+    # Optionally search several indexes, one per document family, instead of AZURE_SEARCH_INDEX
+    search_shards = parse_shard_routes(os.environ.get("AZURE_SEARCH_INDEXES") or "") or None
+
+    # Both tiers share a cache of search results, emptied whenever the indexer finishes a run
+    search_cache = None
+    search_cache_bytes = int(os.environ.get("AZURE_SEARCH_CACHE_MAX_BYTES") or 16 * 1024 * 1024)
+    if search_cache_bytes > 0:
+        search_cache = SearchCache(search_cache_bytes, ttl=float(os.environ.get("AZURE_SEARCH_CACHE_TTL") or 300))
+    # Optionally also reuse the results for rephrasings of a query searched recently
+    semantic_cache = None
+    if (semantic_threshold := os.environ.get("AZURE_SEARCH_SEMANTIC_CACHE_THRESHOLD")) and openai_embedder is None:
+        # Hashed words would match queries that look alike but mean different things
+        logger.warning("AZURE_SEARCH_SEMANTIC_CACHE_THRESHOLD is set without AZURE_OPENAI_EMBEDDING_DEPLOYMENT, the semantic cache is off")
+    elif semantic_threshold:
+        semantic_cache = SemanticCache(openai_embedder,
+            threshold=float(semantic_threshold),
+            max_entries=int(os.environ.get("AZURE_SEARCH_SEMANTIC_CACHE_MAX_ENTRIES") or 2048),
+            ttl=float(os.environ.get("AZURE_SEARCH_CACHE_TTL") or 300))
+    if search_backend is None and (search_cache is not None or semantic_cache is not None):
+        watcher = watch_search_indexer(search_credential,
+            search_endpoint=os.environ.get("AZURE_SEARCH_ENDPOINT"),
+            # Shards are filled by indexers named after them
+            indexer_name=list(search_shards) if search_shards else os.environ.get("AZURE_SEARCH_INDEXER") or os.environ.get("AZURE_SEARCH_INDEX"),
+            interval=float(os.environ.get("AZURE_SEARCH_CACHE_INDEXER_POLL") or 60))
+        for cache in (search_cache, semantic_cache):
+            if cache is not None:
+                watcher.on_change(cache.clear)
+        watcher.attach_to_app(app)
+
+    # Optionally start searching for what phone callers said as soon as it's transcribed
+    if os.environ.get("AZURE_SEARCH_SPECULATIVE") == "true":
+        rtmtForAcs.use_speculative_tool_calls()
+    speculation_threshold = float(os.environ.get("AZURE_SEARCH_SPECULATION_THRESHOLD") or 0.75)
+    # Optionally only send the model the sentences of the results most relevant to its query
+    token_budget = int(os.environ.get("AZURE_SEARCH_TOKEN_BUDGET") or 0) or None
+    # Optionally search for each part of questions like "compare Standard and Plus dental coverage" at once
+    max_subqueries = int(os.environ.get("AZURE_SEARCH_MAX_SUBQUERIES") or 1)
+    # Optionally send a second search when the first is slower than usual, and give up on searches at a deadline
+    hedge_quantile = float(os.environ.get("AZURE_SEARCH_HEDGE_QUANTILE") or 0) or None
+    search_deadline = float(os.environ.get("AZURE_SEARCH_DEADLINE") or 0) or None
+    max_hedge_rate = float(os.environ.get("AZURE_SEARCH_MAX_HEDGE_RATE") or 0.1)
+    # Optionally embed queries here, with the cache above, instead of having Azure AI Search call the vectorizer
+    query_embedder = None
+    if os.environ.get("AZURE_SEARCH_CLIENT_EMBEDDINGS") == "true":
+        query_embedder = openai_embedder
+        if query_embedder is None:
+            logger.warning("AZURE_SEARCH_CLIENT_EMBEDDINGS is set without AZURE_OPENAI_EMBEDDING_DEPLOYMENT, Azure AI Search will embed queries")
 
-    attach_rag_tools(rtmtForAcs,
+    # Both tiers get the same search tool, sharing its caches and search backend
+    rag_tools = dict(
         credentials=search_credential,
         search_endpoint=os.environ.get("AZURE_SEARCH_ENDPOINT"),
         search_index=os.environ.get("AZURE_SEARCH_INDEX"),
@@ -94,23 +269,47 @@ async def create_app():
         content_field=os.environ.get("AZURE_SEARCH_CONTENT_FIELD") or "chunk",
         embedding_field=os.environ.get("AZURE_SEARCH_EMBEDDING_FIELD") or "text_vector",
         title_field=os.environ.get("AZURE_SEARCH_TITLE_FIELD") or "title",
-        use_vector_query=(os.environ.get("AZURE_SEARCH_USE_VECTOR_QUERY") == "true") or True
+        use_vector_query=(os.environ.get("AZURE_SEARCH_USE_VECTOR_QUERY") == "true") or True,
+        cache=search_cache,
+        semantic_cache=semantic_cache,
+        speculation_threshold=speculation_threshold,
+        backend=search_backend,
+        token_budget=token_budget,
+        max_subqueries=max_subqueries,
+        hedge_quantile=hedge_quantile,
+        search_deadline=search_deadline,
+        max_hedge_rate=max_hedge_rate,
+        query_embedder=query_embedder,
+        search_shards=search_shards
         )
+    for tier in (rtmt, rtmtForAcs):
+        attach_rag_tools(tier, **rag_tools)
     
     rtmt.attach_to_app(app, "/realtime")
     rtmtForAcs.attach_to_app(app, "/realtimeForAcs")
+    # On shutdown (a deployment replacing this replica, or a worker being stopped) calls in progress
+    # get some time to finish before their websockets are closed
+    drain_timeout = float(os.environ.get("APP_SHUTDOWN_DRAIN_TIMEOUT") or 30)
+    async def drain_sessions(app):
+        await asyncio.gather(rtmt.drain(drain_timeout), rtmtForAcs.drain(drain_timeout))
+    app.on_shutdown.append(drain_sessions)
+    # Registered last so the shared HTTP sessions outlive everything else that uses them during cleanup
+    client_sessions().attach_to_app(app)
 
     current_directory = Path(__file__).parent
     app.add_routes([
         web.get('/', lambda _: web.FileResponse(current_directory / 'static/index.html')),
         web.post('/api/incomingCall', acs.incomingCall),
         web.post('/api/callbacks/{contextid}', acs.callbacks),
+        web.get('/metrics', metrics_handler),
     ])
     app.router.add_static('/', path=current_directory / 'static', name='static')
     
     return app
 
 if __name__ == "__main__":
-    host = "localhost"
-    port = 8765
-    web.run_app(create_app(), host=host, port=port)
+    serve(create_app,
+          host=os.environ.get("HOST") or "localhost",
+          port=int(os.environ.get("PORT") or 8765),
+          workers=int(os.environ.get("WEB_CONCURRENCY") or 1),
+          event_loop=os.environ.get("APP_EVENT_LOOP") or "auto")
@@ -0,0 +1,153 @@
+import base64
+import math
+import time
+from typing import Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import metrics
+
+_conversion_seconds = metrics.counter("voicerag_audio_conversion_seconds_total", "Time spent converting call audio between the ACS and realtime API formats, by direction")
+
+# Audio formats the realtime API takes and the sample rate of each
+REALTIME_SAMPLE_RATES = {"pcm16": 24000, "g711_ulaw": 8000, "g711_alaw": 8000}
+
+# Upper bounds of the G.711 segments, for 14 bit (μ-law) and 13 bit (A-law) magnitudes
+_ULAW_SEGMENT_ENDS = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF])
+_ALAW_SEGMENT_ENDS = np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF])
+
+def _g711_tables() -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    # Encoding tables with a byte for every 16 bit sample (indexed by the sample's bits as unsigned) and
+    # decoding tables with a sample for every byte, so converting a frame is a single lookup. Built once
+    # with the reference algorithm of ITU-T G.711.
+    pcm = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32)
+    codes = np.arange(256, dtype=np.int32)
+
+    value = pcm >> 2
+    mask = np.where(value < 0, 0x7F, 0xFF)
+    value = np.minimum(np.abs(value), 8159) + (0x84 >> 2)
+    segment = np.searchsorted(_ULAW_SEGMENT_ENDS, value)
+    ulaw = np.where(segment >= 8, 0x7F, (segment << 4) | ((value >> (segment + 1)) & 0xF)) ^ mask
+    inverted = ~codes & 0xFF
+    magnitude = (((inverted & 0xF) << 3) + 0x84) << ((inverted & 0x70) >> 4)
+    ulaw_linear = np.where(inverted & 0x80, 0x84 - magnitude, magnitude - 0x84)
+
+    value = pcm >> 3
+    mask = np.where(value >= 0, 0xD5, 0x55)
+    value = np.where(value >= 0, value, -value - 1)
+    segment = np.searchsorted(_ALAW_SEGMENT_ENDS, value)
+    alaw = np.where(segment >= 8, 0x7F, (segment << 4) | (np.where(segment < 2, value >> 1, value >> segment) & 0xF)) ^ mask
+    toggled = codes ^ 0x55
+    magnitude = (toggled & 0xF) << 4
+    segment = (toggled & 0x70) >> 4
+    magnitude = np.where(segment == 0, magnitude + 8, (magnitude + 0x108) << np.maximum(segment - 1, 0))
+    alaw_linear = np.where(toggled & 0x80, magnitude, -magnitude)
+
+    return {
+        "g711_ulaw": (ulaw.astype(np.uint8), ulaw_linear.astype("<i2")),
+        "g711_alaw": (alaw.astype(np.uint8), alaw_linear.astype("<i2")),
+    }
+
+_G711 = _g711_tables()
+
+def encode(samples: np.ndarray, audio_format: str) -> bytes:
+    if audio_format == "pcm16":
+        return samples.astype("<i2", copy=False).tobytes()
+    return _G711[audio_format][0][samples.astype(np.int16, copy=False).view(np.uint16)].tobytes()
+
+def decode(data: bytes, audio_format: str) -> np.ndarray:
+    if audio_format == "pcm16":
+        return np.frombuffer(data, dtype="<i2").astype(np.int16)
+    return _G711[audio_format][1][np.frombuffer(data, dtype=np.uint8)].astype(np.int16)
+
+class Resampler:
+    # Streaming polyphase resampler between rates with a small ratio (16 and 24 kHz, 24 and 8 kHz). The
+    # low-pass filter is a Kaiser windowed sinc with taps_per_phase taps for every output sample, cut off
+    # below the lower of the two Nyquist frequencies. The last input samples of a frame are kept for the
+    # start of the next one, so frames convert the same as the whole stream would.
+    from_rate: int
+    to_rate: int
+
+    def __init__(self, from_rate: int, to_rate: int, taps_per_phase: int = 24):
+        self.from_rate = from_rate
+        self.to_rate = to_rate
+        divisor = math.gcd(from_rate, to_rate)
+        self._up = to_rate // divisor
+        self._down = from_rate // divisor
+        length = taps_per_phase * self._up
+        cutoff = 0.95 / max(self._up, self._down)
+        t = np.arange(length) - (length - 1) / 2
+        taps = cutoff * np.sinc(cutoff * t) * np.kaiser(length, 8.0)
+        taps *= self._up / taps.sum()
+        # Row p has the taps for outputs in phase p, applied to the taps_per_phase input samples up to
+        # the one the output lines up with, oldest first
+        self._phases = taps.reshape(taps_per_phase, self._up).T[:, ::-1].astype(np.float32)
+        self.reset()
+
+    def reset(self) -> None:
+        self._history = np.zeros(self._phases.shape[1] - 1, dtype=np.float32)
+        # Position of the next output sample in the upsampled stream, relative to the next frame's start
+        self._position = 0
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        if self._up == self._down:
+            return samples
+        if len(samples) == 0:
+            # A frame with only half a sample in it, see AudioConverter
+            return samples.astype(np.int16)
+        buffer = np.concatenate((self._history, samples.astype(np.float32)))
+        end = len(samples) * self._up
+        positions = np.arange(self._position, end, self._down)
+        output = np.empty(len(positions), dtype=np.float32)
+        # Every up-th output has the same phase and lines up with an input down samples further on, so
+        # each phase is a matrix-vector product over a strided view of the input, without copying it
+        windows = sliding_window_view(buffer, self._phases.shape[1])
+        for first in range(min(self._up, len(positions))):
+            start = positions[first] // self._up
+            count = len(range(first, len(positions), self._up))
+            output[first::self._up] = windows[start:start + (count - 1) * self._down + 1:self._down] @ self._phases[positions[first] % self._up]
+        self._position += len(positions) * self._down - end
+        self._history = buffer[len(buffer) - len(self._history):]
+        return np.clip(np.rint(output), -32768, 32767).astype(np.int16)
+
+class AudioConverter:
+    # Converts a stream of base64 audio frames from one format and sample rate to another, keeping the
+    # state of the stream (the resampler's, a byte of a sample split across frames) between frames.
+    # One per session and direction.
+    source_format: str
+    target_format: str
+    direction: str
+
+    def __init__(self, source_format: str, source_rate: int, target_format: str, target_rate: int, direction: str):
+        self.source_format = source_format
+        self.target_format = target_format
+        self.direction = direction
+        self._resampler = Resampler(source_rate, target_rate)
+        self._carry = b""
+
+    def reset(self) -> None:
+        # When the stream is cut off, so the start of the next audio doesn't get the end of the last one
+        self._resampler.reset()
+        self._carry = b""
+
+    def convert(self, data: str) -> str:
+        started = time.perf_counter()
+        raw = self._carry + base64.b64decode(data)
+        if self.source_format == "pcm16" and len(raw) % 2 == 1:
+            raw, self._carry = raw[:-1], raw[-1:]
+        else:
+            self._carry = b""
+        samples = self._resampler.process(decode(raw, self.source_format))
+        converted = base64.b64encode(encode(samples, self.target_format)).decode("ascii")
+        _conversion_seconds.inc(time.perf_counter() - started, direction=self.direction)
+        return converted
+
+def call_audio_converters(acs_sample_rate: int, realtime_format: str) -> Optional[tuple[AudioConverter, AudioConverter]]:
+    # The converters for the audio a caller sends and for the audio they hear, or None when ACS streams
+    # the format the realtime API uses
+    realtime_rate = REALTIME_SAMPLE_RATES[realtime_format]
+    if realtime_format == "pcm16" and acs_sample_rate == realtime_rate:
+        return None
+    return (AudioConverter("pcm16", acs_sample_rate, realtime_format, realtime_rate, "to_server"),
+            AudioConverter(realtime_format, realtime_rate, "pcm16", acs_sample_rate, "to_client"))
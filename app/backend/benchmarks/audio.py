@@ -0,0 +1,67 @@
+import argparse
+import base64
+import time
+
+import numpy as np
+
+from audioconvert import REALTIME_SAMPLE_RATES, call_audio_converters, encode
+
+# Measures the CPU time audio conversion costs per second of call, for each pair of ACS and realtime
+# API formats. A call second is 50 frames of 20 ms from the caller and a second of the answer, which
+# the realtime API sends in deltas of --delta-ms. Both directions are converted, so this assumes
+# the assistant talks all the time, more than it does on a real call.
+#
+# Run from app/backend:  python -m benchmarks.audio [--seconds 60]
+
+_CONFIGURATIONS = [(24000, "pcm16"), (16000, "pcm16"), (24000, "g711_ulaw"), (16000, "g711_ulaw"), (16000, "g711_alaw")]
+
+def _speech(sample_rate: int, seconds: float, seed: int) -> np.ndarray:
+    # Noise shaped like speech closely enough for timing: a few harmonics with a moving pitch, and noise
+    random = np.random.default_rng(seed)
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    pitch = 150 + 30 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    signal = sum(np.sin(phase * harmonic) / harmonic for harmonic in range(1, 6)) + 0.1 * random.standard_normal(len(t))
+    return (3000 * signal).astype("<i2")
+
+def _frames(samples: bytes, frame_bytes: int) -> list[str]:
+    return [base64.b64encode(samples[i:i + frame_bytes]).decode("ascii") for i in range(0, len(samples), frame_bytes)]
+
+def main(seconds: float, delta_ms: int):
+    print(f"{seconds:g} call seconds, caller frames of 20 ms, answer deltas of {delta_ms} ms")
+    print(f"{'ACS':<8}{'realtime':<12}{'in µs/frame':>13}{'out µs/delta':>14}{'CPU ms per call s':>19}{'calls per core':>16}")
+    for acs_rate, realtime_format in _CONFIGURATIONS:
+        converters = call_audio_converters(acs_rate, realtime_format)
+        realtime_rate = REALTIME_SAMPLE_RATES[realtime_format]
+        caller = _frames(_speech(acs_rate, seconds, 1).tobytes(), acs_rate * 2 // 50)
+        answer_pcm = _speech(realtime_rate, seconds, 2)
+        if realtime_format == "pcm16":
+            answer = answer_pcm.tobytes()
+            delta_bytes = realtime_rate * 2 * delta_ms // 1000
+        else:
+            # What the realtime API sends in G.711, one byte per sample
+            answer = encode(answer_pcm, realtime_format)
+            delta_bytes = realtime_rate * delta_ms // 1000
+        deltas = _frames(answer, delta_bytes)
+        if converters is None:
+            print(f"{acs_rate // 1000:<3}kHz  {realtime_format:<12}{'passed through as is':>62}")
+            continue
+        audio_in, audio_out = converters
+        started = time.process_time()
+        for frame in caller:
+            audio_in.convert(frame)
+        inbound = time.process_time() - started
+        started = time.process_time()
+        for delta in deltas:
+            audio_out.convert(delta)
+        outbound = time.process_time() - started
+        per_second = (inbound + outbound) / seconds
+        print(f"{acs_rate // 1000:<3}kHz  {realtime_format:<12}{inbound / len(caller) * 1e6:>13.1f}{outbound / len(deltas) * 1e6:>14.1f}"
+              f"{per_second * 1000:>19.3f}{1 / per_second:>16.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU time of audio conversion per call second")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--delta-ms", type=int, default=100, help="Length of the audio deltas the realtime API sends")
+    args = parser.parse_args()
+    main(args.seconds, args.delta_ms)
@@ -0,0 +1,82 @@
+import argparse
+import base64
+import json
+import os
+import time
+from typing import Any, Callable
+
+# Compares the JSON codecs codec.py can pick from on realtime traffic: decoding every frame and
+# re-encoding it, which is what the middle tiers do for the frames they inspect.
+#
+# Run from app/backend:  python -m benchmarks.codec [--recording frames.jsonl] [--rounds 20]
+#
+# A recording is a text file with one raw websocket frame per line, for example captured from the
+# realtime API with a websocket debugging proxy. Without one a synthetic call is used.
+
+def _codecs() -> dict[str, tuple[Callable[[Any], str], Callable[[str], Any]]]:
+    codecs = {"json": (json.dumps, json.loads)}
+    try:
+        import orjson
+        codecs["orjson"] = (lambda obj: orjson.dumps(obj).decode("utf-8"), orjson.loads)
+    except ImportError:
+        print("orjson is not installed, skipping it")
+    try:
+        import ujson
+        codecs["ujson"] = (lambda obj: ujson.dumps(obj, ensure_ascii=False), ujson.loads)
+    except ImportError:
+        print("ujson is not installed, skipping it")
+    return codecs
+
+def _audio(ms: int) -> str:
+    # PCM16 mono at 24kHz
+    return base64.b64encode(os.urandom(48 * ms)).decode("ascii")
+
+def _synthetic_call(seconds: int = 30) -> list[str]:
+    frames = [json.dumps({"type": "session.created", "event_id": "event_1", "session": {
+        "id": "sess_123", "object": "realtime.session", "model": "gpt-4o-realtime-preview", "modalities": ["audio", "text"],
+        "instructions": "You are a helpful assistant. " * 20, "voice": "alloy", "input_audio_format": "pcm16",
+        "output_audio_format": "pcm16", "input_audio_transcription": None,
+        "turn_detection": {"type": "server_vad", "threshold": 0.5, "prefix_padding_ms": 300, "silence_duration_ms": 200},
+        "tools": [], "tool_choice": "auto", "temperature": 0.8, "max_response_output_tokens": "inf"}})]
+    for second in range(seconds):
+        # About 10 appends and 10 audio deltas per second, a transcript delta now and then
+        for i in range(10):
+            frames.append(json.dumps({"type": "input_audio_buffer.append", "audio": _audio(100)}))
+            frames.append(json.dumps({"type": "response.audio.delta", "event_id": f"event_{second}_{i}", "response_id": "resp_123",
+                                      "item_id": "item_123", "output_index": 0, "content_index": 0, "delta": _audio(100)}))
+        frames.append(json.dumps({"type": "response.audio_transcript.delta", "event_id": f"event_{second}", "response_id": "resp_123",
+                                  "item_id": "item_123", "output_index": 0, "content_index": 0, "delta": "Sure, here's what I found "}))
+    frames.append(json.dumps({"type": "response.done", "event_id": "event_done", "response": {
+        "id": "resp_123", "object": "realtime.response", "status": "completed", "status_details": None,
+        "output": [{"id": "item_123", "type": "message", "role": "assistant",
+                    "content": [{"type": "audio", "transcript": "Sure, here's what I found. " * 10}]}],
+        "usage": {"total_tokens": 1234, "input_tokens": 1000, "output_tokens": 234}}}))
+    return frames
+
+def _load_recording(path: str) -> list[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+def main(frames: list[str], rounds: int):
+    total_bytes = sum(len(frame) for frame in frames) * rounds
+    print(f"{len(frames)} frames, {total_bytes / rounds / 1024 / 1024:.1f} MB per round, {rounds} rounds")
+    print(f"{'codec':<10}{'loads MB/s':>12}{'dumps MB/s':>12}{'round trip us/frame':>22}")
+    for name, (dumps, loads) in _codecs().items():
+        start = time.process_time()
+        for _ in range(rounds):
+            decoded = [loads(frame) for frame in frames]
+        loads_seconds = time.process_time() - start
+        start = time.process_time()
+        for _ in range(rounds):
+            for message in decoded:
+                dumps(message)
+        dumps_seconds = time.process_time() - start
+        round_trip_us = (loads_seconds + dumps_seconds) / (len(frames) * rounds) * 1_000_000
+        print(f"{name:<10}{total_bytes / loads_seconds / 1024 / 1024:>12,.0f}{total_bytes / dumps_seconds / 1024 / 1024:>12,.0f}{round_trip_us:>22.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare JSON codecs on realtime traffic")
+    parser.add_argument("--recording", help="Text file with one recorded websocket frame per line")
+    parser.add_argument("--rounds", type=int, default=20, help="Times to go through the frames")
+    args = parser.parse_args()
+    main(_load_recording(args.recording) if args.recording else _synthetic_call(), args.rounds)
@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import glob
+import os
+import statistics
+import tempfile
+import time
+
+from compression import compress_results, estimate_tokens, format_results
+from embeddings import HashingEmbedder
+from localsearch import LocalSearchIndex, build_index, read_manifest
+from searchcache import normalize_query, query_words
+
+# Compresses search results at several token budgets and reports the tokens sent to the model, the
+# share of the query's words the output still contains (a rough check that the relevant sentences
+# survived) and the time compression takes. Runs offline on a LocalSearchIndex.
+#
+# Run from app/backend:  python -m benchmarks.compression [--index directory] [--queries queries.txt]
+#
+# Every token kept out of the realtime model's input is one it doesn't have to process before it
+# starts answering, compare voicerag_turn_first_audio_seconds with and without AZURE_SEARCH_TOKEN_BUDGET
+# to see what that's worth on a deployment.
+
+_QUERIES = [
+    "What does Contoso Electronics make?",
+    "What are the company's core values?",
+    "How do I set up the search index?",
+    "Which environment variables configure the search cache?",
+    "How do phone calls reach the backend?",
+    "How many sessions can wait for admission?",
+]
+
+def _coverage(query: str, text: str) -> float:
+    words = query_words(query)
+    present = set(normalize_query(text).split())
+    return len(words & present) / len(words) if len(words) > 0 else 1.0
+
+async def main(directory: str, queries: list[str], budgets: list[int]):
+    manifest = read_manifest(directory)
+    index = LocalSearchIndex(directory, HashingEmbedder(manifest["dimensions"]))
+    results = [(query, await index.search(query)) for query in queries]
+    full = [estimate_tokens(format_results(docs)) for _, docs in results]
+    print(f"{len(results)} queries, {statistics.mean(full):.0f} tokens of results on average")
+    print(f"{'budget':<8}{'tokens':>8}{'saved':>8}{'coverage':>10}{'compress ms':>13}")
+    print(f"{'none':<8}{statistics.mean(full):>8.0f}{0:>8.0%}{statistics.mean(_coverage(q, format_results(d)) for q, d in results):>10.0%}{0:>13.3f}")
+    for budget in budgets:
+        tokens = []
+        coverage = []
+        seconds = []
+        for query, docs in results:
+            started = time.perf_counter()
+            compressed = compress_results(query, docs, budget)
+            seconds.append(time.perf_counter() - started)
+            tokens.append(estimate_tokens(compressed))
+            coverage.append(_coverage(query, compressed))
+        saved = 1 - sum(tokens) / sum(full)
+        print(f"{budget:<8}{statistics.mean(tokens):>8.0f}{saved:>8.0%}{statistics.mean(coverage):>10.0%}{statistics.median(seconds) * 1000:>13.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokens saved by compressing search tool output")
+    parser.add_argument("--index", help="Index directory built with python -m localsearch build")
+    parser.add_argument("--queries", help="Text file with one query per line")
+    parser.add_argument("--budgets", default="100,200,400,800", help="Comma separated token budgets")
+    args = parser.parse_args()
+    queries = _QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    budgets = [int(b) for b in args.budgets.split(",")]
+    if args.index:
+        asyncio.run(main(args.index, queries, budgets))
+    else:
+        repository = os.path.join(os.path.dirname(__file__), "..", "..", "..")
+        files = glob.glob(os.path.join(repository, "data", "*.md")) + glob.glob(os.path.join(repository, "docs", "*.md")) + glob.glob(os.path.join(repository, "*.md"))
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(build_index(directory, files, "hashing", 2000))
+            asyncio.run(main(directory, queries, budgets))
@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import random
+import time
+from typing import Optional
+
+from hedging import Hedger
+
+# Compares search latency with and without hedging against a stand-in for Azure AI Search whose
+# latency has a long tail: most requests take around --median-ms, but --straggler-rate of them get
+# stuck for --straggler-ms more, the way a request to a busy replica or one that lost a packet does.
+#
+# Run from app/backend:  python -m benchmarks.hedging [--requests 2000] [--concurrency 20]
+
+class _SlowSearch:
+    sent: int
+
+    def __init__(self, median: float, straggler_rate: float, straggler: float, seed: int):
+        self.median = median
+        self.straggler_rate = straggler_rate
+        self.straggler = straggler
+        self.sent = 0
+        self._random = random.Random(seed)
+
+    async def search(self) -> list[dict]:
+        self.sent += 1
+        latency = self.median * self._random.lognormvariate(0, 0.3)
+        if self._random.random() < self.straggler_rate:
+            latency += self.straggler
+        await asyncio.sleep(latency)
+        return []
+
+def _percentile(samples: list[float], quantile: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * quantile))]
+
+async def _run(hedger: Optional[Hedger], requests: int, concurrency: int, search: _SlowSearch) -> list[float]:
+    latencies = []
+    remaining = iter(range(requests))
+    timeouts = 0
+
+    async def worker():
+        nonlocal timeouts
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                await (search.search() if hedger is None else hedger.run(search.search))
+            except asyncio.TimeoutError:
+                timeouts += 1
+            latencies.append(time.perf_counter() - started)
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    if timeouts > 0:
+        print(f"  {timeouts} requests hit the deadline")
+    return sorted(latencies)
+
+async def main(args):
+    configurations: list[tuple[str, Optional[Hedger]]] = [("no hedging", None)]
+    for quantile in args.quantiles:
+        configurations.append((f"hedge at p{quantile * 100:g}", Hedger("search", quantile, args.deadline, args.max_hedge_rate)))
+    if args.deadline is not None:
+        configurations.append(("deadline only", Hedger("search", None, args.deadline)))
+    print(f"{args.requests} searches, {args.concurrency} at a time, {args.straggler_rate:.0%} stragglers")
+    print(f"{'':<16}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}{'extra load':>12}")
+    for name, hedger in configurations:
+        search = _SlowSearch(args.median_ms / 1000, args.straggler_rate, args.straggler_ms / 1000, args.seed)
+        latencies = await _run(hedger, args.requests, args.concurrency, search)
+        extra = search.sent / args.requests - 1
+        print(f"{name:<16}" + "".join(f"{_percentile(latencies, q) * 1000:>9.0f}" for q in (0.5, 0.9, 0.99, 1.0)) + f"{extra:>12.1%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search tail latency with and without hedged requests")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--median-ms", type=float, default=80)
+    parser.add_argument("--straggler-rate", type=float, default=0.03)
+    parser.add_argument("--straggler-ms", type=float, default=1000)
+    parser.add_argument("--quantiles", type=lambda value: [float(q) for q in value.split(",")], default=[0.9, 0.95])
+    parser.add_argument("--deadline", type=float, help="Seconds before a search gives up")
+    parser.add_argument("--max-hedge-rate", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+from azure.core.credentials import AzureKeyCredential
+
+from benchmarks.mock_realtime import (
+    MockTiming,
+    audio_stamp,
+    percentiles,
+    run,
+    stamp_audio,
+)
+
+# Load test for the middle tiers without Azure OpenAI: the backend runs against the local mock
+# realtime endpoint (benchmarks/mock_realtime.py) and thousands of simulated browser or ACS callers
+# stream audio through it while the mock plays conversations back, with tool calls every few turns.
+#
+# Run from app/backend:  python -m benchmarks.loadtest --path /realtimeForAcs --sessions 1000
+#
+# Reports throughput, the latency the middle tier adds to audio in each direction (mock -> caller and
+# caller -> mock, both including one loopback hop), and the backend's CPU time and memory per session.
+# CPU and memory are read from /proc, so they're only reported on Linux. Each simulated caller holds
+# two sockets, raise the open file limit (ulimit -n) for large runs.
+
+BENCH_PORT = 8765
+MOCK_PORT = 8766
+
+async def _bench_search(args):
+    from rtsession import ToolResult, ToolResultDirection
+    await asyncio.sleep(float(os.environ.get("BENCH_TOOL_DELAY") or 0.05))
+    return ToolResult({"sources": [{"chunk_id": "1", "title": "bench.md", "chunk": "Benchmark content " * 50}]}, ToolResultDirection.TO_SERVER)
+
+_SEARCH_SCHEMA = {
+    "type": "function",
+    "name": "search",
+    "description": "Benchmark search tool",
+    "parameters": {"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}
+}
+
+async def create_bench_app() -> web.Application:
+    # The real middle tiers with a stand-in search tool, pointed at the mock endpoint
+    import rtmt
+    import rtmtForAcs
+    from rtsession import Tool
+
+    app = web.Application()
+    credentials = AzureKeyCredential("benchmark")
+    endpoint = os.environ.get("BENCH_REALTIME_ENDPOINT") or f"http://localhost:{MOCK_PORT}"
+    browser = rtmt.RTMiddleTier(endpoint=endpoint, deployment="benchmark", credentials=credentials)
+    browser.tools["search"] = Tool(target=_bench_search, schema=_SEARCH_SCHEMA)
+    browser.attach_to_app(app, "/realtime")
+    acs = rtmtForAcs.RTMiddleTierForAcs(endpoint=endpoint, deployment="benchmark", credentials=credentials)
+    acs.tools["search"] = Tool(target=_bench_search, schema=_SEARCH_SCHEMA)
+    acs.attach_to_app(app, "/realtimeForAcs")
+    if trace_directory := os.environ.get("REALTIME_TRACE_DIR"):
+        browser.use_tracing(trace_directory)
+        acs.use_tracing(trace_directory)
+    return app
+
+def run_server(workers: int = 1, port: int = BENCH_PORT) -> None:
+    from serving import serve
+    serve(create_bench_app, "localhost", port, workers=workers)
+
+def wait_for_port(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("localhost", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"Nothing listening on port {port} after {timeout}s")
+
+def process_tree_usage(pid: int) -> Optional[tuple[float, int]]:
+    # CPU seconds and resident bytes of a process and all of its descendants, None off Linux
+    if not os.path.exists("/proc/self/stat"):
+        return None
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    parent = int(f.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(parent, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    cpu, rss = 0.0, 0
+    pending = [pid]
+    while len(pending) > 0:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+            rss += int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, IndexError, ValueError):
+            continue
+    return cpu, rss
+
+class CallerStats:
+    downstream_latencies: list[float]
+    sent: int
+    received: int
+    turns: int
+    errors: int
+    connect_latencies: list[float]
+
+    def __init__(self):
+        self.downstream_latencies = []
+        self.sent = 0
+        self.received = 0
+        self.turns = 0
+        self.errors = 0
+        self.connect_latencies = []
+
+async def _caller(session: aiohttp.ClientSession, url: str, acs: bool, duration: float, frame_ms: int, stats: CallerStats) -> None:
+    start = time.monotonic()
+    async with session.ws_connect(url) as ws:
+        stats.connect_latencies.append(time.monotonic() - start)
+
+        async def send():
+            if not acs:
+                # The browser client configures the session first, like the frontend does
+                await ws.send_str(json.dumps({"type": "session.update", "session": {"turn_detection": {"type": "server_vad"}}}))
+            deadline = time.monotonic() + duration
+            next_frame = time.monotonic()
+            while time.monotonic() < deadline:
+                audio = stamp_audio(48 * frame_ms)
+                if acs:
+                    await ws.send_str(json.dumps({"kind": "AudioData", "audioData": {"timestamp": "", "data": audio, "silent": False}}))
+                else:
+                    await ws.send_str(json.dumps({"type": "input_audio_buffer.append", "audio": audio}))
+                stats.sent += 1
+                # Keep real-time pace even when a send was slow
+                next_frame += frame_ms / 1000
+                await asyncio.sleep(max(next_frame - time.monotonic(), 0))
+            await ws.close()
+
+        async def receive():
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                message = json.loads(msg.data)
+                audio = None
+                if acs and message.get("Kind") == "AudioData":
+                    audio = message["AudioData"]["Data"]
+                elif not acs and message.get("type") == "response.audio.delta":
+                    audio = message["delta"]
+                elif message.get("type") == "response.done":
+                    stats.turns += 1
+                if audio is not None:
+                    stats.received += 1
+                    sent_at = audio_stamp(audio)
+                    if sent_at is not None:
+                        stats.downstream_latencies.append(time.monotonic() - sent_at)
+
+        await asyncio.gather(send(), receive())
+
+def _drive(url: str, acs: bool, sessions: int, ramp: float, duration: float, frame_ms: int, results: multiprocessing.Queue) -> None:
+    stats = CallerStats()
+
+    async def main():
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            async def caller(index: int):
+                await asyncio.sleep(ramp * index / max(sessions, 1))
+                try:
+                    await _caller(session, url, acs, duration, frame_ms, stats)
+                except Exception:
+                    stats.errors += 1
+            await asyncio.gather(*(caller(i) for i in range(sessions)))
+
+    asyncio.run(main())
+    results.put(stats)
+
+def main(url: Optional[str], path: str, sessions: int, ramp: float, duration: float, frame_ms: int, drivers: int,
+         workers: int, pid: Optional[int], timing: MockTiming):
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    if url is None:
+        mock = context.Process(target=run, args=("localhost", MOCK_PORT, timing), daemon=True)
+        mock.start()
+        processes.append(mock)
+        wait_for_port(MOCK_PORT)
+        server = context.Process(target=run_server, args=(workers,))
+        server.start()
+        processes.append(server)
+        wait_for_port(BENCH_PORT)
+        url = f"http://localhost:{BENCH_PORT}"
+        pid = server.pid
+
+    try:
+        before = process_tree_usage(pid) if pid is not None else None
+        peak_rss = before[1] if before is not None else 0
+        results = context.Queue()
+        per_driver = [sessions // drivers + (1 if i < sessions % drivers else 0) for i in range(drivers)]
+        driver_processes = [context.Process(target=_drive, args=(url + path, path == "/realtimeForAcs", n, ramp, duration, frame_ms, results))
+                            for n in per_driver if n > 0]
+        started = time.monotonic()
+        for process in driver_processes:
+            process.start()
+
+        stats = CallerStats()
+        collected = 0
+        while collected < len(driver_processes):
+            try:
+                driver_stats = results.get(timeout=1)
+            except Exception:
+                driver_stats = None
+            if driver_stats is not None:
+                collected += 1
+                stats.downstream_latencies.extend(driver_stats.downstream_latencies)
+                stats.connect_latencies.extend(driver_stats.connect_latencies)
+                stats.sent += driver_stats.sent
+                stats.received += driver_stats.received
+                stats.turns += driver_stats.turns
+                stats.errors += driver_stats.errors
+            if pid is not None:
+                usage = process_tree_usage(pid)
+                if usage is not None:
+                    peak_rss = max(peak_rss, usage[1])
+        elapsed = time.monotonic() - started
+        after = process_tree_usage(pid) if pid is not None else None
+        for process in driver_processes:
+            process.join()
+
+        mock_stats = None
+        if processes:
+            async def fetch_stats():
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(f"http://localhost:{MOCK_PORT}/stats") as response:
+                        return await response.json()
+            mock_stats = asyncio.run(fetch_stats())
+    finally:
+        for process in reversed(processes):
+            os.kill(process.pid, signal.SIGTERM)
+            process.join()
+
+    downstream = percentiles(stats.downstream_latencies)
+    connect = percentiles(stats.connect_latencies)
+    print(f"Sessions:              {sessions} on {path} ({stats.errors} failed), {len(driver_processes)} driver process(es)")
+    print(f"Throughput:            {stats.sent / elapsed:,.0f} frames/s to the backend, {stats.received / elapsed:,.0f} audio frames/s back, {stats.turns} turns")
+    print(f"Connect:               p50 {connect['p50'] * 1000:.1f} ms, p99 {connect['p99'] * 1000:.1f} ms")
+    print(f"Added latency to caller: p50 {downstream['p50'] * 1000:.2f} ms, p99 {downstream['p99'] * 1000:.2f} ms")
+    if mock_stats is not None:
+        upstream = mock_stats["upstream_latency"]
+        print(f"Added latency to model:  p50 {upstream['p50'] * 1000:.2f} ms, p99 {upstream['p99'] * 1000:.2f} ms")
+        print(f"Tool outputs:          {mock_stats['tool_outputs']}, response.create {mock_stats['response_creates']}")
+    if before is not None and after is not None:
+        cpu_ms_per_session_second = (after[0] - before[0]) / (sessions * duration) * 1000
+        rss_per_session = (peak_rss - before[1]) / sessions
+        print(f"Backend CPU:           {after[0] - before[0]:.1f} s total, {cpu_ms_per_session_second:.2f} ms per session-second")
+        print(f"Backend RSS:           {before[1] / 1024 / 1024:.0f} MB idle, {peak_rss / 1024 / 1024:.0f} MB peak, {rss_per_session / 1024:.0f} KB per session")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the middle tiers against a mock realtime endpoint")
+    parser.add_argument("--path", default="/realtime", choices=["/realtime", "/realtimeForAcs"])
+    parser.add_argument("--sessions", type=int, default=1000, help="Simulated callers")
+    parser.add_argument("--ramp", type=float, default=10.0, help="Seconds over which callers connect")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds each caller streams audio")
+    parser.add_argument("--frame-ms", type=int, help="Audio per frame the callers send, default 100 for browsers and 20 for ACS")
+    parser.add_argument("--drivers", type=int, default=max((os.cpu_count() or 2) // 2, 1), help="Processes simulating the callers")
+    parser.add_argument("--workers", type=int, default=1, help="Backend worker processes")
+    parser.add_argument("--url", help="Load test an already running backend instead, e.g. http://localhost:8765")
+    parser.add_argument("--pid", type=int, help="Process id of that backend, to report its CPU and memory")
+    parser.add_argument("--speech-seconds", type=float, default=3.0, help="Caller speech per turn")
+    parser.add_argument("--first-audio-delay", type=float, default=0.3, help="Mock's seconds from end of speech to first audio")
+    parser.add_argument("--response-frames", type=int, default=20, help="Audio deltas per answer")
+    parser.add_argument("--tool-every", type=int, default=2, help="Call the search tool every Nth turn, 0 never does")
+    args = parser.parse_args()
+    frame_ms = args.frame_ms or (20 if args.path == "/realtimeForAcs" else 100)
+    timing = MockTiming(speech_frames=max(int(args.speech_seconds * 1000 / frame_ms), 1), first_audio_delay=args.first_audio_delay,
+                        response_frames=args.response_frames, tool_every=args.tool_every)
+    main(args.url, args.path, args.sessions, args.ramp, args.duration, frame_ms, args.drivers, args.workers, args.pid, timing)
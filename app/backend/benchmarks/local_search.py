@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import glob
+import os
+import statistics
+import tempfile
+import time
+
+from embeddings import HashingEmbedder
+from localsearch import LocalSearchIndex, build_index, read_manifest
+
+# Measures how long LocalSearchIndex takes to answer queries, by stage: embedding the query, the BM25
+# ranking, the vector ranking and fusing them. Runs entirely offline with the hashing embedder.
+#
+# Run from app/backend:  python -m benchmarks.local_search [--index directory] [--queries queries.txt]
+#
+# Without an index one is built from the markdown files in the repo. Queries are read one per line,
+# without a file a few questions about the sample data are used.
+
+_QUERIES = [
+    "What does Contoso Electronics make?",
+    "Who founded Contoso Electronics and when?",
+    "What are the company's core values?",
+    "How do I set up the search index?",
+    "Which environment variables does the app need?",
+    "How do phone calls reach the backend?",
+]
+
+def _percentiles(samples: list[float]) -> str:
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return f"{statistics.median(samples) * 1000:>10.3f}{p95 * 1000:>10.3f}"
+
+async def main(directory: str, queries: list[str], rounds: int):
+    manifest = read_manifest(directory)
+    if manifest["embedder"] != "hashing":
+        raise SystemExit(f"{directory} was embedded with {manifest['embedder']}, the benchmark only runs offline with the hashing embedder")
+    start = time.perf_counter()
+    index = LocalSearchIndex(directory, HashingEmbedder(manifest["dimensions"]))
+    print(f"{len(index)} chunks loaded in {(time.perf_counter() - start) * 1000:.1f} ms, {len(queries)} queries x {rounds} rounds")
+    stages: dict[str, list[float]] = {"embed": [], "bm25": [], "vector": [], "fuse": [], "total": []}
+    for _ in range(rounds):
+        for query in queries:
+            started = time.perf_counter()
+            vector = (await index.embedder.embed([query]))[0]
+            embedded = time.perf_counter()
+            keyword = index.keyword_ranking(query)
+            ranked = time.perf_counter()
+            similar = index.vector_ranking(vector)
+            searched = time.perf_counter()
+            index.fuse(keyword, similar)
+            fused = time.perf_counter()
+            stages["embed"].append(embedded - started)
+            stages["bm25"].append(ranked - embedded)
+            stages["vector"].append(searched - ranked)
+            stages["fuse"].append(fused - searched)
+            stages["total"].append(fused - started)
+    print(f"{'stage':<8}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, samples in stages.items():
+        print(f"{stage:<8}{_percentiles(samples)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query latency of the in-process search index")
+    parser.add_argument("--index", help="Index directory built with python -m localsearch build")
+    parser.add_argument("--queries", help="Text file with one query per line")
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+    queries = _QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    if args.index:
+        asyncio.run(main(args.index, queries, args.rounds))
+    else:
+        repository = os.path.join(os.path.dirname(__file__), "..", "..", "..")
+        files = glob.glob(os.path.join(repository, "data", "*.md")) + glob.glob(os.path.join(repository, "docs", "*.md")) + glob.glob(os.path.join(repository, "*.md"))
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(build_index(directory, files, "hashing", 1000))
+            asyncio.run(main(directory, queries, args.rounds))
@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import base64
+import json
+import statistics
+import struct
+import time
+from typing import Optional
+
+from aiohttp import WSMsgType, web
+
+# Local stand-in for the Azure OpenAI /openai/realtime endpoint, so the middle tiers can be
+# load tested without using any quota.
+#
+# In echo mode (speech_frames=0) every input_audio_buffer.append is answered with a
+# response.audio.delta carrying the same audio. Otherwise the mock plays a conversation: after
+# speech_frames appends it reports the end of the caller's speech, optionally calls the "search"
+# tool and waits for its output and response.create, and then streams an answer of response_frames
+# audio deltas followed by response.done, with the timing below.
+#
+# Audio frames carry a timestamp (time.monotonic, which all processes on a machine share) in their
+# first 8 bytes: the mock stamps the audio it sends, and measures how long appends stamped by the
+# load test took to get through the middle tier. Those numbers are served at /stats.
+#
+# Run from app/backend:  python -m benchmarks.mock_realtime [--port 8766] [--speech-frames 100 ...]
+
+class MockTiming:
+    speech_frames: int
+    first_audio_delay: float
+    response_frames: int
+    audio_interval: float
+    audio_ms: int
+    tool_every: int
+    tool_arguments_delay: float
+
+    def __init__(self,
+                 speech_frames: int = 0,
+                 first_audio_delay: float = 0.3,
+                 response_frames: int = 20,
+                 audio_interval: float = 0.05,
+                 audio_ms: int = 100,
+                 tool_every: int = 0,
+                 tool_arguments_delay: float = 0.1):
+        self.speech_frames = speech_frames
+        self.first_audio_delay = first_audio_delay
+        self.response_frames = response_frames
+        self.audio_interval = audio_interval
+        self.audio_ms = audio_ms
+        self.tool_every = tool_every
+        self.tool_arguments_delay = tool_arguments_delay
+
+def stamp_audio(pcm_bytes: int) -> str:
+    return base64.b64encode(struct.pack("d", time.monotonic()) + bytes(max(pcm_bytes - 8, 0))).decode("ascii")
+
+def audio_stamp(audio: str) -> Optional[float]:
+    try:
+        return struct.unpack("d", base64.b64decode(audio[:12])[:8])[0]
+    except Exception:
+        return None
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if len(values) == 0:
+        return {"count": 0, "p50": float("nan"), "p99": float("nan")}
+    if len(values) == 1:
+        return {"count": 1, "p50": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"count": len(values), "p50": cuts[49], "p99": cuts[98]}
+
+def _event(type: str, **fields) -> str:
+    return json.dumps({"type": type, "event_id": f"event_{time.monotonic_ns()}", **fields})
+
+class MockRealtimeServer:
+    timing: MockTiming
+    upstream_latencies: list[float]
+    sessions: int
+    tool_outputs: int
+    response_creates: int
+
+    def __init__(self, timing: MockTiming):
+        self.timing = timing
+        self.upstream_latencies = []
+        self.sessions = 0
+        self.tool_outputs = 0
+        self.response_creates = 0
+
+    async def _realtime(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sessions += 1
+        await ws.send_str(_event("session.created", session={
+            "id": f"sess_{self.sessions}", "object": "realtime.session", "model": "mock", "modalities": ["audio", "text"],
+            "instructions": "", "voice": "alloy", "input_audio_format": "pcm16", "output_audio_format": "pcm16",
+            "turn_detection": {"type": "server_vad"}, "tools": [], "tool_choice": "auto", "temperature": 0.8,
+            "max_response_output_tokens": "inf"}))
+
+        heard = 0
+        turns = 0
+        responding: Optional[asyncio.Task] = None
+        response_create = asyncio.Event()
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                message = json.loads(msg.data)
+                message_type = message["type"]
+                if message_type == "input_audio_buffer.append":
+                    sent_at = audio_stamp(message["audio"])
+                    if sent_at is not None:
+                        self.upstream_latencies.append(time.monotonic() - sent_at)
+                    if self.timing.speech_frames == 0:
+                        await ws.send_str(_event("response.audio.delta", response_id="resp_echo", item_id="item_echo",
+                                                 output_index=0, content_index=0, delta=message["audio"]))
+                        continue
+                    heard += 1
+                    if heard == 1:
+                        await ws.send_str(_event("input_audio_buffer.speech_started", audio_start_ms=0, item_id=f"item_in_{turns}"))
+                    # The caller keeps talking (or sending silence) while the answer plays, like a real call
+                    if heard >= self.timing.speech_frames and (responding is None or responding.done()):
+                        heard = 0
+                        turns += 1
+                        response_create.clear()
+                        responding = asyncio.create_task(self._respond(ws, turns, response_create))
+                elif message_type == "session.update":
+                    await ws.send_str(_event("session.updated", session=message.get("session", {})))
+                elif message_type == "conversation.item.create":
+                    self.tool_outputs += 1
+                elif message_type == "response.create":
+                    self.response_creates += 1
+                    response_create.set()
+        finally:
+            if responding is not None:
+                responding.cancel()
+        return ws
+
+    async def _respond(self, ws: web.WebSocketResponse, turn: int, response_create: asyncio.Event) -> None:
+        timing = self.timing
+        await ws.send_str(_event("input_audio_buffer.speech_stopped", audio_end_ms=0, item_id=f"item_in_{turn}"))
+        await ws.send_str(_event("input_audio_buffer.committed", previous_item_id=None, item_id=f"item_in_{turn}"))
+        if timing.tool_every > 0 and turn % timing.tool_every == 0:
+            response_id = f"resp_tool_{turn}"
+            item = {"id": f"item_tool_{turn}", "type": "function_call", "status": "completed", "name": "search",
+                    "call_id": f"call_{turn}", "arguments": json.dumps({"query": f"question {turn}"})}
+            await ws.send_str(_event("response.created", response={"id": response_id, "status": "in_progress", "output": []}))
+            await ws.send_str(_event("response.output_item.added", response_id=response_id, output_index=0, item={**item, "arguments": ""}))
+            await ws.send_str(_event("conversation.item.created", previous_item_id=f"item_in_{turn}", item={**item, "arguments": ""}))
+            await asyncio.sleep(timing.tool_arguments_delay)
+            await ws.send_str(_event("response.function_call_arguments.delta", response_id=response_id, item_id=item["id"],
+                                     output_index=0, call_id=item["call_id"], delta=item["arguments"]))
+            await ws.send_str(_event("response.function_call_arguments.done", response_id=response_id, item_id=item["id"],
+                                     output_index=0, call_id=item["call_id"], arguments=item["arguments"]))
+            await ws.send_str(_event("response.output_item.done", response_id=response_id, output_index=0, item=item))
+            await ws.send_str(_event("response.done", response={"id": response_id, "status": "completed", "status_details": None, "output": [item]}))
+            await response_create.wait()
+
+        response_id = f"resp_{turn}"
+        item_id = f"item_out_{turn}"
+        await ws.send_str(_event("response.created", response={"id": response_id, "status": "in_progress", "output": []}))
+        await asyncio.sleep(timing.first_audio_delay)
+        for _ in range(timing.response_frames):
+            await ws.send_str(_event("response.audio.delta", response_id=response_id, item_id=item_id, output_index=0,
+                                     content_index=0, delta=stamp_audio(48 * timing.audio_ms)))
+            await asyncio.sleep(timing.audio_interval)
+        await ws.send_str(_event("response.audio_transcript.done", response_id=response_id, item_id=item_id, output_index=0,
+                                 content_index=0, transcript="Here's the answer to your question."))
+        await ws.send_str(_event("response.done", response={"id": response_id, "status": "completed", "status_details": None,
+                                                            "output": [{"id": item_id, "type": "message", "role": "assistant"}]}))
+
+    async def _stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "sessions": self.sessions,
+            "tool_outputs": self.tool_outputs,
+            "response_creates": self.response_creates,
+            "upstream_latency": percentiles(self.upstream_latencies)
+        })
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/openai/realtime", self._realtime)
+        app.router.add_get("/stats", self._stats)
+        return app
+
+def create_mock_app(timing: Optional[MockTiming] = None) -> web.Application:
+    return MockRealtimeServer(timing or MockTiming()).create_app()
+
+def run(host: str = "localhost", port: int = 8766, timing: Optional[MockTiming] = None) -> None:
+    web.run_app(create_mock_app(timing), host=host, port=port, print=None)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Azure OpenAI realtime endpoint")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--speech-frames", type=int, default=0, help="Appends per caller turn, 0 echoes every append back")
+    parser.add_argument("--first-audio-delay", type=float, default=0.3, help="Seconds from end of speech to the first audio delta")
+    parser.add_argument("--response-frames", type=int, default=20, help="Audio deltas per answer")
+    parser.add_argument("--audio-interval", type=float, default=0.05, help="Seconds between audio deltas")
+    parser.add_argument("--audio-ms", type=int, default=100, help="Audio per delta")
+    parser.add_argument("--tool-every", type=int, default=0, help="Call the search tool every Nth turn, 0 never does")
+    args = parser.parse_args()
+    run(args.host, args.port, MockTiming(args.speech_frames, args.first_audio_delay, args.response_frames,
+                                         args.audio_interval, args.audio_ms, args.tool_every))
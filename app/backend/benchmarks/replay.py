@@ -0,0 +1,220 @@
+import argparse
+import asyncio
+import glob
+import json
+import multiprocessing
+import os
+import signal
+import time
+
+import aiohttp
+from aiohttp import WSMsgType, web
+from azure.core.credentials import AzureKeyCredential
+
+from benchmarks.loadtest import BENCH_PORT, process_tree_usage, wait_for_port
+from rtrouter import sniff_field
+from rttrace import TOOL_CALL, TOOL_RESULT, TraceRecord, read_trace
+
+# Replays recorded sessions (see REALTIME_TRACE_DIR in docs/performance_tuning.md) through the
+# middle tiers. The recorded client frames are sent to the backend by a simulated caller and the
+# recorded realtime API frames are played back by a stand-in upstream, either at the original pace
+# or as fast as the backend takes them. Tools return their recorded results, so a replay needs
+# neither Azure OpenAI nor Azure AI Search and the same traces give the same work every time.
+#
+# Run from app/backend:  python -m benchmarks.replay traces/*.rttrace [--speed max] [--copies 10]
+
+REPLAY_PORT = 8767
+
+class _Trace:
+    path: str
+    header: dict
+    records: list[TraceRecord]
+    duration: float
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header, self.records = read_trace(path)
+        self.duration = self.records[-1].offset if len(self.records) > 0 else 0.0
+
+def _normalize(args) -> str:
+    return json.dumps(args, sort_keys=True)
+
+def _recorded_tools(paths: list[str]) -> dict[tuple[str, str], dict]:
+    # (tool name, arguments) -> recorded result, for every tool call in the traces
+    results = {}
+    for path in paths:
+        _, records = read_trace(path)
+        calls = {}
+        for record in records:
+            if record.kind == TOOL_CALL:
+                calls[record.data["call_id"]] = record.data
+            elif record.kind == TOOL_RESULT and record.data["call_id"] in calls:
+                call = calls[record.data["call_id"]]
+                results[(call["name"], _normalize(json.loads(call["arguments"])))] = record.data
+    return results
+
+async def create_replay_app() -> web.Application:
+    # The real middle tiers, pointed at the replaying upstream, with tools that answer from the traces
+    import rtmt
+    import rtmtForAcs
+
+    recorded = _recorded_tools(os.environ["REPLAY_TRACES"].split(os.pathsep))
+    app = web.Application()
+    credentials = AzureKeyCredential("replay")
+    endpoint = f"http://localhost:{REPLAY_PORT}"
+    for module, tier_class, path in ((rtmt, rtmt.RTMiddleTier, "/realtime"), (rtmtForAcs, rtmtForAcs.RTMiddleTierForAcs, "/realtimeForAcs")):
+        middle_tier = tier_class(endpoint=endpoint, deployment="replay", credentials=credentials)
+        for name in {name for name, _ in recorded}:
+            def make_target(name, module):
+                async def target(args):
+                    result = recorded.get((name, _normalize(args)))
+                    if result is None:
+                        return module.ToolResult({"error": "no recorded result"}, module.ToolResultDirection.TO_SERVER)
+                    direction = module.ToolResultDirection.TO_CLIENT if result["to_client"] else module.ToolResultDirection.TO_SERVER
+                    return module.ToolResult(result["output"], direction)
+                return target
+            middle_tier.tools[name] = module.Tool(target=make_target(name, module), schema={"type": "function", "name": name})
+        middle_tier.attach_to_app(app, path)
+    return app
+
+def _run_replay_server() -> None:
+    from serving import serve
+    serve(create_replay_app, "localhost", BENCH_PORT)
+
+async def _pace(started: float, offset: float, speed: float) -> None:
+    if speed > 0:
+        delay = started + offset / speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class _Replayer:
+    speed: float
+    traces: dict[str, _Trace]
+    upstream_done: dict[str, asyncio.Event]
+    frames_to_client: int
+    frames_to_server: int
+    delivered: int
+
+    def __init__(self, traces: dict[str, _Trace], speed: float):
+        self.traces = traces
+        self.speed = speed
+        self.upstream_done = {}
+        self.frames_to_client = 0
+        self.frames_to_server = 0
+        self.delivered = 0
+
+    async def upstream(self, request: web.Request) -> web.WebSocketResponse:
+        # The middle tier passes the caller's x-ms-client-request-id on, which says which trace to play
+        replay_id = request.headers["x-ms-client-request-id"]
+        trace = self.traces[replay_id.rsplit("/", 1)[0]]
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        response_create = asyncio.Event()
+
+        async def receive():
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT and sniff_field(msg.data) == "response.create":
+                    response_create.set()
+        receiving = asyncio.create_task(receive())
+
+        started = time.monotonic()
+        try:
+            for record in trace.records:
+                if not record.from_server:
+                    continue
+                await _pace(started, record.offset, self.speed)
+                await ws.send_str(record.data)
+                self.frames_to_client += 1
+                # Like the real API, nothing more happens after a tool call until the middle tier
+                # has sent the tool output and asked for a new response
+                if sniff_field(record.data) == "response.done" and any(
+                        output.get("type") == "function_call" for output in json.loads(record.data).get("response", {}).get("output", [])):
+                    try:
+                        await asyncio.wait_for(response_create.wait(), timeout=30)
+                    except asyncio.TimeoutError:
+                        break
+                    response_create.clear()
+            self.upstream_done[replay_id].set()
+            # The recorded session ended when the caller hung up, so leave that to the caller
+            await asyncio.wait_for(receiving, timeout=30)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.upstream_done[replay_id].set()
+            await ws.close()
+            receiving.cancel()
+        return ws
+
+    async def caller(self, session: aiohttp.ClientSession, replay_id: str) -> None:
+        trace = self.traces[replay_id.rsplit("/", 1)[0]]
+        self.upstream_done[replay_id] = asyncio.Event()
+        url = f"http://localhost:{BENCH_PORT}{trace.header['path']}"
+        async with session.ws_connect(url, headers={"x-ms-client-request-id": replay_id}) as ws:
+            async def receive():
+                async for msg in ws:
+                    if msg.type == WSMsgType.TEXT:
+                        self.delivered += 1
+            receiving = asyncio.create_task(receive())
+
+            started = time.monotonic()
+            for record in trace.records:
+                if not record.from_client:
+                    continue
+                await _pace(started, record.offset, self.speed)
+                await ws.send_str(record.data)
+                self.frames_to_server += 1
+            await self.upstream_done[replay_id].wait()
+            # Let the last frames through before hanging up
+            await asyncio.sleep(0.2)
+            await ws.close()
+            receiving.cancel()
+
+async def _replay(traces: dict[str, _Trace], speed: float, copies: int) -> tuple[_Replayer, float]:
+    replayer = _Replayer(traces, speed)
+    app = web.Application()
+    app.router.add_get("/openai/realtime", replayer.upstream)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", REPLAY_PORT).start()
+    try:
+        started = time.monotonic()
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            await asyncio.gather(*(replayer.caller(session, f"{key}/{copy}") for key in traces for copy in range(copies)))
+        return replayer, time.monotonic() - started
+    finally:
+        await runner.cleanup()
+
+def main(paths: list[str], speed: float, copies: int):
+    traces = {str(i): _Trace(path) for i, path in enumerate(paths)}
+    recorded_seconds = sum(trace.duration for trace in traces.values()) * copies
+    os.environ["REPLAY_TRACES"] = os.pathsep.join(paths)
+    context = multiprocessing.get_context("spawn")
+    server = context.Process(target=_run_replay_server)
+    server.start()
+    try:
+        wait_for_port(BENCH_PORT)
+        before = process_tree_usage(server.pid)
+        replayer, elapsed = asyncio.run(_replay(traces, speed, copies))
+        after = process_tree_usage(server.pid)
+    finally:
+        os.kill(server.pid, signal.SIGTERM)
+        server.join()
+
+    sessions = len(traces) * copies
+    frames = replayer.frames_to_client + replayer.frames_to_server
+    print(f"Replayed {sessions} session(s), {recorded_seconds:.1f} session-seconds of recorded traffic, in {elapsed:.1f}s")
+    print(f"Frames:       {replayer.frames_to_server} from callers, {replayer.frames_to_client} from the realtime API, "
+          f"{replayer.delivered} delivered to callers, {frames / elapsed:,.0f} frames/s")
+    if before is not None and after is not None:
+        cpu = after[0] - before[0]
+        print(f"Backend CPU:  {cpu:.2f}s, {cpu / max(recorded_seconds, 1e-9) * 1000:.2f} ms per recorded session-second, "
+              f"{cpu / max(frames, 1) * 1_000_000:.1f} us per frame")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded realtime sessions through the middle tiers")
+    parser.add_argument("traces", nargs="+", help="Trace files or glob patterns")
+    parser.add_argument("--speed", default="1", help="Playback speed: 1 for the recorded pace, 2 for twice as fast, max for no pauses")
+    parser.add_argument("--copies", type=int, default=1, help="Concurrent replays of each trace")
+    args = parser.parse_args()
+    paths = sorted(path for pattern in args.traces for path in (glob.glob(pattern) or [pattern]))
+    main(paths, 0 if args.speed == "max" else float(args.speed), args.copies)
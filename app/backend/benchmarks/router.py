@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+
+from aiohttp import WSMessage, WSMsgType
+from azure.core.credentials import AzureKeyCredential
+
+from rtmt import RTMiddleTier
+from rtmtForAcs import RTMiddleTierForAcs
+from rtsession import RTSession
+
+# Compares the per-frame cost of the message routing in the middle tiers against the previous
+# behaviour of fully decoding (and for ACS, re-encoding) every frame.
+#
+# Run from app/backend:  python -m benchmarks.router [--frames 20000]
+
+# Typical frame rates for one call: the realtime API streams ~10 audio deltas per second of speech,
+# browsers send ~10 appends per second and ACS sends a frame every 20ms
+FRAMES_PER_CALL_SECOND = {
+    "browser: response.audio.delta": 10,
+    "browser: input_audio_buffer.append": 10,
+    "acs: response.audio.delta": 10,
+    "acs: AudioData": 50,
+}
+
+def _audio(ms: int) -> str:
+    # PCM16 mono at 24kHz
+    return base64.b64encode(os.urandom(48 * ms)).decode("ascii")
+
+def _frames() -> dict[str, str]:
+    return {
+        "browser: response.audio.delta": json.dumps({"type": "response.audio.delta", "event_id": "event_123", "response_id": "resp_123", "item_id": "item_123",
+                                                     "output_index": 0, "content_index": 0, "delta": _audio(100)}),
+        "browser: input_audio_buffer.append": json.dumps({"type": "input_audio_buffer.append", "audio": _audio(100)}),
+        "acs: response.audio.delta": json.dumps({"type": "response.audio.delta", "event_id": "event_123", "response_id": "resp_123", "item_id": "item_123",
+                                                 "output_index": 0, "content_index": 0, "delta": _audio(100)}),
+        "acs: AudioData": json.dumps({"kind": "AudioData", "audioData": {"timestamp": "2025-02-04T19:57:56.745Z", "participantRawID": "8:acs:123",
+                                                                          "data": _audio(20), "silent": False}}),
+    }
+
+def _legacy(name: str, data: str):
+    # What every frame used to cost before the router: a full json.loads, plus json.dumps for ACS audio
+    message = json.loads(data)
+    if name == "acs: response.audio.delta":
+        return json.dumps({"Kind": "AudioData", "AudioData": {"Data": message["delta"]}, "StopAudio": None})
+    if name == "acs: AudioData":
+        return json.dumps({"type": "input_audio_buffer.append", "audio": message["audioData"]["data"]})
+    return data
+
+async def _current(name: str, data: str, rtmt: RTMiddleTier, rtmt_acs: RTMiddleTierForAcs):
+    msg = WSMessage(WSMsgType.TEXT, data, None)
+    if name == "browser: response.audio.delta":
+        return await rtmt._process_message_to_client(rtmt._bench_session, msg, None, None)
+    if name == "browser: input_audio_buffer.append":
+        return await rtmt._process_message_to_server(rtmt._bench_session, msg, None)
+    if name == "acs: response.audio.delta":
+        return await rtmt_acs._process_message_to_client(rtmt_acs._bench_session, msg, None, None)
+    return await rtmt_acs._process_message_to_server(rtmt_acs._bench_session, msg, None)
+
+async def _measure(frames: int, run) -> tuple[float, float]:
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(frames):
+        await run()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+async def main(frames: int):
+    credentials = AzureKeyCredential("benchmark")
+    rtmt = RTMiddleTier(endpoint="http://localhost", deployment="benchmark", credentials=credentials)
+    rtmt_acs = RTMiddleTierForAcs(endpoint="http://localhost", deployment="benchmark", credentials=credentials)
+    rtmt._bench_session = RTSession(None, rtmt._session_config())
+    rtmt_acs._bench_session = RTSession(None, rtmt_acs._session_config())
+
+    print(f"{'frame':<38}{'before fps':>12}{'after fps':>12}{'before cpu/call-s':>20}{'after cpu/call-s':>19}")
+    for name, data in _frames().items():
+        async def before():
+            return _legacy(name, data)
+        async def after():
+            return await _current(name, data, rtmt, rtmt_acs)
+
+        results = []
+        for run in (before, after):
+            wall, cpu = await _measure(frames, run)
+            cpu_per_call_second_ms = cpu / frames * FRAMES_PER_CALL_SECOND[name] * 1000
+            results.append((frames / wall, cpu_per_call_second_ms))
+        (before_fps, before_cpu), (after_fps, after_cpu) = results
+        print(f"{name:<38}{before_fps:>12,.0f}{after_fps:>12,.0f}{before_cpu:>17.3f} ms{after_cpu:>16.3f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmark for the realtime message router")
+    parser.add_argument("--frames", type=int, default=20000, help="Frames to push through each path")
+    args = parser.parse_args()
+    asyncio.run(main(args.frames))
@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+
+import aiohttp
+
+from benchmarks.loadtest import BENCH_PORT, MOCK_PORT, run_server, wait_for_port
+from benchmarks.mock_realtime import (
+    MockTiming,
+    audio_stamp,
+    percentiles,
+    run,
+    stamp_audio,
+)
+
+# Load test showing how many concurrent calls one replica can carry as the number of worker
+# processes grows. The backend runs through serving.serve, exactly like app.py does, against the
+# mock realtime endpoint, and every simulated call streams audio at real-time pace. The latency
+# reported is the round trip of an audio frame: client -> middle tier -> mock -> middle tier -> client.
+#
+# Run from app/backend:  python -m benchmarks.scaling --workers 1,2,4 --calls 50,100,200,400
+#
+# A worker count is keeping up with a number of calls while the p99 round trip stays under --budget-ms.
+# Run the drivers on a different machine (or give this one enough cores) or they'll be the bottleneck.
+
+async def _call(url: str, acs: bool, duration: float, frame_ms: int, latencies: list[float], counts: dict[str, int]) -> None:
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(url) as ws:
+            async def send():
+                deadline = time.monotonic() + duration
+                while time.monotonic() < deadline:
+                    audio = stamp_audio(48 * frame_ms)
+                    if acs:
+                        await ws.send_str(json.dumps({"kind": "AudioData", "audioData": {"data": audio, "silent": False}}))
+                    else:
+                        await ws.send_str(json.dumps({"type": "input_audio_buffer.append", "audio": audio}))
+                    counts["sent"] += 1
+                    await asyncio.sleep(frame_ms / 1000)
+                # Leave time for the last echoes to come back
+                await asyncio.sleep(1)
+                await ws.close()
+
+            async def receive():
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    message = json.loads(msg.data)
+                    if acs and message.get("Kind") == "AudioData":
+                        audio = message["AudioData"]["Data"]
+                    elif not acs and message.get("type") == "response.audio.delta":
+                        audio = message["delta"]
+                    else:
+                        continue
+                    latencies.append(time.monotonic() - audio_stamp(audio))
+                    counts["received"] += 1
+
+            await asyncio.gather(send(), receive())
+
+def _drive(url: str, acs: bool, calls: int, duration: float, frame_ms: int, results: multiprocessing.Queue) -> None:
+    latencies: list[float] = []
+    counts = {"sent": 0, "received": 0, "errors": 0}
+
+    async def main():
+        async def call(index: int):
+            # Spread the connects over the first second like real traffic would
+            await asyncio.sleep(index / max(calls, 1))
+            try:
+                await _call(url, acs, duration, frame_ms, latencies, counts)
+            except Exception:
+                counts["errors"] += 1
+        await asyncio.gather(*(call(i) for i in range(calls)))
+
+    asyncio.run(main())
+    results.put((latencies, counts))
+
+def main(workers_list: list[int], calls_list: list[int], path: str, duration: float, frame_ms: int, drivers: int, budget_ms: float):
+    context = multiprocessing.get_context("spawn")
+    # The mock echoes every frame straight back
+    mock = context.Process(target=run, args=("localhost", MOCK_PORT, MockTiming(speech_frames=0)), daemon=True)
+    mock.start()
+    wait_for_port(MOCK_PORT)
+    url = f"http://localhost:{BENCH_PORT}{path}"
+    acs = path == "/realtimeForAcs"
+
+    capacity = {}
+    print(f"{'workers':>8}{'calls':>8}{'frames/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}  within budget")
+    for workers in workers_list:
+        server = context.Process(target=run_server, args=(workers,))
+        server.start()
+        wait_for_port(BENCH_PORT)
+        try:
+            for calls in calls_list:
+                results = context.Queue()
+                per_driver = [calls // drivers + (1 if i < calls % drivers else 0) for i in range(drivers)]
+                processes = [context.Process(target=_drive, args=(url, acs, n, duration, frame_ms, results)) for n in per_driver if n > 0]
+                for process in processes:
+                    process.start()
+                latencies, received, errors = [], 0, 0
+                for _ in processes:
+                    driver_latencies, counts = results.get()
+                    latencies.extend(driver_latencies)
+                    received += counts["received"]
+                    errors += counts["errors"]
+                for process in processes:
+                    process.join()
+
+                latency = percentiles(latencies)
+                p50, p99 = latency["p50"] * 1000, latency["p99"] * 1000
+                ok = errors == 0 and p99 <= budget_ms
+                if ok:
+                    capacity[workers] = calls
+                print(f"{workers:>8}{calls:>8}{received / duration:>12,.0f}{p50:>10.1f}{p99:>10.1f}{errors:>8}  {'yes' if ok else 'no'}")
+        finally:
+            os.kill(server.pid, signal.SIGTERM)
+            server.join()
+    mock.terminate()
+
+    print()
+    for workers in workers_list:
+        print(f"{workers} worker(s): {capacity.get(workers, 0)} concurrent calls within a {budget_ms:.0f}ms p99 round trip")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent calls per replica by worker count")
+    parser.add_argument("--workers", default="1,2,4", help="Comma separated worker counts to try")
+    parser.add_argument("--calls", default="50,100,200,400", help="Comma separated numbers of concurrent calls to try")
+    parser.add_argument("--path", default="/realtimeForAcs", choices=["/realtime", "/realtimeForAcs"])
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds each call streams audio")
+    parser.add_argument("--frame-ms", type=int, default=20, help="Audio per frame, ACS sends 20ms frames")
+    parser.add_argument("--drivers", type=int, default=2, help="Processes simulating the calls")
+    parser.add_argument("--budget-ms", type=float, default=100.0, help="p99 round trip a worker count has to stay under")
+    args = parser.parse_args()
+    main([int(w) for w in args.workers.split(",")], [int(c) for c in args.calls.split(",")],
+         args.path, args.duration, args.frame_ms, args.drivers, args.budget_ms)
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import os
+import random
+import time
+from typing import Optional
+
+import numpy as np
+
+from embeddings import AzureOpenAIEmbedder, Embedder, HashingEmbedder
+from httpclient import client_sessions
+from searchcache import normalize_query
+from semanticcache import SemanticCache
+
+# Replays a log of knowledge base queries through the semantic cache at several similarity thresholds
+# and reports how many searches each one saves, how many of those were rephrasings (which the exact
+# search cache would have missed) and how many returned the results of a question that meant
+# something else.
+#
+# Run from app/backend:  python -m benchmarks.semantic_cache [--log queries.tsv] [--embedder hashing|azure]
+#
+# A log is a text file with one query per line, in the order they were asked. A line can start with a
+# label and a tab: queries with the same label ask the same thing, which is how wrong hits are counted.
+# Without a log a synthetic one is used. The azure embedder reads AZURE_OPENAI_ENDPOINT,
+# AZURE_OPENAI_EMBEDDING_DEPLOYMENT and AZURE_OPENAI_API_KEY.
+
+_PARAPHRASES = {
+    "pto": ["how many vacation days do I get", "how many vacation days do i have", "what is my vacation day allowance",
+            "how much vacation do I get per year", "how many days of vacation do I get"],
+    "deductible": ["what is the deductible", "what's my deductible", "how much is the deductible", "whats the deductible on my plan",
+                   "what is the deductible for the health plan"],
+    "dental": ["does my plan cover dental", "is dental covered", "does the plan cover dental care", "is dental care covered by my plan"],
+    "vision": ["does my plan cover vision", "is vision covered", "does the plan cover eye exams", "are glasses covered by my plan"],
+    "401k": ["what is the 401k match", "how much does the company match on the 401k", "does the company match 401k contributions"],
+    "remote": ["can I work from home", "can i work remotely", "what is the remote work policy", "how many days can I work from home"],
+    "sick": ["how many sick days do I get", "what is the sick leave policy", "how much sick leave do I have"],
+    "parental": ["how long is parental leave", "what is the parental leave policy", "how many weeks of parental leave do I get"],
+    "expenses": ["how do I submit an expense report", "how do i file expenses", "where do I submit expenses"],
+    "emergency": ["is the emergency room covered", "does my plan cover emergency room visits", "what does an emergency room visit cost"],
+}
+
+def _synthetic_log(queries: int = 2000, seed: int = 1) -> list[tuple[Optional[str], str]]:
+    generator = random.Random(seed)
+    labels = list(_PARAPHRASES)
+    # A few questions are asked far more often than the rest
+    weights = [1 / (rank + 1) for rank in range(len(labels))]
+    log = []
+    for _ in range(queries):
+        label = generator.choices(labels, weights)[0]
+        log.append((label, generator.choice(_PARAPHRASES[label])))
+    return log
+
+def _load_log(path: str) -> list[tuple[Optional[str], str]]:
+    log = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            label, tab, query = line.partition("\t")
+            log.append((label, query) if tab else (None, line))
+    return log
+
+class _PrecomputedEmbedder(Embedder):
+    # Embeds every query in the log once, so the thresholds are compared on lookups and not on embedding calls
+    def __init__(self, vectors: dict[str, np.ndarray], dimensions: int):
+        self.dimensions = dimensions
+        self._vectors = vectors
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        return np.stack([self._vectors[text] for text in texts])
+
+async def _precompute(embedder: Embedder, queries: list[str], batch_size: int = 64) -> _PrecomputedEmbedder:
+    vectors = {}
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        for query, vector in zip(batch, await embedder.embed(batch)):
+            vectors[query] = vector
+    return _PrecomputedEmbedder(vectors, embedder.dimensions)
+
+async def main(log: list[tuple[Optional[str], str]], embedder: Embedder, thresholds: list[float], max_entries: int):
+    unique = list(dict.fromkeys(query for _, query in log))
+    try:
+        embedder = await _precompute(embedder, unique)
+    finally:
+        await client_sessions().close()
+    labelled = all(label is not None for label, _ in log)
+    print(f"{len(log)} queries, {len(unique)} distinct, {max_entries} cache entries")
+    print(f"{'threshold':<11}{'hit rate':>10}{'rephrased':>11}{'wrong hits':>12}{'lookup us':>11}")
+    for threshold in thresholds:
+        cache = SemanticCache(embedder, threshold=threshold, max_entries=max_entries, ttl=float("inf"))
+        hits = rephrased = wrong = 0
+        seen: set[str] = set()
+        start = time.perf_counter()
+        for label, query in log:
+            searched = False
+
+            async def search():
+                nonlocal searched
+                searched = True
+                return label or query
+            result = await cache.get_or_search(query, "index", search)
+            normalized = normalize_query(query)
+            if not searched:
+                hits += 1
+                if normalized not in seen:
+                    rephrased += 1
+                if labelled and result != label:
+                    wrong += 1
+            seen.add(normalized)
+        lookup_us = (time.perf_counter() - start) / len(log) * 1_000_000
+        wrong_hits = f"{wrong / max(hits, 1):>12.1%}" if labelled else f"{'-':>12}"
+        print(f"{threshold:<11.3f}{hits / len(log):>10.1%}{rephrased / len(log):>11.1%}{wrong_hits}{lookup_us:>11.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hit rate of the semantic search cache by similarity threshold")
+    parser.add_argument("--log", help="Text file with one query per line, optionally prefixed by a label and a tab")
+    parser.add_argument("--embedder", choices=["hashing", "azure"], default="hashing")
+    parser.add_argument("--thresholds", default="0.7,0.75,0.8,0.85,0.9,0.95,0.99", help="Comma separated similarity thresholds")
+    parser.add_argument("--max-entries", type=int, default=2048)
+    args = parser.parse_args()
+    if args.embedder == "azure":
+        from azure.core.credentials import AzureKeyCredential
+        embedder = AzureOpenAIEmbedder(os.environ["AZURE_OPENAI_ENDPOINT"], os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"],
+                                       AzureKeyCredential(os.environ["AZURE_OPENAI_API_KEY"]),
+                                       dimensions=int(os.environ.get("AZURE_OPENAI_EMBEDDING_DIMENSIONS") or 3072))
+    else:
+        embedder = HashingEmbedder()
+    asyncio.run(main(_load_log(args.log) if args.log else _synthetic_log(), embedder,
+                     [float(t) for t in args.thresholds.split(",")], args.max_entries))
@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import glob
+import os
+import statistics
+import tempfile
+import time
+
+from embeddings import HashingEmbedder
+from localsearch import LocalSearchIndex, build_index, read_manifest
+from ragtools import ShardedSearchBackend, parse_shard_routes
+
+# Compares a knowledge base searched as one index with the same documents split into shards, one per
+# folder of the repo, merged by ShardedSearchBackend. Prints the share of the single index's top
+# results the sharded search also returns (recall) and the search time, with and without routing.
+# Runs offline on LocalSearchIndex shards, in Azure AI Search a sharded search takes as long as its
+# slowest shard instead of the sum of them.
+#
+# Run from app/backend:  python -m benchmarks.sharding [--routes "data:contoso|company,docs:deploy|setup|search,readme"]
+
+_QUERIES = [
+    "What does Contoso Electronics make?",
+    "Who founded Contoso Electronics and when?",
+    "What are the company's core values?",
+    "How do I set up the search index?",
+    "Which environment variables configure the search cache?",
+    "How do phone calls reach the backend?",
+    "How do I deploy to existing Azure services?",
+    "How many sessions can wait for admission?",
+]
+
+_SHARDS = {
+    "data": os.path.join("data", "*.md"),
+    "docs": os.path.join("docs", "*.md"),
+    "readme": "*.md",
+}
+
+async def _measure(backend, queries: list[str], rounds: int) -> tuple[dict[str, list[str]], list[float]]:
+    results = {}
+    seconds = []
+    for _ in range(rounds):
+        for query in queries:
+            started = time.perf_counter()
+            docs = await backend.search(query)
+            seconds.append(time.perf_counter() - started)
+            results[query] = [doc["chunk_id"] for doc in docs]
+    return results, seconds
+
+def _load(directory: str) -> LocalSearchIndex:
+    return LocalSearchIndex(directory, HashingEmbedder(read_manifest(directory)["dimensions"]))
+
+async def main(repository: str, queries: list[str], rounds: int, routes: str):
+    with tempfile.TemporaryDirectory() as directory:
+        files = {name: glob.glob(os.path.join(repository, pattern)) for name, pattern in _SHARDS.items()}
+        await build_index(os.path.join(directory, "all"), [f for shard in files.values() for f in shard], "hashing", 1000)
+        for name, shard in files.items():
+            await build_index(os.path.join(directory, name), shard, "hashing", 1000)
+        single = _load(os.path.join(directory, "all"))
+        shards = {name: _load(os.path.join(directory, name)) for name in files}
+        print(f"{len(single)} chunks, shards: " + ", ".join(f"{name} {len(shard)}" for name, shard in shards.items()))
+
+        expected, single_seconds = await _measure(single, queries, rounds)
+        configurations = [("one index", single, expected, single_seconds)]
+        sharded = ShardedSearchBackend(shards)
+        configurations.append(("all shards", sharded, *await _measure(sharded, queries, rounds)))
+        if routes:
+            routed = ShardedSearchBackend(shards, parse_shard_routes(routes))
+            configurations.append(("routed", routed, *await _measure(routed, queries, rounds)))
+
+        print(f"{'':<12}{'recall':>8}{'shards':>8}{'p50 ms':>9}{'max ms':>9}")
+        for name, backend, results, seconds in configurations:
+            recall = statistics.mean(len(set(results[q]) & set(expected[q])) / max(len(expected[q]), 1) for q in queries)
+            searched = statistics.mean(len(backend.route(q)) for q in queries) if isinstance(backend, ShardedSearchBackend) else 1
+            print(f"{name:<12}{recall:>8.0%}{searched:>8.1f}{statistics.median(seconds) * 1000:>9.3f}{max(seconds) * 1000:>9.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall and latency of sharded search compared with a single index")
+    parser.add_argument("--queries", help="Text file with one query per line")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--routes", default="data:contoso|company|founded|value,docs:deploy|setup|search|session|cache|environment|variable|admission")
+    args = parser.parse_args()
+    queries = _QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    repository = os.path.join(os.path.dirname(__file__), "..", "..", "..")
+    asyncio.run(main(repository, queries, args.rounds, args.routes))
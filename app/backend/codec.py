@@ -0,0 +1,34 @@
+import json
+import logging
+from typing import Any, Callable
+
+logger = logging.getLogger("voicerag")
+
+# JSON encoding for everything that goes over the realtime websockets. orjson is a lot cheaper than
+# the standard library on the large audio frames, so it's used when installed, with the json module
+# as the fallback. (ujson was measured too, see benchmarks/codec.py, and is slower than json on
+# frames that are mostly base64 audio.) Everything returns str since that's what send_str expects.
+
+def _load_codec() -> tuple[str, Callable[[Any], str], Callable[[str | bytes], Any]]:
+    try:
+        import orjson
+
+        def orjson_dumps(obj: Any) -> str:
+            return orjson.dumps(obj).decode("utf-8")
+        return "orjson", orjson_dumps, orjson.loads
+    except ImportError:
+        pass
+    return "json", json.dumps, json.loads
+
+name, dumps, loads = _load_codec()
+logger.info("Using %s for realtime JSON encoding", name)
+
+# Messages that never change are serialized once
+STOP_AUDIO = dumps({
+    "Kind": "StopAudio",
+    "AudioData": None,
+    "StopAudio": {}
+})
+RESPONSE_CREATE = dumps({
+    "type": "response.create"
+})
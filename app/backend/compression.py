@@ -0,0 +1,93 @@
+import math
+import re
+import time
+from typing import Any
+
+import metrics
+from searchcache import normalize_query, query_words
+
+_tokens_in = metrics.histogram("voicerag_search_output_tokens", "Estimated tokens of search tool output before compression (before) and sent to the model (after)",
+                               buckets=(50, 100, 200, 300, 400, 600, 800, 1000, 1500, 2000, 3000, 5000))
+_tokens_saved = metrics.counter("voicerag_search_tokens_saved_total", "Estimated tokens compression kept out of the realtime model's input")
+_compression_seconds = metrics.histogram("voicerag_search_compression_seconds", "Time spent compressing search tool output",
+                                         buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025))
+
+# Sentences end at ., ! or ? followed by whitespace, or at a line break (list items, headings)
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\s*\n+\s*")
+
+def estimate_tokens(text: str) -> int:
+    # English text averages about four characters per token with the GPT-4o tokenizer, close enough for a budget
+    return math.ceil(len(text) / 4)
+
+def format_results(docs: list[dict[str, Any]]) -> str:
+    return "".join(f"[{doc['chunk_id']}]: {doc['chunk']}\n-----\n" for doc in docs)
+
+class _Sentence:
+    doc: int
+    position: int
+    text: str
+    words: set[str]
+    score: float
+
+    def __init__(self, doc: int, position: int, text: str, words: set[str]):
+        self.doc = doc
+        self.position = position
+        self.text = text
+        self.words = words
+        self.score = 0.0
+
+def compress_results(query: str, docs: list[dict[str, Any]], token_budget: int) -> str:
+    # Formats search results like format_results, but only with the sentences most relevant to the query,
+    # up to about token_budget tokens. Sentences repeated word for word in a later chunk (the indexer
+    # splits documents into chunks that overlap) are left out. Sentences are scored by the query words they contain,
+    # rarer words counting more, with a small bonus for chunks the search ranked higher. They are kept
+    # in their original order under their chunk's id, so the model can still cite them.
+    started = time.perf_counter()
+    full = format_results(docs)
+    full_tokens = estimate_tokens(full)
+    if full_tokens <= token_budget:
+        _tokens_in.observe(full_tokens, stage="before")
+        _tokens_in.observe(full_tokens, stage="after")
+        return full
+
+    sentences: list[_Sentence] = []
+    # Only whole sentences count as repeats, "Deductible: $500" isn't one of "Deductible: $5000"
+    seen: set[str] = set()
+    for doc_index, doc in enumerate(docs):
+        for position, text in enumerate(_SENTENCE_END.split(doc["chunk"])):
+            normalized = normalize_query(text)
+            if len(normalized) == 0 or normalized in seen:
+                continue
+            seen.add(normalized)
+            sentences.append(_Sentence(doc_index, position, text.strip(), set(normalized.split())))
+
+    wanted = query_words(query)
+    document_frequency = {word: sum(1 for sentence in sentences if word in sentence.words) for word in wanted}
+    for sentence in sentences:
+        sentence.score = sum(math.log(1 + len(sentences) / document_frequency[word]) for word in wanted & sentence.words)
+        sentence.score += 0.1 / (sentence.doc + 1)
+
+    # Every chunk kept costs its id and separator on top of its sentences
+    overhead = {doc_index: estimate_tokens(f"[{doc['chunk_id']}]: \n-----\n") for doc_index, doc in enumerate(docs)}
+    kept: list[_Sentence] = []
+    kept_docs: set[int] = set()
+    used = 0
+    for sentence in sorted(sentences, key=lambda s: -s.score):
+        cost = estimate_tokens(sentence.text) + 1 + (overhead[sentence.doc] if sentence.doc not in kept_docs else 0)
+        if used + cost > token_budget and len(kept) > 0:
+            continue
+        kept.append(sentence)
+        kept_docs.add(sentence.doc)
+        used += cost
+
+    result = ""
+    for doc_index, doc in enumerate(docs):
+        chosen = sorted((s for s in kept if s.doc == doc_index), key=lambda s: s.position)
+        if len(chosen) > 0:
+            result += f"[{doc['chunk_id']}]: {' '.join(s.text for s in chosen)}\n-----\n"
+    compressed_tokens = estimate_tokens(result)
+    _tokens_in.observe(full_tokens, stage="before")
+    _tokens_in.observe(compressed_tokens, stage="after")
+    _tokens_saved.inc(full_tokens - compressed_tokens)
+    _compression_seconds.observe(time.perf_counter() - started)
+    return result
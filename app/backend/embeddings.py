@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+
+import codec
+import metrics
+from httpclient import get_client_session
+from searchcache import normalize_query
+from tokenmanager import COGNITIVE_SERVICES_SCOPE, AsyncTokenManager
+
+logger = logging.getLogger("voicerag")
+
+_requests = metrics.counter("voicerag_embedding_cache_requests_total", "Query embeddings by cache result: hit, miss, or coalesced into an identical request in flight")
+_batch_size = metrics.histogram("voicerag_embedding_batch_size", "Texts per embedding request sent by the cache", buckets=(1, 2, 4, 8, 16, 32, 64))
+
+_WORD = re.compile(r"\w+")
+
+class Embedder:
+    # Turns texts into unit length vectors of a fixed size, so cosine similarity is a dot product
+    dimensions: int
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        raise NotImplementedError
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+class HashingEmbedder(Embedder):
+    # Deterministic local embedder for tests and benchmarks: words and character trigrams are hashed
+    # into a fixed number of buckets. Needs no service, but only sees spelling, not meaning, so
+    # paraphrases that share no words don't come out similar.
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+
+    def _features(self, text: str) -> list[str]:
+        words = _WORD.findall(text.casefold())
+        features = [f"w:{word}" for word in words]
+        for word in words:
+            padded = f" {word} "
+            features.extend(f"t:{padded[i:i + 3]}" for i in range(len(padded) - 2))
+        return features
+
+    def embed_sync(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                # Whole words count more than trigrams, and a sign bit keeps collisions from only adding up
+                weight = 2.0 if feature.startswith("w:") else 1.0
+                vectors[row, digest % self.dimensions] += weight if digest & (1 << 63) else -weight
+        return _normalize_rows(vectors)
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        return self.embed_sync(texts)
+
+class AzureOpenAIEmbedder(Embedder):
+    # Embeddings from an Azure OpenAI deployment, for instance the one the search index was built with
+    endpoint: str
+    deployment: str
+    api_version: str
+    key: Optional[str] = None
+
+    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | AsyncTokenManager,
+                 dimensions: int = 3072, api_version: str = "2024-02-01"):
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.dimensions = dimensions
+        self.api_version = api_version
+        self._token_manager: Optional[AsyncTokenManager] = None
+        if isinstance(credentials, AzureKeyCredential):
+            self.key = credentials.key
+        else:
+            self._token_manager = credentials
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        if self.key is not None:
+            headers = {"api-key": self.key}
+        else:
+            headers = {"Authorization": f"Bearer {await self._token_manager.get_bearer_token(COGNITIVE_SERVICES_SCOPE)}"}
+        url = f"{self.endpoint.rstrip('/')}/openai/deployments/{self.deployment}/embeddings"
+        body = {"input": texts, "dimensions": self.dimensions}
+        async with get_client_session().post(url, params={"api-version": self.api_version}, headers=headers, json=body) as response:
+            response.raise_for_status()
+            result = await response.json()
+        data = sorted(result["data"], key=lambda item: item["index"])
+        return _normalize_rows(np.array([item["embedding"] for item in data], dtype=np.float32))
+
+class CachedEmbedder(Embedder):
+    # Wraps an embedder with an LRU cache of up to max_entries embeddings, keyed by the normalized text,
+    # so repeated queries aren't embedded again. Texts requested within batch_window seconds of each
+    # other, by any session, go to the embedder in one request of up to max_batch texts.
+    #
+    # With a path, the embeddings are kept in a memory-mapped file (and their keys in path.keys), so a
+    # restarted replica starts with the cache it had. Each process needs its own file.
+    embedder: Embedder
+    max_entries: int
+    batch_window: float
+    max_batch: int
+    path: Optional[str]
+
+    def __init__(self, embedder: Embedder, max_entries: int = 10000, batch_window: float = 0.005, max_batch: int = 16, path: Optional[str] = None):
+        self.embedder = embedder
+        self.dimensions = embedder.dimensions
+        self.max_entries = max_entries
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.path = path
+        self._rows: OrderedDict[str, int] = OrderedDict()
+        self._pending: dict[str, asyncio.Future] = {}
+        self._batch: list[tuple[str, str]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # Batches being embedded, kept so they aren't garbage collected and close can cancel them
+        self._tasks: set[asyncio.Task] = set()
+        self._keys_file = None
+        if path is None:
+            self._vectors = np.zeros((max_entries, self.dimensions), dtype=np.float32)
+        else:
+            self._vectors = self._open(path)
+        used = set(self._rows.values())
+        self._free = [row for row in range(max_entries - 1, -1, -1) if row not in used]
+
+    def _open(self, path: str) -> np.ndarray:
+        shape = (self.max_entries, self.dimensions)
+        vectors = None
+        if os.path.exists(path):
+            try:
+                vectors = np.lib.format.open_memmap(path, mode="r+")
+            except (ValueError, OSError):
+                logger.warning("Couldn't read the embedding cache %s, starting with an empty one", path, exc_info=True)
+            if vectors is not None and (vectors.shape != shape or vectors.dtype != np.float32):
+                logger.info("Embedding cache %s has a different size, starting with an empty one", path)
+                vectors = None
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+        elif os.path.exists(path + ".keys"):
+            # Rows get reused after an eviction, the last key written for a row is the one it holds
+            owners: dict[int, str] = {}
+            with open(path + ".keys", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = codec.loads(line)
+                    except ValueError:
+                        # A line cut short when the process stopped
+                        continue
+                    previous = owners.get(entry["row"])
+                    if previous is not None:
+                        self._rows.pop(previous, None)
+                    owners[entry["row"]] = entry["key"]
+                    self._rows.pop(entry["key"], None)
+                    self._rows[entry["key"]] = entry["row"]
+            logger.info("Loaded %d cached embeddings from %s", len(self._rows), path)
+        # Rewritten without the superseded lines, then appended to as embeddings are added
+        with open(path + ".keys", "w", encoding="utf-8") as f:
+            for key, row in self._rows.items():
+                f.write(codec.dumps({"row": row, "key": key}) + "\n")
+        self._keys_file = open(path + ".keys", "a", encoding="utf-8")
+        return vectors
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.empty((len(texts), self.dimensions), dtype=np.float32)
+        waiting = []
+        for i, text in enumerate(texts):
+            key = normalize_query(text) or text
+            row = self._rows.get(key)
+            if row is not None:
+                self._rows.move_to_end(key)
+                vectors[i] = self._vectors[row]
+                _requests.inc(result="hit")
+                continue
+            future = self._pending.get(key)
+            if future is None:
+                future = self._enqueue(key, text)
+                _requests.inc(result="miss")
+            else:
+                _requests.inc(result="coalesced")
+            waiting.append((i, future))
+        for i, future in waiting:
+            # Shielded, the other callers waiting for the same text still get it if this one is cancelled
+            vectors[i] = await asyncio.shield(future)
+        return vectors
+
+    def _enqueue(self, key: str, text: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending[key] = future
+        self._batch.append((key, text))
+        if len(self._batch) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if len(batch) > 0:
+            _batch_size.observe(len(batch))
+            task = asyncio.create_task(self._embed_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _embed_batch(self, batch: list[tuple[str, str]]) -> None:
+        try:
+            vectors = await self.embedder.embed([text for _, text in batch])
+        except Exception as e:
+            for key, _ in batch:
+                future = self._pending.pop(key)
+                future.set_exception(e)
+                # Retrieve it here, there may be nobody waiting anymore
+                future.exception()
+            return
+        for (key, _), vector in zip(batch, vectors):
+            self._store(key, vector)
+            self._pending.pop(key).set_result(vector)
+
+    def _store(self, key: str, vector: np.ndarray) -> None:
+        if len(self._free) > 0:
+            row = self._free.pop()
+        else:
+            _, row = self._rows.popitem(last=False)
+        self._vectors[row] = vector
+        self._rows[key] = row
+        if self._keys_file is not None:
+            self._keys_file.write(codec.dumps({"row": row, "key": key}) + "\n")
+            self._keys_file.flush()
+
+    async def close(self) -> None:
+        # Embeddings still being requested are given up on, whoever waits for them gets CancelledError
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._batch = []
+        if self._keys_file is not None:
+            self._vectors.flush()
+            self._keys_file.close()
+            self._keys_file = None
@@ -0,0 +1,125 @@
+import asyncio
+import time
+from collections import deque
+from collections.abc import Awaitable
+from typing import Any, Callable, Optional, TypeVar
+
+import metrics
+
+_hedges = metrics.counter("voicerag_search_hedges_total", "Duplicate requests sent because the first was slow, by operation and whether the duplicate answered first (won) or not (lost)")
+_deadlines = metrics.counter("voicerag_search_deadline_exceeded_total", "Requests abandoned at their deadline, by operation")
+_hedge_delay = metrics.gauge("voicerag_search_hedge_delay_seconds", "Current wait before a duplicate request is sent, by operation")
+
+T = TypeVar("T")
+
+class Hedger:
+    # Runs requests with a hedge: when a request hasn't answered after the quantile (p90 by default)
+    # of recent latencies, the same request is sent again and whichever answers first wins, the other
+    # is cancelled. A slow replica or a lost packet then costs the delay plus a normal request instead
+    # of the whole tail. At most max_hedge_rate of the recent requests are hedged, so a service that's
+    # slow across the board doesn't get twice the load.
+    #
+    # With a deadline, requests (and their hedges) that haven't answered in time are cancelled and
+    # raise asyncio.TimeoutError.
+    name: str
+    quantile: Optional[float]
+    deadline: Optional[float]
+    max_hedge_rate: float
+    min_delay: float
+    max_delay: float
+    # Latencies measured before the delay is taken from them, until then it's max_delay
+    min_samples: int = 20
+
+    def __init__(self,
+                 name: str,
+                 quantile: Optional[float] = 0.9,
+                 deadline: Optional[float] = None,
+                 max_hedge_rate: float = 0.1,
+                 min_delay: float = 0.02,
+                 max_delay: float = 2.0,
+                 window: int = 200):
+        if not 0 <= max_hedge_rate <= 1:
+            raise ValueError("max_hedge_rate must be between 0 and 1")
+        self.name = name
+        # None only enforces the deadline
+        self.quantile = quantile
+        self.deadline = deadline
+        self.max_hedge_rate = max_hedge_rate
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._hedged: deque[bool] = deque(maxlen=window)
+        self._hedge_count = 0
+
+    def delay(self) -> float:
+        if len(self._latencies) < self.min_samples:
+            return self.max_delay
+        ordered = sorted(self._latencies)
+        delay = ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))]
+        return min(max(delay, self.min_delay), self.max_delay)
+
+    def _record(self, hedged: bool) -> None:
+        if len(self._hedged) == self._hedged.maxlen and self._hedged[0]:
+            self._hedge_count -= 1
+        self._hedged.append(hedged)
+        if hedged:
+            self._hedge_count += 1
+
+    def _may_hedge(self) -> bool:
+        # A rate of 0 turns hedging off and only leaves the deadline
+        if self.max_hedge_rate <= 0:
+            return False
+        return self._hedge_count + 1 <= self.max_hedge_rate * max(len(self._hedged), 1 / self.max_hedge_rate)
+
+    async def _timed(self, request: Callable[[], Awaitable[T]]) -> T:
+        started = time.monotonic()
+        try:
+            return await request()
+        finally:
+            # Requests cancelled because the other one won count too, or the slow ones would never be seen
+            self._latencies.append(time.monotonic() - started)
+
+    async def run(self, request: Callable[[], Awaitable[T]]) -> T:
+        started = time.monotonic()
+        deadline_at = None if self.deadline is None else started + self.deadline
+        first = asyncio.create_task(self._timed(request))
+        tasks = [first]
+        hedged = False
+        try:
+            if self.quantile is not None:
+                delay = self.delay()
+                _hedge_delay.set(delay, operation=self.name)
+                done, _ = await asyncio.wait(tasks, timeout=delay if deadline_at is None else min(delay, self.deadline))
+                # Slow, or failed right away, either way another try is likely to do better
+                if (len(done) == 0 or first.exception() is not None) and self._may_hedge():
+                    hedged = True
+                    tasks.append(asyncio.create_task(self._timed(request)))
+
+            # The first request to succeed wins
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while len(pending) > 0:
+                remaining = None if deadline_at is None else deadline_at - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if hedged:
+                            _hedges.inc(operation=self.name, outcome="lost" if task is first else "won")
+                        return task.result()
+                    error = task.exception()
+                if len(done) == 0:
+                    break
+            if len(pending) == 0 and error is not None:
+                raise error
+            _deadlines.inc(operation=self.name)
+            raise asyncio.TimeoutError(f"{self.name} took longer than {self.deadline}s")
+        finally:
+            self._record(hedged)
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict[str, Any]:
+        return {"delay": self.delay() if self.quantile is not None else None, "samples": len(self._latencies), "hedge_rate": self._hedge_count / max(len(self._hedged), 1)}
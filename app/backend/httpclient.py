@@ -0,0 +1,70 @@
+import logging
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+from azure.core.pipeline.transport import AioHttpTransport
+
+logger = logging.getLogger("voicerag")
+
+# Names of the shared sessions. Realtime websockets hold their connection for the whole call, so they
+# get a session without a connection limit instead of competing with short HTTP requests for slots.
+REALTIME = "realtime"
+HTTP = "http"
+
+class ClientSessionRegistry:
+    # Process-wide aiohttp sessions shared by every outbound request and websocket in the backend, so
+    # DNS lookups, pooled keep-alive connections and TLS sessions are reused across calls instead of
+    # being thrown away with a per-request ClientSession.
+    limit: int
+    limit_per_host: int
+    ttl_dns_cache: int
+    keepalive_timeout: float
+
+    def __init__(self, limit: int = 200, limit_per_host: int = 50, ttl_dns_cache: int = 300, keepalive_timeout: float = 30.0):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self._sessions: dict[str, aiohttp.ClientSession] = {}
+
+    def get(self, name: str = HTTP) -> aiohttp.ClientSession:
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            session = self._sessions[name] = self._create(name)
+        return session
+
+    def _create(self, name: str) -> aiohttp.ClientSession:
+        unlimited = name == REALTIME
+        connector = aiohttp.TCPConnector(
+            limit=0 if unlimited else self.limit,
+            limit_per_host=0 if unlimited else self.limit_per_host,
+            ttl_dns_cache=self.ttl_dns_cache,
+            keepalive_timeout=self.keepalive_timeout,
+            enable_cleanup_closed=True)
+        return aiohttp.ClientSession(connector=connector)
+
+    def transport(self) -> AioHttpTransport:
+        # For the async Azure SDK clients, so their requests share the same connection pool
+        return AioHttpTransport(session=self.get(HTTP), session_owner=False)
+
+    async def close(self) -> None:
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    def attach_to_app(self, app: web.Application) -> None:
+        async def close_sessions(app):
+            await self.close()
+        app.on_cleanup.append(close_sessions)
+
+_registry: Optional[ClientSessionRegistry] = None
+
+def client_sessions() -> ClientSessionRegistry:
+    global _registry
+    if _registry is None:
+        _registry = ClientSessionRegistry()
+    return _registry
+
+def get_client_session(name: str = HTTP) -> aiohttp.ClientSession:
+    return client_sessions().get(name)
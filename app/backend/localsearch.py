@@ -0,0 +1,239 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from embeddings import AzureOpenAIEmbedder, Embedder, HashingEmbedder
+from httpclient import client_sessions
+from ragtools import KEY_PATTERN, SearchBackend
+from searchcache import normalize_query
+
+# An index directory holds the chunks (one JSON object per line, with chunk_id, title and chunk), their
+# embeddings as a float32 NumPy array with one row per chunk, and a manifest saying how they were embedded.
+# Build one with:
+#
+#   python -m localsearch export <directory>               from the Azure AI Search index, with its embeddings
+#   python -m localsearch build <directory> <files>...      from text or markdown files, embedded locally
+CHUNKS_FILE = "chunks.jsonl"
+EMBEDDINGS_FILE = "embeddings.npy"
+MANIFEST_FILE = "manifest.json"
+
+def _tokens(text: str) -> list[str]:
+    return normalize_query(text).split()
+
+def _top(scores: np.ndarray, rows: np.ndarray, k: int) -> np.ndarray:
+    # The k of rows with the highest scores, best first
+    if len(rows) > k:
+        rows = rows[np.argpartition(-scores[rows], k)[:k]]
+    return rows[np.argsort(-scores[rows], kind="stable")]
+
+def read_manifest(directory: str) -> dict[str, Any]:
+    with open(Path(directory) / MANIFEST_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+def write_index(directory: str, chunks: list[dict[str, Any]], embeddings: np.ndarray, embedder: str) -> None:
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    with open(path / CHUNKS_FILE, "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(json.dumps({"chunk_id": chunk["chunk_id"], "title": chunk["title"], "chunk": chunk["chunk"]}) + "\n")
+    np.save(path / EMBEDDINGS_FILE, np.ascontiguousarray(embeddings, dtype=np.float32))
+    with open(path / MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump({"count": len(chunks), "dimensions": int(embeddings.shape[1]), "embedder": embedder, "created": time.time()}, f)
+
+class LocalSearchIndex(SearchBackend):
+    # Hybrid search over a knowledge base small enough to keep in the process, like the data folder,
+    # without a network hop to Azure AI Search. Chunks are ranked by BM25 over their words and by the
+    # cosine similarity of their embeddings to the query's (a brute-force matrix-vector product over
+    # the memory-mapped embeddings), and the two rankings are merged with reciprocal rank fusion.
+    #
+    # The embedder has to be the one the index was built with, see the manifest. The BM25 postings are
+    # built when the index is loaded, which takes well under a second for a few thousand chunks.
+    directory: str
+    embedder: Embedder
+    top: int
+    candidates: int
+    # BM25 term frequency saturation and length normalization
+    k1: float = 1.2
+    b: float = 0.75
+    # Reciprocal rank fusion constant, larger values flatten the difference between ranks
+    rrf_k: int = 60
+
+    def __init__(self, directory: str, embedder: Embedder, top: int = 5, candidates: int = 50):
+        self.directory = directory
+        self.embedder = embedder
+        self.top = top
+        # Results taken from each ranking before fusing them
+        self.candidates = candidates
+        manifest = read_manifest(directory)
+        with open(Path(directory) / CHUNKS_FILE, encoding="utf-8") as f:
+            self._chunks = [json.loads(line) for line in f if line.strip()]
+        self._embeddings = np.load(Path(directory) / EMBEDDINGS_FILE, mmap_mode="r")
+        if self._embeddings.shape != (len(self._chunks), embedder.dimensions):
+            raise ValueError(f"{directory} has {self._embeddings.shape[0]} embeddings of {self._embeddings.shape[1]} dimensions "
+                             f"for {len(self._chunks)} chunks, the embedder makes {embedder.dimensions}")
+        self._rows = {chunk["chunk_id"]: row for row, chunk in enumerate(self._chunks)}
+        self._postings = self._index()
+        self.scope = ("local", os.path.abspath(directory), manifest.get("created"))
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def _index(self) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+        # For every term, the chunks it appears in and its BM25 weight in each, so a query only adds them up
+        counts: dict[str, dict[int, int]] = {}
+        lengths = np.zeros(len(self._chunks), dtype=np.float32)
+        for row, chunk in enumerate(self._chunks):
+            tokens = _tokens(f"{chunk['title']} {chunk['chunk']}")
+            lengths[row] = len(tokens)
+            for token in tokens:
+                rows = counts.setdefault(token, {})
+                rows[row] = rows.get(row, 0) + 1
+        average_length = max(float(lengths.mean()), 1.0) if len(lengths) > 0 else 1.0
+        postings = {}
+        for term, rows in counts.items():
+            chunk_rows = np.fromiter(rows.keys(), dtype=np.int32, count=len(rows))
+            frequencies = np.fromiter(rows.values(), dtype=np.float32, count=len(rows))
+            idf = math.log(1 + (len(self._chunks) - len(rows) + 0.5) / (len(rows) + 0.5))
+            normalization = self.k1 * (1 - self.b + self.b * lengths[chunk_rows] / average_length)
+            postings[term] = (chunk_rows, idf * frequencies * (self.k1 + 1) / (frequencies + normalization))
+        return postings
+
+    def keyword_ranking(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self._chunks), dtype=np.float32)
+        for term in set(_tokens(query)):
+            posting = self._postings.get(term)
+            if posting is not None:
+                scores[posting[0]] += posting[1]
+        return _top(scores, np.flatnonzero(scores), self.candidates)
+
+    def vector_ranking(self, vector: np.ndarray) -> np.ndarray:
+        similarities = self._embeddings @ vector
+        return _top(similarities, np.arange(len(similarities)), self.candidates)
+
+    def _fused_scores(self, *rankings: np.ndarray) -> dict[int, float]:
+        scores: dict[int, float] = {}
+        for ranking in rankings:
+            for rank, row in enumerate(ranking.tolist()):
+                scores[row] = scores.get(row, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        return scores
+
+    def fuse(self, *rankings: np.ndarray) -> list[int]:
+        scores = self._fused_scores(*rankings)
+        return sorted(scores, key=lambda row: -scores[row])[:self.top]
+
+    async def search(self, query: str) -> list[dict[str, Any]]:
+        vector = (await self.embedder.embed([query]))[0]
+        rows = self.fuse(self.keyword_ranking(query), self.vector_ranking(vector))
+        return [self._chunks[row] for row in rows]
+
+    async def scored_search(self, query: str) -> list[tuple[float, dict[str, Any]]]:
+        vector = (await self.embedder.embed([query]))[0]
+        scores = self._fused_scores(self.keyword_ranking(query), self.vector_ranking(vector))
+        rows = sorted(scores, key=lambda row: -scores[row])[:self.top]
+        if len(rows) == 0:
+            return []
+        # Fused scores only say how a chunk ranks in this index, a small index always has a first one.
+        # The cosine similarity to the query compares across indexes embedded with the same model,
+        # scaled by the fused score relative to the best one to keep this index's order.
+        similarities = self._embeddings[rows] @ vector
+        best = scores[rows[0]]
+        return [(max(float(similarity), 0.0) * scores[row] / best, self._chunks[row]) for row, similarity in zip(rows, similarities)]
+
+    async def get(self, chunk_ids: list[str]) -> list[dict[str, Any]]:
+        return [self._chunks[self._rows[chunk_id]] for chunk_id in chunk_ids if chunk_id in self._rows]
+
+def chunk_text(title: str, text: str, max_characters: int = 1000) -> list[dict[str, Any]]:
+    # Splits a document into chunks of whole paragraphs, only paragraphs longer than max_characters get cut
+    prefix = re.sub(r"[^a-zA-Z0-9_=\-]", "_", Path(title).stem)
+    chunks: list[dict[str, Any]] = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(current) + len(paragraph) + 2 > max_characters and current:
+            chunks.append(current)
+            current = ""
+        while len(paragraph) > max_characters:
+            chunks.append(paragraph[:max_characters])
+            paragraph = paragraph[max_characters:]
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return [{"chunk_id": f"{prefix}_{i}", "title": title, "chunk": chunk} for i, chunk in enumerate(chunks)]
+
+async def _embed_all(embedder: Embedder, texts: list[str], batch_size: int = 16) -> np.ndarray:
+    batches = [await embedder.embed(texts[start:start + batch_size]) for start in range(0, len(texts), batch_size)]
+    return np.concatenate(batches) if len(batches) > 0 else np.zeros((0, embedder.dimensions), dtype=np.float32)
+
+async def build_index(directory: str, files: list[str], embedder_name: str, max_characters: int) -> None:
+    chunks = []
+    for file in files:
+        chunks.extend(chunk_text(Path(file).name, Path(file).read_text(encoding="utf-8"), max_characters))
+    if embedder_name == "azure":
+        from azure.core.credentials import AzureKeyCredential
+        dimensions = int(os.environ.get("AZURE_OPENAI_EMBEDDING_DIMENSIONS") or 3072)
+        embedder = AzureOpenAIEmbedder(os.environ["AZURE_OPENAI_ENDPOINT"], os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"],
+                                       AzureKeyCredential(os.environ["AZURE_OPENAI_API_KEY"]), dimensions=dimensions)
+        manifest_embedder = "azure"
+    else:
+        embedder = HashingEmbedder()
+        manifest_embedder = "hashing"
+    try:
+        embeddings = await _embed_all(embedder, [chunk["chunk"] for chunk in chunks])
+    finally:
+        await client_sessions().close()
+    write_index(directory, chunks, embeddings, manifest_embedder)
+    print(f"Wrote {len(chunks)} chunks from {len(files)} files to {directory}")
+
+async def _export(directory: str) -> None:
+    # Copies the chunks and the embeddings integrated vectorization computed out of the Azure AI Search index
+    from azure.core.credentials import AzureKeyCredential
+    from azure.identity.aio import DefaultAzureCredential
+    from azure.search.documents.aio import SearchClient
+    identifier_field = os.environ.get("AZURE_SEARCH_IDENTIFIER_FIELD") or "chunk_id"
+    content_field = os.environ.get("AZURE_SEARCH_CONTENT_FIELD") or "chunk"
+    embedding_field = os.environ.get("AZURE_SEARCH_EMBEDDING_FIELD") or "text_vector"
+    title_field = os.environ.get("AZURE_SEARCH_TITLE_FIELD") or "title"
+    search_key = os.environ.get("AZURE_SEARCH_API_KEY")
+    credential = AzureKeyCredential(search_key) if search_key else DefaultAzureCredential()
+    chunks = []
+    vectors = []
+    async with SearchClient(os.environ["AZURE_SEARCH_ENDPOINT"], os.environ["AZURE_SEARCH_INDEX"], credential) as search_client:
+        results = await search_client.search(search_text="*", select=[identifier_field, title_field, content_field, embedding_field])
+        async for r in results:
+            if not KEY_PATTERN.match(r[identifier_field]):
+                continue
+            chunks.append({"chunk_id": r[identifier_field], "title": r[title_field], "chunk": r[content_field]})
+            vectors.append(r[embedding_field])
+    if not isinstance(credential, AzureKeyCredential):
+        await credential.close()
+    embeddings = np.array(vectors, dtype=np.float32)
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    write_index(directory, chunks, embeddings, "azure")
+    print(f"Wrote {len(chunks)} chunks from {os.environ['AZURE_SEARCH_INDEX']} to {directory}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an index directory for LocalSearchIndex")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Copy the chunks and embeddings of the Azure AI Search index (AZURE_SEARCH_* variables)")
+    export.add_argument("directory")
+    build = commands.add_parser("build", help="Chunk and embed text or markdown files")
+    build.add_argument("directory")
+    build.add_argument("files", nargs="+")
+    build.add_argument("--embedder", choices=["hashing", "azure"], default="hashing",
+                       help="azure uses AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_EMBEDDING_DEPLOYMENT and AZURE_OPENAI_API_KEY")
+    build.add_argument("--chunk-size", type=int, default=1000, help="Maximum characters per chunk")
+    args = parser.parse_args()
+    if args.command == "export":
+        asyncio.run(_export(args.directory))
+    else:
+        asyncio.run(build_index(args.directory, args.files, args.embedder, args.chunk_size))
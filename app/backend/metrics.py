@@ -0,0 +1,267 @@
+import glob
+import math
+import os
+import threading
+import time
+from typing import Any, Optional
+
+import codec
+
+# Minimal in-process metrics with Prometheus-style names and labels. Values are kept per label set
+# and are only ever read by whoever reports them, so there's no dependency on a metrics client library.
+# With several worker processes, see use_shared_directory, every worker reports the sum of all of them.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _label_key(labels: dict[str, str]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+class Metric:
+    name: str
+    help: str
+    type: str = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(_label_key(labels), 0.0)
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(_label_key(labels), 0.0)
+
+class HistogramValue:
+    buckets: tuple[float, ...]
+    counts: list[int]
+    count: int
+    sum: float
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def copy(self) -> "HistogramValue":
+        copied = HistogramValue(self.buckets)
+        copied.counts = list(self.counts)
+        copied.count = self.count
+        copied.sum = self.sum
+        return copied
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+class Histogram(Metric):
+    type = "histogram"
+    buckets: tuple[float, ...]
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+        self.values: dict[tuple, HistogramValue] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = HistogramValue(self.buckets)
+            histogram.observe(value)
+
+    def get(self, **labels: str) -> Optional[HistogramValue]:
+        return self.values.get(_label_key(labels))
+
+_registry: dict[str, Metric] = {}
+_registry_lock = threading.Lock()
+
+def _get_or_create(cls, name: str, help: str, **kwargs) -> Metric:
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, help, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+        return metric
+
+def counter(name: str, help: str) -> Counter:
+    return _get_or_create(Counter, name, help)
+
+def gauge(name: str, help: str) -> Gauge:
+    return _get_or_create(Gauge, name, help)
+
+def histogram(name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return _get_or_create(Histogram, name, help, buckets=buckets)
+
+def registered_metrics() -> list[Metric]:
+    with _registry_lock:
+        return list(_registry.values())
+
+def _values(metric: Metric) -> list[tuple[tuple, Any]]:
+    # A consistent copy of a metric's values: histograms are copied whole under the lock, otherwise a
+    # concurrent observe could leave their buckets, count and sum out of step with each other
+    with metric._lock:
+        return [(key, value.copy() if isinstance(value, HistogramValue) else value) for key, value in metric.values.items()]
+
+# Where the worker processes keep their snapshots and the name of this one's, see use_shared_directory
+_shared_directory: Optional[str] = None
+_worker: Optional[str] = None
+# Snapshots not rewritten for this many intervals belong to workers that are gone and are left out
+_STALE_INTERVALS = 5
+_interval = 1.0
+_CLASSES = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+def use_shared_directory(directory: str, worker: str, interval: float = 1.0) -> None:
+    # Each worker writes a snapshot of its metrics to directory every interval seconds, and reports the
+    # sum of every worker's latest snapshot and its own current values. Counters, gauges and histogram
+    # buckets add up across workers, so /metrics is the same whichever worker the scrape lands on. A
+    # worker restarted under the same name replaces its predecessor's snapshot, which looks like a
+    # counter reset to Prometheus.
+    global _shared_directory, _worker, _interval
+    _shared_directory = directory
+    _worker = worker
+    _interval = interval
+    write_snapshot()
+
+    def write_periodically():
+        while True:
+            time.sleep(interval)
+            write_snapshot()
+
+    threading.Thread(target=write_periodically, name="metrics-snapshot", daemon=True).start()
+
+def write_snapshot() -> None:
+    snapshot = {}
+    for metric in registered_metrics():
+        values = _values(metric)
+        snapshot[metric.name] = {
+            "type": metric.type,
+            "help": metric.help,
+            "buckets": list(getattr(metric, "buckets", ())),
+            "values": [[key, {"counts": list(value.counts), "count": value.count, "sum": value.sum} if isinstance(value, HistogramValue) else value]
+                       for key, value in values],
+        }
+    path = os.path.join(_shared_directory, f"{_worker}.json")
+    # Replaced in one go, so other workers never read half a snapshot
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(codec.dumps(snapshot))
+    os.replace(path + ".tmp", path)
+
+def _read_snapshots() -> list[dict[str, Any]]:
+    # The other live workers' snapshots. This worker's own values are read from the registry instead,
+    # and snapshots that haven't been rewritten for a while are from workers that have exited.
+    snapshots = []
+    own = os.path.join(_shared_directory, f"{_worker}.json")
+    stale_before = time.time() - _STALE_INTERVALS * _interval
+    for path in sorted(glob.glob(os.path.join(_shared_directory, "*.json"))):
+        if path == own:
+            continue
+        try:
+            if os.path.getmtime(path) < stale_before:
+                continue
+            with open(path, encoding="utf-8") as f:
+                snapshots.append(codec.loads(f.read()))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+def _merged_snapshots() -> list[Metric]:
+    merged: dict[str, Metric] = {}
+
+    def add(name: str, type: str, help: str, buckets: tuple[float, ...], values: list) -> None:
+        metric = merged.get(name)
+        if metric is None:
+            cls = _CLASSES[type]
+            metric = merged[name] = cls(name, help, buckets) if cls is Histogram else cls(name, help)
+        for key, value in values:
+            key = tuple(tuple(pair) for pair in key)
+            if isinstance(metric, Histogram):
+                total = metric.values.get(key)
+                if total is None:
+                    total = metric.values[key] = HistogramValue(metric.buckets)
+                total.counts = [a + b for a, b in zip(total.counts, value["counts"])]
+                total.count += value["count"]
+                total.sum += value["sum"]
+            else:
+                metric.values[key] = metric.values.get(key, 0.0) + value
+
+    for metric in registered_metrics():
+        add(metric.name, metric.type, metric.help, getattr(metric, "buckets", ()),
+            [(key, {"counts": value.counts, "count": value.count, "sum": value.sum} if isinstance(value, HistogramValue) else value)
+             for key, value in _values(metric)])
+    for snapshot in _read_snapshots():
+        for name, entry in snapshot.items():
+            add(name, entry["type"], entry["help"], tuple(entry["buckets"]), entry["values"])
+    return list(merged.values())
+
+def _format_labels(key: tuple[tuple[str, str], ...], extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra is not None else [])
+    if len(pairs) == 0:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+def render_prometheus() -> str:
+    # Prometheus text exposition format (version 0.0.4) of everything in the registry, summed over the
+    # worker processes when they share a directory. Snapshots are only written by the background thread.
+    reported = registered_metrics() if _shared_directory is None else _merged_snapshots()
+    lines = []
+    for metric in reported:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for key, value in _values(metric):
+            if isinstance(value, HistogramValue):
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append(f"{metric.name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {cumulative}")
+                lines.append(f"{metric.name}_bucket{_format_labels(key, ('le', '+Inf'))} {value.count}")
+                lines.append(f"{metric.name}_sum{_format_labels(key)} {_format_value(value.sum)}")
+                lines.append(f"{metric.name}_count{_format_labels(key)} {value.count}")
+            else:
+                lines.append(f"{metric.name}{_format_labels(key)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
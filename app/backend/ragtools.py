@@ -1,12 +1,36 @@
+import asyncio
+import functools
+import logging
 import re
-from typing import Any
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Hashable
+from typing import Any, Callable, Optional
 
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceNotFoundError
 from azure.identity import DefaultAzureCredential
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import VectorizableTextQuery
+from azure.search.documents.indexes.aio import SearchIndexerClient
+from azure.search.documents.models import VectorizableTextQuery, VectorizedQuery
 
-from rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection
+import metrics
+from compression import compress_results, format_results
+from embeddings import Embedder
+from hedging import Hedger
+from httpclient import client_sessions
+from rtsession import RTMiddleTierBase, RTSession, Tool, ToolResult, ToolResultDirection
+from searchcache import IndexWatcher, SearchCache, query_words
+from semanticcache import SemanticCache
+from subqueries import fuse_rankings, split_query
+from tokenmanager import AsyncTokenManager
+
+logger = logging.getLogger("voicerag")
+
+_speculative_searches = metrics.counter("voicerag_speculative_searches_total", "Searches started from a caller's transcript before the model asked (started), and the ones that answered its search call (used)")
+_subqueries = metrics.histogram("voicerag_search_subqueries", "Queries each search tool call was split into", buckets=(1, 2, 3, 4, 6, 8))
+_shards_searched = metrics.histogram("voicerag_search_shards", "Index shards each search was sent to", buckets=(1, 2, 3, 4, 6, 8))
+_shard_errors = metrics.counter("voicerag_search_shard_errors_total", "Searches an index shard failed, by index")
+_grounding_chunks = metrics.counter("voicerag_grounding_chunks_total", "Chunks cited with report_grounding, by where they came from: the session's earlier search results or another query to the index")
 
 _search_tool_schema = {
     "type": "function",
@@ -49,70 +73,388 @@ _grounding_tool_schema = {
     }
 }
 
+class ChunkStore:
+    # Chunks the search tool returned during a session, so report_grounding can answer from them instead
+    # of fetching the same chunks from the index again. Keeps the max_chunks most recent ones.
+    max_chunks: int
+
+    def __init__(self, max_chunks: int = 200):
+        self.max_chunks = max_chunks
+        self._chunks: OrderedDict[str, dict[str, Any]] = OrderedDict()
+
+    def add(self, docs: list[dict[str, Any]]) -> None:
+        for doc in docs:
+            self._chunks[doc["chunk_id"]] = doc
+            self._chunks.move_to_end(doc["chunk_id"])
+        while len(self._chunks) > self.max_chunks:
+            self._chunks.popitem(last=False)
+
+    def get(self, chunk_id: str) -> Optional[dict[str, Any]]:
+        return self._chunks.get(chunk_id)
+
+def _chunk_store(rt_session: RTSession) -> ChunkStore:
+    return rt_session.tool_state.setdefault("chunks", ChunkStore())
+
+class SearchBackend:
+    # Where the search and report_grounding tools get knowledge base chunks from, as dicts with a
+    # chunk_id, title and chunk. Azure AI Search by default, localsearch.LocalSearchIndex for small
+    # corpora served from memory.
+    #
+    # Identifies the results for the search caches, everything that changes them should be in it
+    scope: Hashable
+
+    async def search(self, query: str) -> list[dict[str, Any]]:
+        raise NotImplementedError
+
+    async def scored_search(self, query: str) -> list[tuple[float, dict[str, Any]]]:
+        # Like search, with each chunk's relevance between 0 and 1, comparable with other backends' so
+        # results from several of them can be merged
+        raise NotImplementedError
+
+    async def get(self, chunk_ids: list[str]) -> list[dict[str, Any]]:
+        raise NotImplementedError
+
+class AzureSearchBackend(SearchBackend):
+    def __init__(self,
+        search_client: SearchClient,
+        semantic_configuration: str | None,
+        identifier_field: str,
+        content_field: str,
+        embedding_field: str,
+        title_field: str,
+        use_vector_query: bool,
+        scope: Hashable,
+        embedder: Optional[Embedder] = None):
+        self.search_client = search_client
+        self.semantic_configuration = semantic_configuration
+        self.identifier_field = identifier_field
+        self.content_field = content_field
+        self.embedding_field = embedding_field
+        self.title_field = title_field
+        self.use_vector_query = use_vector_query
+        self.scope = scope
+        # With an embedder the query is embedded here and sent as a vector, instead of Azure AI Search
+        # calling the index's vectorizer for every query
+        self.embedder = embedder
+
+    def _doc(self, r: dict[str, Any]) -> dict[str, Any]:
+        return {"chunk_id": r[self.identifier_field], "title": r[self.title_field], "chunk": r[self.content_field]}
+
+    async def _docs(self, search_results) -> list[dict[str, Any]]:
+        return [self._doc(r) async for r in search_results]
+
+    async def _query(self, query: str):
+        # Hybrid query using Azure AI Search with (optional) Semantic Ranker
+        vector_queries = []
+        if self.use_vector_query and self.embedder is not None:
+            vector = (await self.embedder.embed([query]))[0]
+            vector_queries.append(VectorizedQuery(vector=vector.tolist(), k_nearest_neighbors=50, fields=self.embedding_field))
+        elif self.use_vector_query:
+            vector_queries.append(VectorizableTextQuery(text=query, k_nearest_neighbors=50, fields=self.embedding_field))
+        search_results = await self.search_client.search(
+            search_text=query, 
+            query_type="semantic" if self.semantic_configuration else "simple",
+            semantic_configuration_name=self.semantic_configuration,
+            top=5,
+            vector_queries=vector_queries,
+            select=", ".join([self.identifier_field, self.title_field, self.content_field])
+        )
+        return search_results
+
+    async def search(self, query: str) -> list[dict[str, Any]]:
+        # The title is only used by report_grounding, which gets it from the session's chunk store
+        return await self._docs(await self._query(query))
+
+    async def scored_search(self, query: str) -> list[tuple[float, dict[str, Any]]]:
+        results = [r async for r in await self._query(query)]
+        if self.semantic_configuration:
+            # The semantic ranker scores from 0 to 4 on the same scale for every index
+            scores = [(r.get("@search.reranker_score") or 0.0) / 4 for r in results]
+        elif self.use_vector_query:
+            # Hybrid scores are the reciprocal rank fusion of the text and vector rankings (k = 60),
+            # a chunk first in both gets 2/61
+            scores = [min(r["@search.score"] * 61 / 2, 1.0) for r in results]
+        else:
+            # BM25 scores depend on the index's statistics, only their ratio to the best one compares
+            best = max((r["@search.score"] for r in results), default=1.0) or 1.0
+            scores = [r["@search.score"] / best for r in results]
+        return [(score, self._doc(r)) for score, r in zip(scores, results)]
+
+    async def get(self, chunk_ids: list[str]) -> list[dict[str, Any]]:
+        list = " OR ".join(chunk_ids)
+        # Use search instead of filter to align with how detailt integrated vectorization indexes
+        # are generated, where chunk_id is searchable with a keyword tokenizer, not filterable 
+        search_results = await self.search_client.search(search_text=list, 
+                                                         search_fields=[self.identifier_field], 
+                                                         select=[self.identifier_field, self.title_field, self.content_field], 
+                                                         top=len(chunk_ids), 
+                                                         query_type="full")
+
+        # If your index has a key field that's filterable but not searchable and with the keyword analyzer, you can 
+        # use a filter instead (and you can remove the regex check in _report_grounding_tool, just ensure you escape single quotes)
+        # search_results = await self.search_client.search(filter=f"search.in(chunk_id, '{list}')", select=["chunk_id", "title", "chunk"])
+        return await self._docs(search_results)
+
+class ShardedSearchBackend(SearchBackend):
+    # Searches a knowledge base split across several indexes (by document family, for instance), each
+    # with a smaller vector graph than one index holding everything. A query goes to the shards whose
+    # routing keywords it contains and the ones without keywords, or to all of them when it contains
+    # none. The shards are searched concurrently and their results merged by normalized score
+    # into the top results overall.
+    shards: dict[str, SearchBackend]
+    routes: dict[str, set[str]]
+    top: int
+
+    def __init__(self, shards: dict[str, SearchBackend], routes: Optional[dict[str, set[str]]] = None, top: int = 5):
+        self.shards = shards
+        self.routes = {name: {k.lower() for k in keywords} for name, keywords in (routes or {}).items() if len(keywords) > 0}
+        self.top = top
+        self.scope = ("shards", tuple((name, shard.scope) for name, shard in shards.items()),
+                      tuple((name, tuple(sorted(keywords))) for name, keywords in sorted(self.routes.items())))
+
+    def route(self, query: str) -> list[str]:
+        words = query_words(query)
+        # Keywords match words starting with them, "benefit" also routes "benefits"
+        matched = {name for name, keywords in self.routes.items() if any(word.startswith(keyword) for word in words for keyword in keywords)}
+        if len(matched) == 0:
+            return list(self.shards)
+        return [name for name in self.shards if name in matched or name not in self.routes]
+
+    async def _gather(self, names: list[str], request: Callable[[SearchBackend], Awaitable[list[Any]]]) -> list[list[Any]]:
+        # A shard that fails only loses its results, unless they all do
+        results = await asyncio.gather(*(request(self.shards[name]) for name in names), return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, BaseException):
+                _shard_errors.inc(index=name)
+                logger.warning("Search index shard %s failed: %s", name, result)
+        answered = [r for r in results if not isinstance(r, BaseException)]
+        if len(answered) == 0:
+            raise results[0]
+        return answered
+
+    async def scored_search(self, query: str) -> list[tuple[float, dict[str, Any]]]:
+        names = self.route(query)
+        _shards_searched.observe(len(names))
+        rankings = await self._gather(names, lambda shard: shard.scored_search(query))
+        merged: dict[str, tuple[float, dict[str, Any]]] = {}
+        for ranking in rankings:
+            for score, doc in ranking:
+                if doc["chunk_id"] not in merged or merged[doc["chunk_id"]][0] < score:
+                    merged[doc["chunk_id"]] = (score, doc)
+        return sorted(merged.values(), key=lambda scored: -scored[0])[:self.top]
+
+    async def search(self, query: str) -> list[dict[str, Any]]:
+        return [doc for _, doc in await self.scored_search(query)]
+
+    async def get(self, chunk_ids: list[str]) -> list[dict[str, Any]]:
+        # Any shard could have the chunks
+        found = {}
+        for docs in await self._gather(list(self.shards), lambda shard: shard.get(chunk_ids)):
+            for doc in docs:
+                found.setdefault(doc["chunk_id"], doc)
+        return list(found.values())
+
+def parse_shard_routes(value: str) -> dict[str, set[str]]:
+    # "benefits:benefit|dental|vision,handbook:policy|vacation,roles" is three indexes, the first two
+    # only searched for queries with one of their keywords
+    routes = {}
+    for entry in value.split(","):
+        name, _, keywords = entry.strip().partition(":")
+        if name:
+            routes[name] = {k.strip() for k in keywords.split("|") if k.strip()}
+    return routes
+
+async def _search(
+    backend: SearchBackend,
+    cache: Optional[SearchCache],
+    semantic_cache: Optional[SemanticCache],
+    hedger: Optional[Hedger],
+    query: str) -> list[dict[str, Any]]:
+    search = functools.partial(backend.search, query)
+    if hedger is not None:
+        # Only requests that actually go to the backend get hedged, not the ones the caches answer
+        search = functools.partial(hedger.run, search)
+    if semantic_cache is not None:
+        # Exact repeats are answered by the cache below, paraphrases of an earlier query by this one
+        search = functools.partial(semantic_cache.get_or_search, query, backend.scope, search)
+    if cache is None:
+        return await search()
+    # Everything that changes the results is part of the key, so differently configured tools can share a cache
+    return await cache.get_or_search(SearchCache.key(query, scope=backend.scope), search)
+
+class _Speculation:
+    words: set[str]
+    task: asyncio.Task
+
+    def __init__(self, words: set[str], task: asyncio.Task):
+        self.words = words
+        self.task = task
+
+def _prefetch_search(lookup: Callable[[str], Awaitable[list[dict[str, Any]]]], transcript: str, rt_session: RTSession) -> None:
+    # Searches for what the caller just said while the model is still working out its search query.
+    # Short utterances ("yes", "thanks") aren't worth a search.
+    words = query_words(transcript)
+    if len(words) < 2:
+        return
+
+    async def speculate() -> Optional[list[dict[str, Any]]]:
+        try:
+            return await lookup(transcript)
+        except Exception:
+            logger.warning("Speculative search for '%s' failed", transcript, exc_info=True)
+            return None
+    speculations = rt_session.tool_state.setdefault("speculations", deque(maxlen=3))
+    speculations.append(_Speculation(words, rt_session.create_task(speculate())))
+    _speculative_searches.inc(result="started")
+
+async def _speculated(query: str, rt_session: RTSession, threshold: float) -> Optional[list[dict[str, Any]]]:
+    # Results of a speculative search for a transcript that contains enough of the model's query, the
+    # model usually searches for a condensed version of what the caller said
+    words = query_words(query)
+    for speculation in reversed(rt_session.tool_state.get("speculations", ())):
+        if len(words) == 0 or len(words & speculation.words) / len(words) < threshold:
+            continue
+        # Shielded, the search stays useful to later calls if this one times out
+        docs = await asyncio.shield(speculation.task)
+        if docs is not None:
+            _speculative_searches.inc(result="used")
+            return docs
+    return None
+
+async def _fan_out(lookup: Callable[[str], Awaitable[list[dict[str, Any]]]], max_queries: int, query: str) -> list[dict[str, Any]]:
+    # Searches for every part of a question about several things at once, so a single tool call finds
+    # what the model would otherwise look up one search call (and one model round trip) at a time
+    queries = split_query(query, max_queries)
+    _subqueries.observe(len(queries))
+    if len(queries) == 1:
+        return await lookup(query)
+    results = await asyncio.gather(*(lookup(q) for q in queries), return_exceptions=True)
+    rankings = [r for r in results if not isinstance(r, BaseException)]
+    if len(rankings) == 0:
+        raise results[0]
+    if len(rankings) < len(results):
+        logger.warning("%d of %d searches for '%s' failed", len(results) - len(rankings), len(results), query)
+    return fuse_rankings(rankings)
+
 async def _search_tool(
-    search_client: SearchClient, 
-    semantic_configuration: str | None,
-    identifier_field: str,
-    content_field: str,
-    embedding_field: str,
-    use_vector_query: bool,
-    args: Any) -> ToolResult:
+    lookup: Callable[[str], Awaitable[list[dict[str, Any]]]],
+    speculation_threshold: float,
+    token_budget: Optional[int],
+    args: Any,
+    rt_session: RTSession) -> ToolResult:
     print(f"Searching for '{args['query']}' in the knowledge base.")
-    # Hybrid query using Azure AI Search with (optional) Semantic Ranker
-    vector_queries = []
-    if use_vector_query:
-        vector_queries.append(VectorizableTextQuery(text=args['query'], k_nearest_neighbors=50, fields=embedding_field))
-    search_results = await search_client.search(
-        search_text=args["query"], 
-        query_type="semantic" if semantic_configuration else "simple",
-        semantic_configuration_name=semantic_configuration,
-        top=5,
-        vector_queries=vector_queries,
-        select=", ".join([identifier_field, content_field])
-    )
-    result = ""
-    async for r in search_results:
-        result += f"[{r[identifier_field]}]: {r[content_field]}\n-----\n"
+    docs = await _speculated(args["query"], rt_session, speculation_threshold)
+    if docs is None:
+        try:
+            docs = await lookup(args["query"])
+        except asyncio.TimeoutError:
+            # Past the search deadline, the model can tell the caller instead of leaving them in silence
+            return ToolResult("No results, the knowledge base didn't answer in time.", ToolResultDirection.TO_SERVER)
+    _chunk_store(rt_session).add(docs)
+    # The session keeps the whole chunks for report_grounding, the model may only get the relevant parts
+    result = format_results(docs) if token_budget is None else compress_results(args["query"], docs, token_budget)
     return ToolResult(result, ToolResultDirection.TO_SERVER)
 
 KEY_PATTERN = re.compile(r'^[a-zA-Z0-9_=\-]+$')
 
 # TODO: move from sending all chunks used for grounding eagerly to only sending links to 
 # the original content in storage, it'll be more efficient overall
-async def _report_grounding_tool(search_client: SearchClient, identifier_field: str, title_field: str, content_field: str, args: Any) -> None:
+async def _report_grounding_tool(backend: SearchBackend, hedger: Optional[Hedger], args: Any, rt_session: RTSession) -> None:
     sources = [s for s in args["sources"] if KEY_PATTERN.match(s)]
-    list = " OR ".join(sources)
-    print(f"Grounding source: {list}")
-    # Use search instead of filter to align with how detailt integrated vectorization indexes
-    # are generated, where chunk_id is searchable with a keyword tokenizer, not filterable 
-    search_results = await search_client.search(search_text=list, 
-                                                search_fields=[identifier_field], 
-                                                select=[identifier_field, title_field, content_field], 
-                                                top=len(sources), 
-                                                query_type="full")
-    
-    # If your index has a key field that's filterable but not searchable and with the keyword analyzer, you can 
-    # use a filter instead (and you can remove the regex check above, just ensure you escape single quotes)
-    # search_results = await search_client.search(filter=f"search.in(chunk_id, '{list}')", select=["chunk_id", "title", "chunk"])
-
-    docs = []
-    async for r in search_results:
-        docs.append({"chunk_id": r[identifier_field], "title": r[title_field], "chunk": r[content_field]})
-    return ToolResult({"sources": docs}, ToolResultDirection.TO_CLIENT)
-
-def attach_rag_tools(rtmt: RTMiddleTier,
-    credentials: AzureKeyCredential | DefaultAzureCredential,
+    # The model cites chunks the search tool just returned, those are usually still in the session's store
+    store = _chunk_store(rt_session)
+    missing = [s for s in sources if store.get(s) is None]
+    _grounding_chunks.inc(len(sources) - len(missing), source="session")
+    if len(missing) > 0:
+        _grounding_chunks.inc(len(missing), source="index")
+        print(f"Grounding source: {' OR '.join(missing)}")
+        get = functools.partial(backend.get, missing)
+        try:
+            store.add(await (get() if hedger is None else hedger.run(get)))
+        except asyncio.TimeoutError:
+            # The sources the session already had are better than none
+            logger.warning("Grounding sources %s didn't arrive in time", missing)
+
+    docs = [store.get(s) for s in dict.fromkeys(sources)]
+    return ToolResult({"sources": [doc for doc in docs if doc is not None]}, ToolResultDirection.TO_CLIENT)
+
+def attach_rag_tools(rtmt: RTMiddleTierBase,
+    credentials: AzureKeyCredential | AsyncTokenManager | DefaultAzureCredential,
     search_endpoint: str, search_index: str,
     semantic_configuration: str | None,
     identifier_field: str,
     content_field: str,
     embedding_field: str,
     title_field: str,
-    use_vector_query: bool
+    use_vector_query: bool,
+    cache: Optional[SearchCache] = None,
+    semantic_cache: Optional[SemanticCache] = None,
+    speculation_threshold: float = 0.75,
+    backend: Optional[SearchBackend] = None,
+    token_budget: Optional[int] = None,
+    max_subqueries: int = 1,
+    hedge_quantile: Optional[float] = None,
+    search_deadline: Optional[float] = None,
+    max_hedge_rate: float = 0.1,
+    query_embedder: Optional[Embedder] = None,
+    search_shards: Optional[dict[str, set[str]]] = None
     ) -> None:
-    if not isinstance(credentials, AzureKeyCredential):
-        credentials.get_token("https://search.azure.com/.default") # warm this up before we start getting requests
-    search_client = SearchClient(search_endpoint, search_index, credentials, user_agent="RTMiddleTier")
+    # The Azure AI Search settings are ignored when another backend is passed
+    if backend is None:
+        if not isinstance(credentials, (AzureKeyCredential, AsyncTokenManager)):
+            # The async search client would call a synchronous credential on the event loop
+            credentials = AsyncTokenManager(credentials)
+        def index_backend(index: str) -> AzureSearchBackend:
+            search_client = SearchClient(search_endpoint, index, credentials, user_agent="RTMiddleTier", transport=client_sessions().transport())
+            scope = (search_endpoint, index, semantic_configuration, identifier_field, content_field, embedding_field, title_field, use_vector_query)
+            # query_embedder has to use the same model as the index's vectorizer, the results are then the same either way
+            return AzureSearchBackend(search_client, semantic_configuration, identifier_field, content_field, embedding_field, title_field, use_vector_query, scope, query_embedder)
+        if search_shards:
+            # The shards have the same fields, search_index is ignored
+            backend = ShardedSearchBackend({index: index_backend(index) for index in search_shards}, search_shards)
+        else:
+            backend = index_backend(search_index)
+
+    search_hedger = grounding_hedger = None
+    if hedge_quantile is not None or search_deadline is not None:
+        search_hedger = Hedger("search", hedge_quantile, search_deadline, max_hedge_rate)
+        grounding_hedger = Hedger("grounding", hedge_quantile, search_deadline, max_hedge_rate)
+
+    lookup = functools.partial(_search, backend, cache, semantic_cache, search_hedger)
+    search_lookup = lookup if max_subqueries <= 1 else functools.partial(_fan_out, lookup, max_subqueries)
+
+    rtmt.tools["search"] = Tool(schema=_search_tool_schema, pass_session=True,
+                                target=lambda args, rt_session: _search_tool(search_lookup, speculation_threshold, token_budget, args, rt_session),
+                                prefetch=lambda transcript, rt_session: _prefetch_search(lookup, transcript, rt_session))
+    rtmt.tools["report_grounding"] = Tool(schema=_grounding_tool_schema, pass_session=True, target=lambda args, rt_session: _report_grounding_tool(backend, grounding_hedger, args, rt_session))
+
+def watch_search_indexer(
+    credentials: AzureKeyCredential | AsyncTokenManager | DefaultAzureCredential,
+    search_endpoint: str,
+    indexer_name: str | list[str],
+    interval: float = 60.0
+    ) -> IndexWatcher:
+    # Notices when the indexer (the one setup_intvect.py creates is named after the index) finishes
+    # another run, so cached results can be dropped and re-indexed content is searched right away.
+    # With a list, when any of the indexers (one per shard) does.
+    if not isinstance(credentials, (AzureKeyCredential, AsyncTokenManager)):
+        credentials = AsyncTokenManager(credentials)
+    indexer_client = SearchIndexerClient(search_endpoint, credentials, user_agent="RTMiddleTier", transport=client_sessions().transport())
+    indexer_names = [indexer_name] if isinstance(indexer_name, str) else indexer_name
+    missing: set[str] = set()
+
+    async def last_run(name: str):
+        try:
+            status = await indexer_client.get_indexer_status(name)
+        except ResourceNotFoundError:
+            if name not in missing:
+                logger.info("Search indexer %s not found, cached search results will only expire", name)
+                missing.add(name)
+            return None
+        last_result = status.last_result
+        return None if last_result is None else (last_result.status, last_result.end_time)
+
+    async def indexer_version():
+        return tuple(await asyncio.gather(*(last_run(name) for name in indexer_names)))
 
-    rtmt.tools["search"] = Tool(schema=_search_tool_schema, target=lambda args: _search_tool(search_client, semantic_configuration, identifier_field, content_field, embedding_field, use_vector_query, args))
-    rtmt.tools["report_grounding"] = Tool(schema=_grounding_tool_schema, target=lambda args: _report_grounding_tool(search_client, identifier_field, title_field, content_field, args))
+    return IndexWatcher(indexer_version, interval)
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from collections.abc import Awaitable
+from typing import Any, Callable, Optional, TypeVar
+from urllib.parse import urlparse
+
+import aiohttp
+
+import metrics
+from admission import AdmissionRejected
+
+logger = logging.getLogger("voicerag")
+
+_sessions = metrics.counter("voicerag_backend_sessions_total", "Sessions routed to each realtime backend")
+_in_flight = metrics.gauge("voicerag_backend_in_flight", "Sessions currently open on each realtime backend")
+_failures = metrics.counter("voicerag_backend_failures_total", "Failed upstream handshakes by realtime backend and reason, each one fails over to the next backend")
+
+T = TypeVar("T")
+
+def _average(current: Optional[float], sample: float, alpha: float) -> float:
+    return sample if current is None else current + alpha * (sample - current)
+
+class RealtimeBackend:
+    # One Azure OpenAI realtime deployment, possibly in another region. Keeps the measurements the
+    # selector routes on: moving averages of the handshake and first audio latency, the sessions
+    # currently open and the recent handshake failures.
+    endpoint: str
+    deployment: str
+    key: Optional[str]
+    name: str
+    in_flight: int
+    sessions: int
+    handshake_latency: Optional[float]
+    first_audio_latency: Optional[float]
+    cooldown_until: float
+    consecutive_failures: int
+    # Weight of the newest sample in the moving averages
+    alpha: float = 0.2
+
+    def __init__(self, endpoint: str, deployment: str, key: Optional[str] = None, name: Optional[str] = None):
+        self.endpoint = endpoint
+        self.deployment = deployment
+        # Falls back to the middle tier's credentials when not set
+        self.key = key
+        self.name = name or f"{urlparse(endpoint).hostname}/{deployment}"
+        self.in_flight = 0
+        self.sessions = 0
+        self.handshake_latency = None
+        self.first_audio_latency = None
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self._failures: deque[float] = deque()
+
+    def handshake_succeeded(self, seconds: float) -> None:
+        self.handshake_latency = _average(self.handshake_latency, seconds, self.alpha)
+        self.consecutive_failures = 0
+
+    def first_audio(self, seconds: float) -> None:
+        self.first_audio_latency = _average(self.first_audio_latency, seconds, self.alpha)
+
+    def recent_failures(self, window: float, now: float) -> int:
+        while len(self._failures) > 0 and self._failures[0] < now - window:
+            self._failures.popleft()
+        return len(self._failures)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "in_flight": self.in_flight,
+            "sessions": self.sessions,
+            "handshake_latency": self.handshake_latency,
+            "first_audio_latency": self.first_audio_latency,
+            "cooling_down": self.cooldown_until > time.monotonic(),
+            "recent_failures": len(self._failures)
+        }
+
+class BackendSelector:
+    # Picks the realtime backend for each new session. Backends are scored by the latency a caller would
+    # see (handshake plus first audio, as exponentially weighted moving averages), plus in_flight_cost
+    # seconds per session already open on them and failure_cost seconds per handshake failure in the
+    # last failure_window seconds, and the lowest score wins. A backend nobody has measured yet scores
+    # as fast as the best one, so new backends get tried. Latencies are only measured on the sessions a
+    # backend gets, so a backend that was slow is tried again once in_flight_cost makes up the difference.
+    #
+    # A backend whose handshake fails (a 429, an error status, or no connection at all) cools down and
+    # isn't picked until the Retry-After it sent, or an exponential backoff, has passed. The session
+    # fails over to the next best backend. The selector is meant to be shared by both middle tiers.
+    backends: list[RealtimeBackend]
+    in_flight_cost: float
+    failure_cost: float
+    failure_window: float
+    base_cooldown: float
+    max_cooldown: float
+
+    def __init__(self,
+                 backends: list[RealtimeBackend],
+                 alpha: float = 0.2,
+                 in_flight_cost: float = 0.01,
+                 failure_cost: float = 0.5,
+                 failure_window: float = 60.0,
+                 base_cooldown: float = 5.0,
+                 max_cooldown: float = 120.0):
+        if len(backends) == 0:
+            raise ValueError("At least one realtime backend is required")
+        self.backends = backends
+        for backend in backends:
+            backend.alpha = alpha
+        self.in_flight_cost = in_flight_cost
+        self.failure_cost = failure_cost
+        self.failure_window = failure_window
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    def _score(self, backend: RealtimeBackend, now: float) -> float:
+        handshakes = [b.handshake_latency for b in self.backends if b.handshake_latency is not None]
+        first_audios = [b.first_audio_latency for b in self.backends if b.first_audio_latency is not None]
+        handshake = backend.handshake_latency if backend.handshake_latency is not None else min(handshakes, default=0.0)
+        first_audio = backend.first_audio_latency if backend.first_audio_latency is not None else min(first_audios, default=0.0)
+        return (handshake + first_audio
+                + self.in_flight_cost * backend.in_flight
+                + self.failure_cost * backend.recent_failures(self.failure_window, now))
+
+    def choose(self, exclude: Optional[set[str]] = None) -> RealtimeBackend:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if exclude is None or b.name not in exclude] or self.backends
+        available = [b for b in candidates if b.cooldown_until <= now]
+        if len(available) == 0:
+            # Everything is cooling down, the one that gets out of it first is the best bet
+            return min(candidates, key=lambda b: b.cooldown_until)
+        # Ties go to the backend that has had the fewest sessions, which is how unmeasured ones get tried
+        return min(available, key=lambda b: (self._score(b, now), b.sessions))
+
+    async def connect(self, connect: Callable[[RealtimeBackend], Awaitable[T]]) -> tuple[T, RealtimeBackend]:
+        # Connects to the best backend, failing over to the next one each time a handshake fails or
+        # admission control turns the session away
+        tried: set[str] = set()
+        while True:
+            backend = self.choose(tried)
+            try:
+                return await connect(backend), backend
+            except AdmissionRejected as e:
+                # The backend is working, just full, so it isn't cooled down
+                tried.add(backend.name)
+                if len(tried) >= len(self.backends):
+                    raise
+                logger.warning("Realtime backend %s has no room (%s), failing over", backend.name, e)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.failed(backend, e)
+                tried.add(backend.name)
+                if len(tried) >= len(self.backends):
+                    raise
+                logger.warning("Realtime backend %s failed (%s), failing over", backend.name, e)
+
+    def failed(self, backend: RealtimeBackend, error: Exception) -> None:
+        now = time.monotonic()
+        backend._failures.append(now)
+        backend.consecutive_failures += 1
+        cooldown = min(self.base_cooldown * 2 ** (backend.consecutive_failures - 1), self.max_cooldown)
+        reason = "connect"
+        if isinstance(error, aiohttp.WSServerHandshakeError):
+            reason = str(error.status)
+            retry_after = (error.headers or {}).get("Retry-After")
+            if retry_after is not None and retry_after.isdigit():
+                cooldown = min(float(retry_after), self.max_cooldown)
+        backend.cooldown_until = now + cooldown
+        _failures.inc(backend=backend.name, reason=reason)
+
+    def session_started(self, backend: RealtimeBackend) -> None:
+        backend.in_flight += 1
+        backend.sessions += 1
+        _sessions.inc(backend=backend.name)
+        _in_flight.set(backend.in_flight, backend=backend.name)
+
+    def session_ended(self, backend: RealtimeBackend) -> None:
+        backend.in_flight -= 1
+        _in_flight.set(backend.in_flight, backend=backend.name)
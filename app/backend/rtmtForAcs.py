@@ -1,85 +1,92 @@
 import asyncio
-import json
+import base64
+import functools
 import logging
+import math
+import sys
+from array import array
 from dataclasses import dataclass
-from enum import Enum
-from typing import Any, Callable, Optional
+from typing import Optional
 
-import aiohttp
 from aiohttp import WSMessage, web
-from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 
-logger = logging.getLogger("voicerag_acs")
-
-class ToolResultDirection(Enum):
-    TO_SERVER = 1
-    TO_CLIENT = 2
-
-class ToolResult:
-    text: str
-    destination: ToolResultDirection
-
-    def __init__(self, text: str, destination: ToolResultDirection):
-        self.text = text
-        self.destination = destination
-
-    def to_text(self) -> str:
-        if self.text is None:
-            return ""
-        return self.text if isinstance(self.text, str) else json.dumps(self.text)
-
-class Tool:
-    target: Callable[..., ToolResult]
-    schema: Any
+import codec
+from admission import AdmissionController
+from audioconvert import REALTIME_SAMPLE_RATES, call_audio_converters
+from rtqueue import AudioFrameFormat, FrameQueue
+from rtrouter import MessageRouter, extract_string_field
+from rtsession import RTMiddleTierBase, RTSession
 
-    def __init__(self, target: Any, schema: Any):
-        self.target = target
-        self.schema = schema
-
-class RTToolCall:
-    tool_call_id: str
-    previous_id: str
-
-    def __init__(self, tool_call_id: str, previous_id: str):
-        self.tool_call_id = tool_call_id
-        self.previous_id = previous_id
+logger = logging.getLogger("voicerag_acs")
 
-class RTMiddleTierForAcs:
-    endpoint: str
-    deployment: str
-    key: Optional[str] = None
-    
-    # Tools are server-side only for now, though the case could be made for client-side tools
-    # in addition to server-side tools that are invisible to the client
-    tools: dict[str, Tool] = {}
-
-    # Server-enforced configuration, if set, these will override the client's configuration
-    # Typically at least the model name and system message will be set by the server
-    model: Optional[str] = None
-    system_message: Optional[str] = None
-    temperature: Optional[float] = None
-    max_tokens: Optional[int] = None
-    disable_audio: Optional[bool] = None
-    voice_choice: Optional[str] = None
-    api_version: str = "2024-10-01-preview"
-    _tools_pending = {}
-    _token_provider = None
-
-    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | DefaultAzureCredential, voice_choice: Optional[str] = None):
-        self.endpoint = endpoint
-        self.deployment = deployment
-        self.voice_choice = voice_choice
-        if voice_choice is not None:
-            logger.info("Realtime voice choice set to %s", voice_choice)
-        if isinstance(credentials, AzureKeyCredential):
-            self.key = credentials.key
-        else:
-            self._token_provider = get_bearer_token_provider(credentials, "https://cognitiveservices.azure.com/.default")
-            self._token_provider() # Warm up during startup so we have a token cached when the first request arrives
-
-    async def _process_message_to_client(self, msg: str, client_ws: web.WebSocketResponse, server_ws: web.WebSocketResponse) -> Optional[str]:
-        message = json.loads(msg.data)
+# Only events the middle tier rewrites, acts on or logs get parsed. Audio deltas are re-wrapped for ACS
+# straight from the raw text and everything else goes through as-is.
+_to_client_router = MessageRouter(
+    inspect={"session.created", "response.output_item.added", "conversation.item.created", "response.output_item.done", "response.done",
+             "error", "input_audio_buffer.cleared", "input_audio_buffer.speech_started", "response.audio_transcript.done",
+             "conversation.item.input_audio_transcription.completed", "conversation.item.input_audio_transcription.failed"},
+    drop={"response.function_call_arguments.delta", "response.function_call_arguments.done"})
+_to_server_router = MessageRouter(inspect={"AudioData"}, drop={"AudioMetadata"}, key="kind")
+
+@functools.cache
+def _hold_tone(sample_rate: int = 24000, frequency: float = 440.0, duration: float = 0.3, amplitude: float = 0.08) -> str:
+    # A short, quiet beep in the PCM mono format ACS streams, faded in and out so it doesn't click
+    count = int(sample_rate * duration)
+    fade = int(sample_rate * 0.02)
+    samples = array("h", (int(32767 * amplitude * min(1.0, i / fade, (count - i) / fade) * math.sin(2 * math.pi * frequency * i / sample_rate))
+                          for i in range(count)))
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return base64.b64encode(samples.tobytes()).decode("ascii")
+
+class RTMiddleTierForAcs(RTMiddleTierBase):
+    tier: str = "acs"
+    to_client_audio: AudioFrameFormat = AudioFrameFormat("Kind", "AudioData", "Data")
+    logger: logging.Logger = logger
+    # Seconds between the beeps callers hear while waiting for admission
+    hold_interval: float = 3.0
+    # Whether tools get to prefetch from the caller's transcript, see use_speculative_tool_calls
+    speculative_tool_calls: bool = False
+    # Sample rate of the PCM audio ACS streams and the realtime API's audio format, see use_audio_formats
+    acs_sample_rate: int = 24000
+    realtime_audio_format: str = "pcm16"
+
+    def use_speculative_tool_calls(self):
+        # The caller's speech is transcribed anyway, tools with a prefetch (the search tool) start working
+        # on it while the model is still deciding what to call, which hides their latency behind its own
+        self.speculative_tool_calls = True
+
+    def use_audio_formats(self, acs_sample_rate: int, realtime_audio_format: str):
+        # ACS streams 16 or 24 kHz PCM, the realtime API takes 24 kHz PCM (pcm16) or 8 kHz G.711
+        # (g711_ulaw, g711_alaw). Audio is converted in between when they differ, which lets calls
+        # stream 16 kHz, a third less bandwidth, at the cost of some CPU per call.
+        if realtime_audio_format not in REALTIME_SAMPLE_RATES:
+            raise ValueError(f"Unknown realtime audio format {realtime_audio_format}, expected one of {', '.join(REALTIME_SAMPLE_RATES)}")
+        self.acs_sample_rate = acs_sample_rate
+        self.realtime_audio_format = realtime_audio_format
+
+    def _prepare_session(self, rt_session: RTSession) -> None:
+        converters = call_audio_converters(self.acs_sample_rate, self.realtime_audio_format)
+        if converters is not None:
+            rt_session.audio_in, rt_session.audio_out = converters
+
+    async def _process_message_to_client(self, rt_session: RTSession, msg: str, to_client: FrameQueue, to_server: FrameQueue) -> Optional[str]:
+        message_type = _to_client_router.sniff(msg.data)
+        if message_type == "input_audio_buffer.speech_stopped":
+            rt_session.speech_stopped()
+        if message_type == "response.audio.delta":
+            rt_session.audio_delta()
+            delta = extract_string_field(msg.data, "delta")
+            if delta is not None:
+                if rt_session.audio_out is not None:
+                    delta = rt_session.audio_out.convert(delta)
+                return self.receive_audio_for_outbound_message(delta)
+        elif _to_client_router.is_passthrough(message_type):
+            return msg.data
+        elif _to_client_router.is_dropped(message_type):
+            return None
+
+        message = codec.loads(msg.data)
         updated_message = msg.data
         if message is not None:
             match message["type"]:
@@ -90,14 +97,14 @@ class RTMiddleTierForAcs:
                     # tools, this will need updating
                     session["instructions"] = ""
                     session["tools"] = []
-                    session["voice"] = self.voice_choice
+                    session["voice"] = rt_session.config.voice_choice
                     session["tool_choice"] = "none"
                     session["max_response_output_tokens"] = None
-                    updated_message = json.dumps(message)
+                    updated_message = codec.dumps(message)
 
                     # update the session with the new session
                     logger.info("Sending session.update message to OpenAI's realtime socket connection.")
-                    await server_ws.send_str(self._create_session_update_message(message))
+                    await to_server.put(self._create_session_update_message(rt_session, message))
 
                 case "response.output_item.added":
                     if "item" in message and message["item"]["type"] == "function_call":
@@ -106,8 +113,7 @@ class RTMiddleTierForAcs:
                 case "conversation.item.created":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        if item["call_id"] not in self._tools_pending:
-                            self._tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
+                        rt_session.add_tool_call(item["call_id"], message["previous_item_id"])
                         updated_message = None
                     elif "item" in message and message["item"]["type"] == "function_call_output":
                         updated_message = None
@@ -121,35 +127,18 @@ class RTMiddleTierForAcs:
                 case "response.output_item.done":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        tool_call = self._tools_pending[message["item"]["call_id"]]
-                        tool = self.tools[item["name"]]
-                        args = item["arguments"]
-                        result = await tool.target(json.loads(args))
-                        await server_ws.send_json({
-                            "type": "conversation.item.create",
-                            "item": {
-                                "type": "function_call_output",
-                                "call_id": item["call_id"],
-                                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
-                            }
-                        })
-                        if result.destination == ToolResultDirection.TO_CLIENT:
-                            # TODO: this will break clients that don't know about this extra message, rewrite 
-                            # this to be a regular text message with a special marker of some sort
-                            await client_ws.send_json({
-                                "type": "extension.middle_tier_tool_response",
-                                "previous_item_id": tool_call.previous_id,
-                                "tool_name": item["name"],
-                                "tool_result": result.to_text()
-                            })
+                        tool_call = rt_session.tools_pending[message["item"]["call_id"]]
+                        tool_call.response_id = message.get("response_id")
+                        # Run the tool in the background so audio and transcripts keep flowing while it works
+                        rt_session.start_tool_call(tool_call, self._run_tool(rt_session, tool_call, item, to_client, to_server))
                         updated_message = None
 
                 case "response.done":
-                    if len(self._tools_pending) > 0:
-                        self._tools_pending.clear() # Any chance tool calls could be interleaved across different outstanding responses?
-                        await server_ws.send_json({
-                            "type": "response.create"
-                        })
+                    tool_calls = rt_session.complete_response(message.get("response", {}).get("id"))
+                    if len(tool_calls) > 0:
+                        rt_session.create_task(self._create_response_after_tools(rt_session, tool_calls, to_server))
+                    rt_session.response_done(final=len(tool_calls) == 0)
+                    rt_session.record_usage(message.get("response", {}).get("usage"))
                     if "response" in message:
                         replace = False
                         for i, output in enumerate(reversed(message["response"]["output"])):
@@ -157,7 +146,7 @@ class RTMiddleTierForAcs:
                                 message["response"]["output"].pop(i)
                                 replace = True
                         if replace:
-                            updated_message = json.dumps(message)                        
+                            updated_message = codec.dumps(message)                        
 
                 case "error":
                     print(f"  Error: {message['error']}")
@@ -167,12 +156,21 @@ class RTMiddleTierForAcs:
                     pass
                 case "input_audio_buffer.speech_started":
                     print(f"Voice activity detection started at {message['audio_start_ms']} [ms]")
+                    # The caller is talking over the assistant, audio that hasn't gone out yet is stale
+                    if rt_session.to_client_queue is not None:
+                        rt_session.to_client_queue.clear_audio()
+                    if rt_session.audio_out is not None:
+                        rt_session.audio_out.reset()
                     updated_message = self.stop_audio_message()
                     pass
                 case "input_audio_buffer.speech_stopped":
                     pass
                 case "conversation.item.input_audio_transcription.completed":
                     print(f" User:-- {message['transcript']}")
+                    if self.speculative_tool_calls:
+                        for tool in rt_session.config.tools.values():
+                            if tool.prefetch is not None:
+                                tool.prefetch(message["transcript"], rt_session)
                 case "conversation.item.input_audio_transcription.failed":
                     print(f"  Error: {message['error']}")
                 case "response.done":
@@ -183,7 +181,10 @@ class RTMiddleTierForAcs:
                 case "response.audio_transcript.done":
                     print(f" AI:-- {message['transcript']}")
                 case "response.audio.delta":
-                    updated_message = self.receive_audio_for_outbound_message(message["delta"])
+                    delta = message["delta"]
+                    if rt_session.audio_out is not None:
+                        delta = rt_session.audio_out.convert(delta)
+                    updated_message = self.receive_audio_for_outbound_message(delta)
                     pass
                 case _:
                     pass    
@@ -191,33 +192,14 @@ class RTMiddleTierForAcs:
         return updated_message
     
     def stop_audio_message(self):
-        stop_audio_data = {
-            "Kind": "StopAudio",
-            "AudioData": None,
-            "StopAudio": {}
-        }
-
-        json_data = json.dumps(stop_audio_data)
-        return json_data
+        return codec.STOP_AUDIO
 
     def receive_audio_for_outbound_message(self, data):
-        try:
-            data = {
-                "Kind": "AudioData",
-                "AudioData": {
-                        "Data":  data
-                },
-                "StopAudio": None
-            }
+        # base64 never needs escaping, so the envelope is spliced together instead of going through json.dumps
+        return '{"Kind": "AudioData", "AudioData": {"Data": "' + data + '"}, "StopAudio": null}'
 
-            # Serialize the server streaming data
-            serialized_data = json.dumps(data)
-            return serialized_data
-        
-        except Exception as e:
-            print(e)
-
-    def _create_session_update_message(self, message) -> str:
+    def _create_session_update_message(self, rt_session: RTSession, message) -> str:
+        config = rt_session.config
 
         sessionUpdateMessage = {
             "event_id": "update-session-for-acs",
@@ -233,28 +215,41 @@ class RTMiddleTierForAcs:
                 "input_audio_transcription": {
                     "model": "whisper-1"
                 },
-                "tool_choice": "auto" if len(self.tools) > 0 else "none",
-                "tools": [tool.schema for tool in self.tools.values()]
+                "tool_choice": "auto" if len(config.tools) > 0 else "none",
+                "tools": [tool.schema for tool in config.tools.values()]
             }
         }
         session = sessionUpdateMessage["session"]
 
-        if self.system_message is not None:
-            session["instructions"] = self.system_message
-        if self.temperature is not None:
-            session["temperature"] = self.temperature
-        if self.max_tokens is not None:
-            session["max_response_output_tokens"] = self.max_tokens
-        if self.disable_audio is not None:
-            session["disable_audio"] = self.disable_audio
-        if self.voice_choice is not None:
-            session["voice"] = self.voice_choice
-
-        return json.dumps(sessionUpdateMessage)
-
-
-    async def _process_message_to_server(self, msg: WSMessage, ws: web.WebSocketResponse) -> Optional[str]:
-        message = json.loads(msg.data)
+        if config.system_message is not None:
+            session["instructions"] = config.system_message
+        if config.temperature is not None:
+            session["temperature"] = config.temperature
+        if config.max_tokens is not None:
+            session["max_response_output_tokens"] = config.max_tokens
+        if config.disable_audio is not None:
+            session["disable_audio"] = config.disable_audio
+        if config.voice_choice is not None:
+            session["voice"] = config.voice_choice
+        if self.realtime_audio_format != "pcm16":
+            session["input_audio_format"] = self.realtime_audio_format
+            session["output_audio_format"] = self.realtime_audio_format
+
+        return codec.dumps(sessionUpdateMessage)
+
+
+    async def _process_message_to_server(self, rt_session: RTSession, msg: WSMessage, ws: web.WebSocketResponse) -> Optional[str]:
+        kind = _to_server_router.sniff(msg.data)
+        if kind == "AudioData":
+            audio_data = extract_string_field(msg.data, "data")
+            if audio_data is not None:
+                if rt_session.audio_in is not None:
+                    audio_data = rt_session.audio_in.convert(audio_data)
+                return '{"type": "input_audio_buffer.append", "audio": "' + audio_data + '"}'
+        elif _to_server_router.is_dropped(kind):
+            return None
+
+        message = codec.loads(msg.data)
         updated_message = msg.data
         # from web:
         # {'type': 'input_audio_buffer.append', 'audio': 'AAA'}
@@ -267,8 +262,10 @@ class RTMiddleTierForAcs:
              match message["kind"]:
                 case "AudioData":
                     audio_data = message["audioData"]["data"]
+                    if rt_session.audio_in is not None:
+                        audio_data = rt_session.audio_in.convert(audio_data)
 
-                    updated_message = json.dumps({
+                    updated_message = codec.dumps({
                         "type": "input_audio_buffer.append",
                         "audio": audio_data
                     })
@@ -280,64 +277,55 @@ class RTMiddleTierForAcs:
             
         
         return updated_message
-        
-
-    async def _forward_messages(self, ws: web.WebSocketResponse):
-        async with aiohttp.ClientSession(base_url=self.endpoint) as session:
-            params = { "api-version": self.api_version, "deployment": self.deployment}
-            headers = {}
-            if "x-ms-client-request-id" in ws.headers:
-                headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
-            if self.key is not None:
-                headers = { "api-key": self.key }
-            else:
-                headers = { "Authorization": f"Bearer {self._token_provider()}" } # NOTE: no async version of token provider, maybe refresh token on a timer?
-            async with session.ws_connect("/openai/realtime", headers=headers, params=params) as target_ws:
-                async def from_client_to_server():
-                    async for msg in ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_server(msg, ws)
-                            if new_msg is not None:
-                                # sending from ACS '{"type": "input_audio_buffer.append", "audio": "+////////v/4//j/9f/6//r//f/7//v//", "_is_azure": true}'
-                                # sending from web '{"type":"input_audio_buffer.append","audio":"AAAAAAAAAAAAAAAAAAAAAAAAAA"}'
-
-                                # this is for debugging - if there's no type in the message, hit a breakpoint
-                                if "type" not in json.loads(new_msg):
-                                    logger.error("No type in message")
-                                    breakpoint()
-
-                                await target_ws.send_str(new_msg)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
-                    
-                    # Means it is gracefully closed by the client then time to close the target_ws
-                    if target_ws:
-                        print("Closing OpenAI's realtime socket connection.")
-                        await target_ws.close()
-                        
-                async def from_server_to_client():
-                    async for msg in target_ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_client(msg, ws, target_ws)
-                            if new_msg is not None:
-                                await ws.send_str(new_msg)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
 
+    async def _hold(self, ws: web.WebSocketResponse, admitted: asyncio.Event):
+        # What a caller hears while waiting for admission: a beep every hold_interval seconds. The caller's
+        # audio from this time is read and thrown away so ACS isn't held up by a socket nobody reads.
+        # Cancelling a websocket read closes the socket, so the reader stops on its own at the first
+        # frame after admission.
+        async def discard():
+            async for _ in ws:
+                if admitted.is_set():
+                    return
+
+        async def beep():
+            message = self.receive_audio_for_outbound_message(_hold_tone(self.acs_sample_rate))
+            while not ws.closed and not admitted.is_set():
+                await ws.send_str(message)
                 try:
-                    await asyncio.gather(from_client_to_server(), from_server_to_client())
-                except ConnectionResetError:
-                    # Ignore the errors resulting from the client disconnecting the socket
+                    await asyncio.wait_for(admitted.wait(), self.hold_interval)
+                except asyncio.TimeoutError:
                     pass
 
-    async def _websocket_handler(self, request: web.Request):
-        ws = web.WebSocketResponse()
-        await ws.prepare(request)
-        await self._forward_messages(ws)
-        return ws
-    
-    def attach_to_app(self, app, path):
-        app.router.add_get(path, self._websocket_handler)
+        await asyncio.gather(discard(), beep())
+
+    async def _admit(self, ws: web.WebSocketResponse, rt_session: RTSession, controller: AdmissionController) -> bool:
+        acquiring = asyncio.create_task(controller.acquire())
+        done, _ = await asyncio.wait([acquiring], timeout=0)
+        if len(done) == 0:
+            admitted = asyncio.Event()
+            holding = asyncio.create_task(self._hold(ws, admitted))
+            try:
+                await asyncio.wait([acquiring, holding], return_when=asyncio.FIRST_COMPLETED)
+                if not acquiring.done():
+                    # The caller hung up while on hold
+                    acquiring.cancel()
+                    await asyncio.gather(acquiring, return_exceptions=True)
+                    return False
+                admitted.set()
+                # ACS streams a frame every 20ms, so this doesn't hold up the call
+                await asyncio.gather(holding, return_exceptions=True)
+            finally:
+                if not holding.done():
+                    holding.cancel()
+                if not acquiring.done():
+                    acquiring.cancel()
+        # Raises AdmissionRejected when this backend has no room, the selector then tries the next one
+        rt_session.admission = acquiring.result()
+        if ws.closed:
+            return False
+        await ws.send_str(self.stop_audio_message())
+        return True
 
 @dataclass
 class Envelope:
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections.abc import Awaitable
+from typing import Callable, Optional
+
+import aiohttp
+
+import metrics
+
+logger = logging.getLogger("voicerag")
+
+_acquire_latency = metrics.histogram("voicerag_upstream_acquire_seconds", "Time to get an upstream realtime websocket for a new session")
+_acquires = metrics.counter("voicerag_upstream_acquire_total", "Upstream realtime websockets handed out, by whether they came from the pool")
+_idle_connections = metrics.gauge("voicerag_upstream_pool_idle", "Pre-warmed upstream realtime websockets waiting for a session")
+
+class _PooledConnection:
+    ws: aiohttp.ClientWebSocketResponse
+    created_at: float
+    # The x-ms-client-request-id the connection was opened with, which is what Azure OpenAI logs it under
+    request_id: str
+
+    def __init__(self, ws: aiohttp.ClientWebSocketResponse, request_id: str):
+        self.ws = ws
+        self.created_at = time.monotonic()
+        self.request_id = request_id
+
+class RealtimeConnectionPool:
+    # Keeps a few upstream /openai/realtime websockets connected and authenticated ahead of time so a new
+    # session doesn't pay for the TLS and websocket handshake. Realtime connections carry conversation
+    # state, so they're never returned to the pool: each one is handed out once and the pool refills.
+    #
+    # The pool holds at least min_size idle connections and grows towards max_size when sessions arrive
+    # faster than it can refill. Connections idle for longer than idle_timeout are closed (shrinking
+    # back to min_size), and every health_interval seconds idle connections are pinged and dropped if
+    # they've gone away.
+    name: str
+    min_size: int
+    max_size: int
+    idle_timeout: float
+    health_interval: float
+
+    def __init__(self,
+                 connect: Callable[[Optional[dict[str, str]]], Awaitable[aiohttp.ClientWebSocketResponse]],
+                 min_size: int = 2,
+                 max_size: int = 10,
+                 idle_timeout: float = 60.0,
+                 health_interval: float = 15.0,
+                 name: str = "default"):
+        if min_size < 0 or max_size < min_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size")
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.name = name
+        self._idle: list[_PooledConnection] = []
+        self._target_size = min_size
+        self._connecting = 0
+        self._maintenance_task: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+        self._closed = False
+
+    async def start(self) -> None:
+        self._refill()
+        self._maintenance_task = asyncio.create_task(self._maintain())
+
+    async def acquire(self, headers: Optional[dict[str, str]] = None) -> aiohttp.ClientWebSocketResponse:
+        # headers are only sent when a new connection has to be opened. Pre-warmed connections were opened
+        # with their own client request id, the session's is logged next to it so the two can be matched.
+        start = time.perf_counter()
+        connection = self._take_idle()
+        pooled = connection is not None
+        if connection is None:
+            # The pool ran dry, let it grow so the next burst finds a warm connection
+            self._target_size = min(self._target_size + 1, self.max_size)
+            ws = await self._connect(headers)
+        else:
+            ws = connection.ws
+            if headers is not None and "x-ms-client-request-id" in headers:
+                logger.info("Client request %s uses pre-warmed connection %s from pool %s",
+                            headers["x-ms-client-request-id"], connection.request_id, self.name)
+        self._refill()
+        _acquire_latency.observe(time.perf_counter() - start, pool=self.name)
+        _acquires.inc(pool=self.name, pooled=str(pooled).lower())
+        return ws
+
+    def _take_idle(self) -> Optional[_PooledConnection]:
+        while len(self._idle) > 0:
+            connection = self._idle.pop()
+            if not self._is_usable(connection):
+                self._background(connection.ws.close())
+                continue
+            self._update_idle_gauge()
+            return connection
+        self._update_idle_gauge()
+        return None
+
+    def _is_usable(self, connection: _PooledConnection) -> bool:
+        return not connection.ws.closed and connection.ws.exception() is None \
+            and time.monotonic() - connection.created_at < self.idle_timeout
+
+    def _refill(self) -> None:
+        if self._closed:
+            return
+        missing = self._target_size - len(self._idle) - self._connecting
+        for _ in range(max(missing, 0)):
+            self._connecting += 1
+            self._background(self._add_connection())
+
+    def _background(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _add_connection(self) -> None:
+        request_id = str(uuid.uuid4())
+        try:
+            ws = await self._connect({"x-ms-client-request-id": request_id})
+        except Exception:
+            logger.exception("Failed to pre-warm upstream realtime connection for pool %s", self.name)
+            return
+        finally:
+            self._connecting -= 1
+        if self._closed:
+            await ws.close()
+            return
+        self._idle.append(_PooledConnection(ws, request_id))
+        self._update_idle_gauge()
+
+    async def _maintain(self) -> None:
+        while not self._closed:
+            await asyncio.sleep(self.health_interval)
+            unhealthy = []
+            # Sessions may take connections while we're pinging, so work on a snapshot
+            for connection in list(self._idle):
+                if self._is_usable(connection):
+                    try:
+                        await connection.ws.ping()
+                        continue
+                    except Exception:
+                        logger.info("Dropping unhealthy pooled upstream connection from pool %s", self.name)
+                else:
+                    # Expired connections also let the pool shrink back after a burst
+                    self._target_size = max(self._target_size - 1, self.min_size)
+                unhealthy.append(connection)
+            self._idle = [connection for connection in self._idle if connection not in unhealthy]
+            for connection in unhealthy:
+                await connection.ws.close()
+            self._update_idle_gauge()
+            self._refill()
+
+    def _update_idle_gauge(self) -> None:
+        _idle_connections.set(len(self._idle), pool=self.name)
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        for connection in self._idle:
+            await connection.ws.close()
+        self._idle.clear()
+        self._update_idle_gauge()
@@ -0,0 +1,183 @@
+import asyncio
+import base64
+import binascii
+import logging
+from collections import deque
+from collections.abc import Awaitable
+from enum import Enum
+from typing import Any, Callable, Optional
+
+import metrics
+from rtrouter import extract_string_field, replace_string_field, sniff_field
+
+logger = logging.getLogger("voicerag")
+
+_dropped_frames = metrics.counter("voicerag_queue_dropped_frames_total", "Stale audio frames dropped because a websocket consumer fell behind, by direction")
+_coalesced_frames = metrics.counter("voicerag_queue_coalesced_frames_total", "Audio frames merged into the previous one because a websocket consumer fell behind, by direction")
+_backpressure_waits = metrics.counter("voicerag_queue_backpressure_waits_total", "Times a reader was paused because the queue to a slow websocket consumer was full, by direction")
+
+class OverflowPolicy(Enum):
+    # Pause whoever is producing frames until the consumer catches up, which stops reading from the
+    # other websocket and lets TCP flow control slow the sender down
+    BACKPRESSURE = "backpressure"
+    # Drop the oldest queued audio frames, the consumer skips ahead instead of falling further behind
+    DROP_AUDIO = "drop_audio"
+    # Merge new audio into the last queued audio frame, fewer (larger) sends for the same audio
+    COALESCE_AUDIO = "coalesce_audio"
+
+class AudioFrameFormat:
+    # Describes which frames in a direction carry audio and where their base64 payload is, so the
+    # queue can drop or merge them without parsing the JSON
+    type_key: str
+    type_value: str
+    payload_key: str
+    match_key: Optional[str]
+
+    def __init__(self, type_key: str, type_value: str, payload_key: str, match_key: Optional[str] = None):
+        self.type_key = type_key
+        self.type_value = type_value
+        self.payload_key = payload_key
+        self.match_key = match_key
+
+    def is_audio(self, frame: str) -> bool:
+        return sniff_field(frame, self.type_key) == self.type_value
+
+    def coalesce(self, first: str, second: str) -> Optional[str]:
+        # Only frames belonging to the same item (when the format has one) can be merged
+        if self.match_key is not None and extract_string_field(first, self.match_key) != extract_string_field(second, self.match_key):
+            return None
+        first_payload = extract_string_field(first, self.payload_key)
+        second_payload = extract_string_field(second, self.payload_key)
+        if first_payload is None or second_payload is None:
+            return None
+        try:
+            merged = base64.b64encode(base64.b64decode(first_payload) + base64.b64decode(second_payload)).decode("ascii")
+        except binascii.Error:
+            return None
+        return replace_string_field(first, self.payload_key, merged)
+
+class FrameQueue:
+    # Bounded buffer between a pump reading one websocket and the task writing to the other, so a slow
+    # consumer (a phone on a bad network, a throttled browser tab) can't make memory grow without bound.
+    # Depth is counted in frames: once it goes above high_watermark the overflow policy kicks in, and
+    # producers paused by backpressure resume when the writer has drained it down to low_watermark.
+    direction: str
+    audio_format: Optional[AudioFrameFormat]
+    high_watermark: int
+    low_watermark: int
+    policy: OverflowPolicy
+    max_depth: int
+    dropped: int
+    coalesced: int
+    backpressure_waits: int
+
+    def __init__(self,
+                 send: Callable[[str], Awaitable[Any]],
+                 direction: str,
+                 audio_format: Optional[AudioFrameFormat] = None,
+                 high_watermark: int = 200,
+                 low_watermark: int = 50,
+                 policy: OverflowPolicy = OverflowPolicy.BACKPRESSURE):
+        if low_watermark > high_watermark:
+            raise ValueError("low_watermark can't be larger than high_watermark")
+        self._send = send
+        self._frames: deque[tuple[str, bool]] = deque()
+        self._not_empty = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._closed = False
+        self.direction = direction
+        self.audio_format = audio_format
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.max_depth = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.backpressure_waits = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._frames)
+
+    async def put(self, frame: str) -> None:
+        if self._closed:
+            return
+        audio = self.audio_format is not None and self.audio_format.is_audio(frame)
+        if audio and self.policy == OverflowPolicy.COALESCE_AUDIO and len(self._frames) >= self.high_watermark and self._frames[-1][1]:
+            merged = self.audio_format.coalesce(self._frames[-1][0], frame)
+            if merged is not None:
+                self._frames[-1] = (merged, True)
+                self.coalesced += 1
+                _coalesced_frames.inc(direction=self.direction)
+                return
+
+        self._frames.append((frame, audio))
+        self._not_empty.set()
+        self.max_depth = max(self.max_depth, len(self._frames))
+        if len(self._frames) <= self.high_watermark:
+            return
+
+        if self.policy == OverflowPolicy.DROP_AUDIO:
+            self._drop_stale_audio()
+        # Backpressure is also the fallback when there's no audio left to drop or merge
+        if len(self._frames) > self.high_watermark and not self._closed:
+            self.backpressure_waits += 1
+            _backpressure_waits.inc(direction=self.direction)
+            self._drained.clear()
+            await self._drained.wait()
+
+    def _drop_stale_audio(self) -> None:
+        excess = len(self._frames) - self.low_watermark
+        kept = deque()
+        for frame, audio in self._frames:
+            if audio and excess > 0:
+                excess -= 1
+                self.dropped += 1
+                continue
+            kept.append((frame, audio))
+        _dropped_frames.inc(len(self._frames) - len(kept), direction=self.direction)
+        self._frames = kept
+
+    def clear_audio(self) -> None:
+        # Used on barge-in: audio that hasn't been sent yet is no longer wanted
+        self._frames = deque((frame, audio) for frame, audio in self._frames if not audio)
+        self._release_if_drained()
+
+    def _release_if_drained(self) -> None:
+        if len(self._frames) <= self.low_watermark:
+            self._drained.set()
+
+    async def run(self) -> None:
+        try:
+            while True:
+                while len(self._frames) == 0:
+                    if self._closed:
+                        return
+                    self._not_empty.clear()
+                    await self._not_empty.wait()
+                frame, _ = self._frames.popleft()
+                self._release_if_drained()
+                await self._send(frame)
+        finally:
+            # If sending failed the consumer is gone, make sure producers don't wait on it forever
+            self._closed = True
+            self._frames.clear()
+            self._drained.set()
+
+    def close(self, flush: bool = True) -> None:
+        # With flush the writer sends whatever is still queued before run() returns
+        self._closed = True
+        if not flush:
+            self._frames.clear()
+        self._not_empty.set()
+        self._drained.set()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "depth": len(self._frames),
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "backpressure_waits": self.backpressure_waits
+        }
@@ -0,0 +1,69 @@
+import re
+from typing import Optional
+
+# Audio frames make up nearly all of the realtime traffic and carry large base64 payloads the middle
+# tier never changes, so instead of decoding every frame we peek at its type straight from the raw
+# text and only run json.loads on the (rare) control and tool events we actually need to inspect.
+
+_LEADING_FIELD_PATTERNS: dict[str, re.Pattern] = {}
+_FIELD_MARKERS: dict[str, tuple[str, ...]] = {}
+
+def sniff_field(data: str, key: str = "type") -> Optional[str]:
+    # Only matches when the key is the first member of the top-level object, which is how both the
+    # realtime API and ACS serialize their events. Anything else (different key order, escaped
+    # characters in the value) returns None and the caller falls back to a full parse.
+    pattern = _LEADING_FIELD_PATTERNS.get(key)
+    if pattern is None:
+        pattern = _LEADING_FIELD_PATTERNS[key] = re.compile(r'\s*\{\s*"' + re.escape(key) + r'"\s*:\s*"([^"\\]*)"')
+    match = pattern.match(data)
+    return match.group(1) if match is not None else None
+
+def _find_string_field(data: str, key: str) -> Optional[tuple[int, int]]:
+    # str.find is used rather than a regex since payloads are tens of kilobytes of base64 and scanning
+    # them character by character in the regex engine costs more than json.loads would.
+    markers = _FIELD_MARKERS.get(key)
+    if markers is None:
+        markers = _FIELD_MARKERS[key] = ('"' + key + '":"', '"' + key + '": "')
+    for marker in markers:
+        start = data.find(marker)
+        if start >= 0:
+            start += len(marker)
+            end = data.find('"', start)
+            if end < 0 or data.find("\\", start, end) >= 0:
+                return None
+            return start, end
+    return None
+
+def extract_string_field(data: str, key: str) -> Optional[str]:
+    # Pulls a string value (e.g. a base64 audio payload) out of a frame without decoding the rest of
+    # it. Only use this once the frame type is known and the key appears once in that type of frame.
+    # Values containing escape sequences return None so the caller falls back to a full parse.
+    span = _find_string_field(data, key)
+    return data[span[0]:span[1]] if span is not None else None
+
+def replace_string_field(data: str, key: str, value: str) -> Optional[str]:
+    # Counterpart to extract_string_field, value must not need escaping (e.g. base64)
+    span = _find_string_field(data, key)
+    return data[:span[0]] + value + data[span[1]:] if span is not None else None
+
+class MessageRouter:
+    # Decides per frame whether it needs a full parse. Types listed in `inspect` are parsed and handed
+    # to the middle tier, types in `drop` are discarded without parsing, and everything else is
+    # forwarded byte-for-byte.
+    inspect: frozenset[str]
+    drop: frozenset[str]
+    key: str
+
+    def __init__(self, inspect: set[str], drop: Optional[set[str]] = None, key: str = "type"):
+        self.inspect = frozenset(inspect)
+        self.drop = frozenset(drop or ())
+        self.key = key
+
+    def sniff(self, data: str) -> Optional[str]:
+        return sniff_field(data, self.key)
+
+    def is_passthrough(self, message_type: Optional[str]) -> bool:
+        return message_type is not None and message_type not in self.inspect and message_type not in self.drop
+
+    def is_dropped(self, message_type: Optional[str]) -> bool:
+        return message_type is not None and message_type in self.drop
@@ -0,0 +1,595 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+import uuid
+from enum import Enum
+from typing import Any, Callable, Optional
+
+import aiohttp
+from aiohttp import web
+from azure.core.credentials import AzureKeyCredential
+from azure.identity import DefaultAzureCredential
+
+import codec
+import metrics
+from admission import AdmissionController, AdmissionRejected, AdmissionTicket
+from audioconvert import AudioConverter
+from httpclient import REALTIME, get_client_session
+from rtbackends import BackendSelector, RealtimeBackend
+from rtpool import RealtimeConnectionPool
+from rtqueue import AudioFrameFormat, FrameQueue, OverflowPolicy
+from rttrace import TraceWriter
+from tokenmanager import COGNITIVE_SERVICES_SCOPE, AsyncTokenManager
+
+logger = logging.getLogger("voicerag")
+
+# Voice turns are measured from the end of the caller's speech, tool calls run in between
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 20.0)
+_active_sessions = metrics.gauge("voicerag_active_sessions", "Client websockets currently connected, by tier")
+_first_audio_latency = metrics.histogram("voicerag_turn_first_audio_seconds", "Time from the end of the caller's speech to the first audio of the answer, by tier", _LATENCY_BUCKETS)
+_turn_latency = metrics.histogram("voicerag_turn_seconds", "Time from the end of the caller's speech until the answer is complete, by tier", _LATENCY_BUCKETS)
+_tool_latency = metrics.histogram("voicerag_tool_seconds", "Time taken by tool calls, by tier, tool and outcome", _LATENCY_BUCKETS)
+_queue_depth = metrics.gauge("voicerag_queue_depth", "Frames waiting in the session queues, summed over the open sessions, by tier and direction")
+_queue_backlogged = metrics.gauge("voicerag_queue_backlogged_sessions", "Open sessions with more frames queued than the low watermark, by tier and direction")
+_handshake_latency = metrics.histogram("voicerag_upstream_handshake_seconds", "Time to open and authenticate a websocket to the realtime API, by tier and backend")
+
+class ToolResultDirection(Enum):
+    TO_SERVER = 1
+    TO_CLIENT = 2
+
+class ToolResult:
+    text: str
+    destination: ToolResultDirection
+
+    def __init__(self, text: str, destination: ToolResultDirection):
+        self.text = text
+        self.destination = destination
+
+    def to_text(self) -> str:
+        if self.text is None:
+            return ""
+        return self.text if isinstance(self.text, str) else codec.dumps(self.text)
+
+class Tool:
+    target: Callable[..., ToolResult]
+    schema: Any
+    timeout: Optional[float]
+    # Tools that keep data between calls (in RTSession.tool_state) get the session after the arguments
+    pass_session: bool
+    # Called with what the caller said as soon as it's transcribed, before the model calls the tool,
+    # for tiers with speculative tool calls turned on
+    prefetch: Optional[Callable[[str, Any], None]]
+
+    def __init__(self, target: Any, schema: Any, timeout: Optional[float] = None, pass_session: bool = False,
+                 prefetch: Optional[Callable[[str, Any], None]] = None):
+        self.target = target
+        self.schema = schema
+        self.timeout = timeout
+        self.pass_session = pass_session
+        self.prefetch = prefetch
+
+class RTToolCall:
+    tool_call_id: str
+    previous_id: str
+    response_id: Optional[str]
+    task: Optional[asyncio.Task]
+
+    def __init__(self, tool_call_id: str, previous_id: str, response_id: Optional[str] = None):
+        self.tool_call_id = tool_call_id
+        self.previous_id = previous_id
+        self.response_id = response_id
+        self.task = None
+
+class RTTurn:
+    # Monotonic timestamps of the key events of one voice turn, which starts when the caller stops
+    # talking and ends with the response.done of the answer (after any tool calls)
+    speech_stopped_at: Optional[float]
+    first_audio_at: Optional[float]
+    done_at: Optional[float]
+    tool_calls: list[tuple[str, float, float, str]]
+
+    def __init__(self, speech_stopped_at: Optional[float] = None):
+        self.speech_stopped_at = speech_stopped_at
+        self.first_audio_at = None
+        self.done_at = None
+        self.tool_calls = []
+
+    def summary(self) -> dict[str, Any]:
+        def since_speech(at: Optional[float]) -> Optional[float]:
+            if at is None or self.speech_stopped_at is None:
+                return None
+            return round(at - self.speech_stopped_at, 3)
+        return {
+            "first_audio": since_speech(self.first_audio_at),
+            "done": since_speech(self.done_at),
+            "tools": [{"name": name, "start": since_speech(start), "seconds": round(end - start, 3), "outcome": outcome}
+                      for name, start, end, outcome in self.tool_calls]
+        }
+
+class RTSessionConfig:
+    # Server-enforced configuration captured when the session starts, so changes to the middle tier
+    # while calls are in progress don't affect them halfway through
+    system_message: Optional[str]
+    temperature: Optional[float]
+    max_tokens: Optional[int]
+    disable_audio: Optional[bool]
+    voice_choice: Optional[str]
+    tools: dict[str, Any]
+
+    def __init__(self, system_message: Optional[str], temperature: Optional[float], max_tokens: Optional[int],
+                 disable_audio: Optional[bool], voice_choice: Optional[str], tools: dict[str, Any]):
+        self.system_message = system_message
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.disable_audio = disable_audio
+        self.voice_choice = voice_choice
+        self.tools = dict(tools)
+
+class RTSession:
+    # State owned by a single client websocket: one instance is created per connection in
+    # _websocket_handler and closed when the connection goes away
+    id: str
+    tier: str
+    client_ws: web.WebSocketResponse
+    config: RTSessionConfig
+    tools_pending: dict[str, RTToolCall]
+    closed: bool
+    to_client_queue: Optional[FrameQueue]
+    to_server_queue: Optional[FrameQueue]
+    turn: RTTurn
+    trace: Optional[TraceWriter]
+    admission: Optional[AdmissionTicket]
+    backend: Optional[RealtimeBackend]
+    # Converters for the caller's audio on its way to the realtime API and for the answers on their way
+    # back, when the two sides use different formats
+    audio_in: Optional[AudioConverter]
+    audio_out: Optional[AudioConverter]
+    # Data tools keep between calls in this session, by tool
+    tool_state: dict[str, Any]
+    _tasks: set[asyncio.Task]
+
+    def __init__(self, client_ws: web.WebSocketResponse, config: RTSessionConfig, tier: str = "realtime"):
+        self.id = str(uuid.uuid4())
+        self.tier = tier
+        self.client_ws = client_ws
+        self.config = config
+        self.tools_pending = {}
+        self.closed = False
+        self.to_client_queue = None
+        self.to_server_queue = None
+        self.turn = RTTurn()
+        self.trace = None
+        self.admission = None
+        self.backend = None
+        self.audio_in = None
+        self.audio_out = None
+        self.tool_state = {}
+        self._tasks = set()
+        _active_sessions.inc(tier=tier)
+
+    def add_tool_call(self, call_id: str, previous_id: str) -> None:
+        if call_id not in self.tools_pending:
+            self.tools_pending[call_id] = RTToolCall(call_id, previous_id)
+
+    def create_task(self, coro) -> asyncio.Task:
+        # Background work (tool calls and anything waiting on them) is tied to the session so it gets
+        # cancelled when the socket closes instead of writing to a dead connection
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Session %s background task failed", self.id, exc_info=task.exception())
+
+    def start_tool_call(self, tool_call: RTToolCall, coro) -> None:
+        tool_call.task = self.create_task(coro)
+
+    def complete_response(self, response_id: Optional[str]) -> list[RTToolCall]:
+        # Drops the tool calls that belong to the response that just finished and returns them, if
+        # there are any the caller needs to ask the model for a follow-up response once they're done.
+        # Calls we never saw an output_item.done for (no response id yet) are kept around.
+        done = [call for call in self.tools_pending.values()
+                if call.response_id is not None and (response_id is None or call.response_id == response_id)]
+        for call in done:
+            del self.tools_pending[call.tool_call_id]
+        return done
+
+    async def wait_for_tool_calls(self, tool_calls: list[RTToolCall]) -> None:
+        tasks = [call.task for call in tool_calls if call.task is not None]
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def speech_stopped(self) -> None:
+        self.turn = RTTurn(time.monotonic())
+
+    def audio_delta(self) -> None:
+        # Called for every audio frame, only the first one of a turn does anything
+        if self.turn.first_audio_at is not None:
+            return
+        self.turn.first_audio_at = time.monotonic()
+        if self.turn.speech_stopped_at is not None:
+            latency = self.turn.first_audio_at - self.turn.speech_stopped_at
+            _first_audio_latency.observe(latency, tier=self.tier)
+            if self.backend is not None:
+                self.backend.first_audio(latency)
+
+    def tool_call_done(self, name: str, started_at: float, outcome: str) -> None:
+        ended_at = time.monotonic()
+        self.turn.tool_calls.append((name, started_at, ended_at, outcome))
+        _tool_latency.observe(ended_at - started_at, tier=self.tier, tool=name, outcome=outcome)
+
+    def response_done(self, final: bool) -> None:
+        # Responses that only call tools are followed by another one with the actual answer
+        if not final or self.turn.done_at is not None:
+            return
+        self.turn.done_at = time.monotonic()
+        if self.turn.speech_stopped_at is not None:
+            _turn_latency.observe(self.turn.done_at - self.turn.speech_stopped_at, tier=self.tier)
+            logger.debug("Session %s turn: %s", self.id, self.turn.summary())
+
+    def record_usage(self, usage: Optional[dict[str, Any]]) -> None:
+        # Token usage the realtime API reported for a response, charged against the deployment's quota
+        if self.admission is not None and usage is not None:
+            self.admission.consume(usage.get("total_tokens") or 0)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "tools_pending": len(self.tools_pending),
+            "to_client_queue": self.to_client_queue.stats() if self.to_client_queue is not None else None,
+            "to_server_queue": self.to_server_queue.stats() if self.to_server_queue is not None else None
+        }
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        _active_sessions.dec(tier=self.tier)
+        logger.info("Session %s closed: %s", self.id, self.stats())
+        if len(self.tools_pending) > 0:
+            logger.info("Session %s closed with %d tool call(s) pending", self.id, len(self.tools_pending))
+        self.tools_pending.clear()
+        self.tool_state.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        if self.trace is not None:
+            self.trace.close()
+        if self.admission is not None:
+            self.admission.release()
+
+class RTMiddleTierBase:
+    # What the browser and phone tiers share: connecting to the realtime API, moving frames between the
+    # two sockets and running tools. Subclasses rewrite the messages in _process_message_to_client and
+    # _process_message_to_server, and set the audio frame formats of their clients.
+    endpoint: str
+    deployment: str
+    key: Optional[str] = None
+    
+    # Tools are server-side only for now, though the case could be made for client-side tools
+    # in addition to server-side tools that are invisible to the client
+    tools: dict[str, Tool]
+
+    # Server-enforced configuration, if set, these will override the client's configuration
+    # Typically at least the model name and system message will be set by the server
+    model: Optional[str] = None
+    system_message: Optional[str] = None
+    temperature: Optional[float] = None
+    max_tokens: Optional[int] = None
+    disable_audio: Optional[bool] = None
+    voice_choice: Optional[str] = None
+    api_version: str = "2024-10-01-preview"
+    # Label for this tier's sessions in metrics
+    tier: str = "realtime"
+    # Seconds a tool call may take before the model is told it failed, tools can override this
+    tool_timeout: Optional[float] = 20.0
+    # Frames buffered per direction before the overflow policy applies, see rtqueue.FrameQueue
+    queue_high_watermark: int = 200
+    queue_low_watermark: int = 50
+    client_overflow_policy: OverflowPolicy = OverflowPolicy.BACKPRESSURE
+    server_overflow_policy: OverflowPolicy = OverflowPolicy.BACKPRESSURE
+    # Where the audio sits in the frames each side sends, so queues can find and drop it
+    to_client_audio: AudioFrameFormat
+    to_server_audio: AudioFrameFormat = AudioFrameFormat("type", "input_audio_buffer.append", "audio")
+    # Deployments sessions can be routed to, just endpoint/deployment unless use_backends is called
+    backends: BackendSelector
+    # Optional pools of pre-warmed upstream connections by backend name, see use_connection_pool
+    pools: dict[str, RealtimeConnectionPool]
+    # When set, every session is recorded to a trace file in this directory, see use_tracing
+    trace_directory: Optional[str] = None
+    # Optional limits on the sessions opened against each backend by backend name, see use_admission_control
+    admission: dict[str, AdmissionController]
+    # Seconds between samples of the open sessions' queue depths for /metrics
+    queue_sample_interval: float = 1.0
+    logger: logging.Logger = logger
+    _queue_sampler: Optional[asyncio.Task] = None
+    _token_manager: Optional[AsyncTokenManager] = None
+    _sessions: dict[str, RTSession]
+
+    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | AsyncTokenManager | DefaultAzureCredential, voice_choice: Optional[str] = None):
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.voice_choice = voice_choice
+        self.tools = {}
+        self._sessions = {}
+        self.backends = BackendSelector([RealtimeBackend(endpoint, deployment)])
+        self.pools = {}
+        self.admission = {}
+        if voice_choice is not None:
+            self.logger.info("Realtime voice choice set to %s", voice_choice)
+        if isinstance(credentials, AzureKeyCredential):
+            self.key = credentials.key
+        elif isinstance(credentials, AsyncTokenManager):
+            self._token_manager = credentials
+        else:
+            self._token_manager = AsyncTokenManager(credentials)
+
+    def use_queue_settings(self, high_watermark: int, low_watermark: int, client_overflow_policy: OverflowPolicy, server_overflow_policy: OverflowPolicy):
+        self.queue_high_watermark = high_watermark
+        self.queue_low_watermark = low_watermark
+        self.client_overflow_policy = client_overflow_policy
+        self.server_overflow_policy = server_overflow_policy
+
+    def use_tracing(self, directory: str):
+        # Records every session to a binary trace that benchmarks/replay.py can play back. Traces
+        # contain the callers' audio and the tool results, so only enable this where that's acceptable.
+        os.makedirs(directory, exist_ok=True)
+        self.trace_directory = directory
+
+    def use_admission_control(self, controllers: dict[str, AdmissionController]):
+        # Sessions wait for the controller of the backend they were routed to before connecting to it,
+        # backends without one connect right away. Both tiers should share the controllers, since they
+        # share the deployments' quotas.
+        self.admission = controllers
+
+    def use_backends(self, backends: BackendSelector):
+        # Spreads sessions over several deployments, call this before use_connection_pool. Both tiers
+        # should share the selector so its measurements and in-flight counts cover every session.
+        self.backends = backends
+
+    def use_connection_pool(self, min_size: int, max_size: int, idle_timeout: float = 60.0, health_interval: float = 15.0):
+        # One pool per backend, each keeping its own connections warm
+        for backend in self.backends.backends:
+            self.pools[backend.name] = RealtimeConnectionPool(functools.partial(self._connect, backend),
+                                                              min_size=min_size, max_size=max_size,
+                                                              idle_timeout=idle_timeout, health_interval=health_interval,
+                                                              name=f"{type(self).__name__}/{backend.name}")
+
+    def _session_config(self) -> RTSessionConfig:
+        return RTSessionConfig(
+            system_message=self.system_message,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            disable_audio=self.disable_audio,
+            voice_choice=self.voice_choice,
+            tools=self.tools)
+
+    def _prepare_session(self, rt_session: RTSession) -> None:
+        # Called for every new session before it connects, for subclasses with per-session state
+        pass
+
+    async def _process_message_to_client(self, rt_session: RTSession, msg: aiohttp.WSMessage, to_client: FrameQueue, to_server: FrameQueue) -> Optional[str]:
+        raise NotImplementedError
+
+    async def _process_message_to_server(self, rt_session: RTSession, msg: aiohttp.WSMessage, ws: web.WebSocketResponse) -> Optional[str]:
+        raise NotImplementedError
+
+    async def _run_tool(self, rt_session: RTSession, tool_call: RTToolCall, item: Any, to_client: FrameQueue, to_server: FrameQueue) -> None:
+        tool = rt_session.config.tools[item["name"]]
+        timeout = tool.timeout if tool.timeout is not None else self.tool_timeout
+        started_at = time.monotonic()
+        outcome = "ok"
+        if rt_session.trace is not None:
+            rt_session.trace.tool_call(item["name"], item["call_id"], item["arguments"])
+        try:
+            args = codec.loads(item["arguments"])
+            call = tool.target(args, rt_session) if tool.pass_session else tool.target(args)
+            result = await asyncio.wait_for(call, timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning("Tool %s timed out after %ss", item["name"], timeout)
+            outcome = "timeout"
+            result = ToolResult({"error": f"The {item['name']} tool timed out"}, ToolResultDirection.TO_SERVER)
+        except Exception:
+            self.logger.exception("Tool %s failed", item["name"])
+            outcome = "error"
+            result = ToolResult({"error": f"The {item['name']} tool failed"}, ToolResultDirection.TO_SERVER)
+        rt_session.tool_call_done(item["name"], started_at, outcome)
+        if rt_session.trace is not None:
+            rt_session.trace.tool_result(item["name"], item["call_id"], result.to_text(),
+                                         result.destination == ToolResultDirection.TO_CLIENT, outcome)
+
+        # Through the session's queues, so these wait their turn behind the frames already queued
+        await to_server.put(codec.dumps({
+            "type": "conversation.item.create",
+            "item": {
+                "type": "function_call_output",
+                "call_id": item["call_id"],
+                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
+            }
+        }))
+        if result.destination == ToolResultDirection.TO_CLIENT:
+            # TODO: this will break clients that don't know about this extra message, rewrite 
+            # this to be a regular text message with a special marker of some sort
+            await to_client.put(codec.dumps({
+                "type": "extension.middle_tier_tool_response",
+                "previous_item_id": tool_call.previous_id,
+                "tool_name": item["name"],
+                "tool_result": result.to_text()
+            }))
+
+    async def _create_response_after_tools(self, rt_session: RTSession, tool_calls: list[RTToolCall], to_server: FrameQueue) -> None:
+        # Tool calls from the same response run in parallel, the model only gets asked to continue once
+        # all of their outputs have been submitted
+        await rt_session.wait_for_tool_calls(tool_calls)
+        await to_server.put(codec.RESPONSE_CREATE)
+
+    async def _connect(self, backend: RealtimeBackend, headers: Optional[dict[str, str]] = None) -> aiohttp.ClientWebSocketResponse:
+        params = { "api-version": self.api_version, "deployment": backend.deployment}
+        headers = dict(headers or {})
+        if backend.key is not None:
+            headers["api-key"] = backend.key
+        elif self.key is not None:
+            headers["api-key"] = self.key
+        else:
+            headers["Authorization"] = f"Bearer {await self._token_manager.get_bearer_token(COGNITIVE_SERVICES_SCOPE)}"
+        url = backend.endpoint.rstrip("/") + "/openai/realtime"
+        start = time.perf_counter()
+        ws = await get_client_session(REALTIME).ws_connect(url, headers=headers, params=params)
+        elapsed = time.perf_counter() - start
+        backend.handshake_succeeded(elapsed)
+        _handshake_latency.observe(elapsed, tier=self.tier, backend=backend.name)
+        return ws
+
+    async def _admit(self, ws: web.WebSocketResponse, rt_session: RTSession, controller: AdmissionController) -> bool:
+        # The client's first messages wait in the socket until there's room on the backend. Raises
+        # AdmissionRejected when there isn't any, so the session can fail over to another backend.
+        rt_session.admission = await controller.acquire()
+        return True
+
+    async def _forward_messages(self, request: web.Request, ws: web.WebSocketResponse, rt_session: RTSession):
+        headers = {}
+        if "x-ms-client-request-id" in request.headers:
+            headers["x-ms-client-request-id"] = request.headers["x-ms-client-request-id"]
+
+        async def connect(backend: RealtimeBackend) -> Optional[aiohttp.ClientWebSocketResponse]:
+            # None when the client hung up while waiting for room on the backend
+            if (controller := self.admission.get(backend.name)) is not None and not await self._admit(ws, rt_session, controller):
+                return None
+            try:
+                pool = self.pools.get(backend.name)
+                return await pool.acquire(headers) if pool is not None else await self._connect(backend, headers)
+            except BaseException:
+                # The session fails over to another backend, which has its own controller
+                if rt_session.admission is not None:
+                    rt_session.admission.release()
+                    rt_session.admission = None
+                raise
+
+        try:
+            target_ws, backend = await self.backends.connect(connect)
+        except AdmissionRejected as e:
+            # Every backend turned the session away
+            self.logger.warning("Session %s rejected: %s", rt_session.id, e)
+            await ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b"Realtime capacity exhausted, try again later")
+            return
+        if target_ws is None:
+            return
+        rt_session.backend = backend
+        self.backends.session_started(backend)
+        try:
+            await self._forward_between(ws, target_ws, rt_session)
+        finally:
+            await target_ws.close()
+            self.backends.session_ended(backend)
+
+    async def _forward_between(self, ws: web.WebSocketResponse, target_ws: aiohttp.ClientWebSocketResponse, rt_session: RTSession):
+        # Each direction goes through a bounded queue so a slow consumer can't make memory grow without limit
+        to_client = FrameQueue(ws.send_str, "to_client", self.to_client_audio,
+                               self.queue_high_watermark, self.queue_low_watermark, self.client_overflow_policy)
+        to_server = FrameQueue(target_ws.send_str, "to_server", self.to_server_audio,
+                               self.queue_high_watermark, self.queue_low_watermark, self.server_overflow_policy)
+        rt_session.to_client_queue = to_client
+        rt_session.to_server_queue = to_server
+
+        async def from_client_to_server():
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    if rt_session.trace is not None:
+                        rt_session.trace.from_client(msg.data)
+                    new_msg = await self._process_message_to_server(rt_session, msg, ws)
+                    if new_msg is not None:
+                        await to_server.put(new_msg)
+                else:
+                    print("Error: unexpected message type:", msg.type)
+
+            # Means it is gracefully closed by the client then time to close the target_ws
+            to_server.close(flush=False)
+            if target_ws:
+                print("Closing OpenAI's realtime socket connection.")
+                await target_ws.close()
+
+        async def from_server_to_client():
+            async for msg in target_ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    if rt_session.trace is not None:
+                        rt_session.trace.from_server(msg.data)
+                    new_msg = await self._process_message_to_client(rt_session, msg, to_client, to_server)
+                    if new_msg is not None:
+                        await to_client.put(new_msg)
+                else:
+                    print("Error: unexpected message type:", msg.type)
+            # Whatever is still queued for the client gets delivered before its writer stops
+            to_client.close()
+
+        tasks = [asyncio.create_task(c) for c in (from_client_to_server(), from_server_to_client(), to_client.run(), to_server.run())]
+        try:
+            await asyncio.gather(*tasks)
+        except ConnectionResetError:
+            # Ignore the errors resulting from the client disconnecting the socket
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _websocket_handler(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        rt_session = RTSession(ws, self._session_config(), self.tier)
+        self._prepare_session(rt_session)
+        self._sessions[rt_session.id] = rt_session
+        if self.trace_directory is not None:
+            rt_session.trace = TraceWriter(os.path.join(self.trace_directory, f"{self.tier}-{rt_session.id}.rttrace"),
+                                           {"tier": self.tier, "path": request.path, "session_id": rt_session.id, "deployment": self.deployment})
+        try:
+            await self._forward_messages(request, ws, rt_session)
+        finally:
+            del self._sessions[rt_session.id]
+            rt_session.close()
+        return ws
+    
+    async def drain(self, timeout: float):
+        # Used when the server is shutting down: calls in progress get up to timeout seconds to end
+        # on their own, then the remaining clients are told the server is going away
+        deadline = time.monotonic() + timeout
+        while len(self._sessions) > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        if len(self._sessions) > 0:
+            self.logger.info("Closing %d session(s) that didn't end within %ss", len(self._sessions), timeout)
+        await asyncio.gather(*(rt_session.client_ws.close(code=aiohttp.WSCloseCode.GOING_AWAY, message=b"Server is shutting down")
+                               for rt_session in list(self._sessions.values())), return_exceptions=True)
+
+    def _sample_queues(self) -> None:
+        # Sampled rather than updated on every frame, which keeps the metrics lock out of the frame path
+        by_direction: dict[str, list[FrameQueue]] = {"to_client": [], "to_server": []}
+        for rt_session in self._sessions.values():
+            for queue in (rt_session.to_client_queue, rt_session.to_server_queue):
+                if queue is not None:
+                    by_direction[queue.direction].append(queue)
+        for direction, queues in by_direction.items():
+            _queue_depth.set(sum(queue.depth for queue in queues), tier=self.tier, direction=direction)
+            _queue_backlogged.set(sum(1 for queue in queues if queue.depth > queue.low_watermark), tier=self.tier, direction=direction)
+
+    async def _sample_queues_periodically(self) -> None:
+        while True:
+            self._sample_queues()
+            await asyncio.sleep(self.queue_sample_interval)
+
+    async def _on_startup(self, app: web.Application):
+        for pool in self.pools.values():
+            await pool.start()
+        self._queue_sampler = asyncio.create_task(self._sample_queues_periodically())
+
+    async def _on_cleanup(self, app: web.Application):
+        if self._queue_sampler is not None:
+            self._queue_sampler.cancel()
+        for pool in self.pools.values():
+            await pool.close()
+
+    def attach_to_app(self, app, path):
+        app.router.add_get(path, self._websocket_handler)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
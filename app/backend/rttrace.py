@@ -0,0 +1,157 @@
+import base64
+import binascii
+import json
+import logging
+import struct
+import time
+from collections.abc import Iterator
+from typing import Any, BinaryIO, Optional
+
+from rtrouter import extract_string_field, replace_string_field, sniff_field
+
+logger = logging.getLogger("voicerag")
+
+# Compact binary recording of a realtime session, for replaying real traffic through the middle tiers
+# (see benchmarks/replay.py). A trace is the magic bytes, a length-prefixed JSON header, and then one
+# record per event:
+#
+#   kind (u8) | microseconds since the session started (u64) | payload length (u32) | payload
+#
+# Text frames are stored as UTF-8. Audio frames are stored as their JSON envelope with the base64
+# payload emptied, followed by the decoded PCM, which is 25% smaller and cheap to turn back into the
+# original frame. Tool calls and their results are stored as JSON.
+
+MAGIC = b"RTTRACE1"
+
+# Frames the middle tier received from the client (browser or ACS) and from the realtime API
+FROM_CLIENT = 1
+FROM_SERVER = 2
+FROM_CLIENT_AUDIO = 3
+FROM_SERVER_AUDIO = 4
+TOOL_CALL = 5
+TOOL_RESULT = 6
+
+_RECORD_HEADER = struct.Struct("<BQI")
+_AUDIO_HEADER = struct.Struct("<BI")
+
+# (type key, type value) -> key of the base64 audio payload
+_AUDIO_FRAMES = {
+    ("type", "input_audio_buffer.append"): "audio",
+    ("type", "response.audio.delta"): "delta",
+    ("kind", "AudioData"): "data",
+}
+
+class TraceRecord:
+    kind: int
+    offset: float
+    data: Any
+
+    def __init__(self, kind: int, offset: float, data: Any):
+        self.kind = kind
+        self.offset = offset
+        self.data = data
+
+    @property
+    def from_client(self) -> bool:
+        return self.kind in (FROM_CLIENT, FROM_CLIENT_AUDIO)
+
+    @property
+    def from_server(self) -> bool:
+        return self.kind in (FROM_SERVER, FROM_SERVER_AUDIO)
+
+def _audio_key(frame: str) -> Optional[str]:
+    for (type_key, type_value), payload_key in _AUDIO_FRAMES.items():
+        if sniff_field(frame, type_key) == type_value:
+            return payload_key
+    return None
+
+class TraceWriter:
+    path: str
+    records: int
+
+    def __init__(self, path: str, header: dict[str, Any]):
+        self.path = path
+        self.records = 0
+        self._started = time.monotonic()
+        # Writes land in a large buffer so recording doesn't mean a disk write per frame
+        self._file: Optional[BinaryIO] = open(path, "wb", buffering=1024 * 1024)
+        header_bytes = json.dumps({**header, "started_at": time.time()}).encode("utf-8")
+        self._file.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+
+    def _write(self, kind: int, payload: bytes) -> None:
+        if self._file is None:
+            return
+        offset_us = int((time.monotonic() - self._started) * 1_000_000)
+        self._file.write(_RECORD_HEADER.pack(kind, offset_us, len(payload)))
+        self._file.write(payload)
+        self.records += 1
+
+    def _frame(self, text_kind: int, audio_kind: int, frame: str) -> None:
+        key = _audio_key(frame)
+        if key is not None:
+            audio = extract_string_field(frame, key)
+            if audio is not None:
+                try:
+                    pcm = base64.b64decode(audio, validate=True)
+                except binascii.Error:
+                    pcm = None
+                # Only store PCM when the frame can be rebuilt byte for byte from it
+                if pcm is not None and base64.b64encode(pcm).decode("ascii") == audio:
+                    envelope = replace_string_field(frame, key, "").encode("utf-8")
+                    key_bytes = key.encode("ascii")
+                    self._write(audio_kind, _AUDIO_HEADER.pack(len(key_bytes), len(envelope)) + key_bytes + envelope + pcm)
+                    return
+        self._write(text_kind, frame.encode("utf-8"))
+
+    def from_client(self, frame: str) -> None:
+        self._frame(FROM_CLIENT, FROM_CLIENT_AUDIO, frame)
+
+    def from_server(self, frame: str) -> None:
+        self._frame(FROM_SERVER, FROM_SERVER_AUDIO, frame)
+
+    def tool_call(self, name: str, call_id: str, arguments: str) -> None:
+        self._write(TOOL_CALL, json.dumps({"name": name, "call_id": call_id, "arguments": arguments}).encode("utf-8"))
+
+    def tool_result(self, name: str, call_id: str, output: str, to_client: bool, outcome: str) -> None:
+        self._write(TOOL_RESULT, json.dumps({"name": name, "call_id": call_id, "output": output,
+                                             "to_client": to_client, "outcome": outcome}).encode("utf-8"))
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        logger.info("Wrote %d records to trace %s", self.records, self.path)
+
+def _decode(kind: int, payload: bytes) -> Any:
+    if kind in (FROM_CLIENT_AUDIO, FROM_SERVER_AUDIO):
+        key_length, envelope_length = _AUDIO_HEADER.unpack_from(payload)
+        start = _AUDIO_HEADER.size
+        key = payload[start:start + key_length].decode("ascii")
+        envelope = payload[start + key_length:start + key_length + envelope_length].decode("utf-8")
+        pcm = payload[start + key_length + envelope_length:]
+        return replace_string_field(envelope, key, base64.b64encode(pcm).decode("ascii"))
+    if kind in (TOOL_CALL, TOOL_RESULT):
+        return json.loads(payload)
+    return payload.decode("utf-8")
+
+def read_trace(path: str) -> tuple[dict[str, Any], list[TraceRecord]]:
+    # Audio frames come back exactly as they were received, base64 and all
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a realtime session trace")
+        (header_length,) = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(header_length))
+        return header, list(_read_records(f))
+
+def _read_records(f: BinaryIO) -> Iterator[TraceRecord]:
+    while True:
+        record_header = f.read(_RECORD_HEADER.size)
+        if len(record_header) < _RECORD_HEADER.size:
+            return
+        kind, offset_us, length = _RECORD_HEADER.unpack(record_header)
+        payload = f.read(length)
+        if len(payload) < length:
+            # The session ended while a record was being written
+            return
+        yield TraceRecord(kind, offset_us / 1_000_000, _decode(kind, payload))
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Hashable
+from typing import Any, Callable, Optional
+
+from aiohttp import web
+
+import codec
+import metrics
+
+logger = logging.getLogger("voicerag")
+
+_requests = metrics.counter("voicerag_search_cache_requests_total", "Knowledge base searches by cache result: hit, miss, or coalesced into an identical search in flight")
+_hit_ratio = metrics.gauge("voicerag_search_cache_hit_ratio", "Share of knowledge base searches answered without querying Azure AI Search")
+_evictions = metrics.counter("voicerag_search_cache_evictions_total", "Cached search results removed, by reason: size, expired or invalidated")
+_bytes = metrics.gauge("voicerag_search_cache_bytes", "Size of the cached search results")
+_entries = metrics.gauge("voicerag_search_cache_entries", "Number of cached search results")
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_query(query: str) -> str:
+    # "What's the deductible?" and "whats the  deductible" are the same question to the search index
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub("", query.casefold())).strip()
+
+# Words that say nothing about what a caller is asking for
+_STOP_WORDS = frozenset("a an and are about can could do does for from get how i in is it me my of on or please "
+                        "the to tell what whats when where which who why will with would you your".split())
+
+def query_words(text: str) -> set[str]:
+    return set(normalize_query(text).split()) - _STOP_WORDS
+
+def _size_of(value: Any) -> int:
+    # Roughly the memory a cached value holds, search results are mostly their text
+    return len((value if isinstance(value, str) else codec.dumps(value)).encode("utf-8"))
+
+class _CacheEntry:
+    value: Any
+    size: int
+    expires_at: float
+
+    def __init__(self, value: Any, size: int, expires_at: float):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+
+class SearchCache:
+    # In-process cache of knowledge base search results, shared by both middle tiers. Entries
+    # expire after ttl seconds and the least recently used ones are evicted to stay under max_bytes.
+    # Concurrent misses for the same key share a single search. An IndexWatcher can clear it when the
+    # index changes, so answers don't lag behind a re-indexing by a ttl.
+    max_bytes: int
+    ttl: float
+    hits: int
+    misses: int
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, ttl: float = 300.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, _CacheEntry] = OrderedDict()
+        self._size = 0
+        # Bumped by clear(), so a search that started before an invalidation doesn't get cached after it
+        self._generation = 0
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+
+    @staticmethod
+    def key(query: str, **parameters: Any) -> Hashable:
+        return (normalize_query(query),) + tuple(sorted((k, str(v)) for k, v in parameters.items()))
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key, "expired")
+            return None
+        self._entries.move_to_end(key)
+        return entry.value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = _size_of(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key, None)
+        self._entries[key] = _CacheEntry(value, size, time.monotonic() + self.ttl)
+        self._size += size
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)), "size")
+        self._update_gauges()
+
+    def _remove(self, key: Hashable, reason: Optional[str]) -> None:
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+        if reason is not None:
+            _evictions.inc(reason=reason)
+        self._update_gauges()
+
+    def _update_gauges(self) -> None:
+        _bytes.set(self._size)
+        _entries.set(len(self._entries))
+
+    def _count(self, result: str) -> None:
+        if result == "miss":
+            self.misses += 1
+        else:
+            self.hits += 1
+        _requests.inc(result=result)
+        _hit_ratio.set(self.hits / (self.hits + self.misses))
+
+    async def get_or_search(self, key: Hashable, search: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key)
+        if value is not None:
+            self._count("hit")
+            return value
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self._count("coalesced")
+            try:
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling() > 0:
+                    raise
+            # The caller that started the search hung up before it finished, search again
+            return await self.get_or_search(key, search)
+
+        self._count("miss")
+        generation = self._generation
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            value = await search()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieve it here, there may be nobody else waiting for this search
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+        future.set_result(value)
+        if generation == self._generation:
+            self.put(key, value)
+        return value
+
+    def clear(self, reason: str = "invalidated") -> None:
+        count = len(self._entries)
+        self._generation += 1
+        for key in list(self._entries):
+            self._remove(key, reason)
+        if count > 0:
+            logger.info("Dropped %d cached search result(s), %s", count, reason)
+
+    def stats(self) -> dict[str, Any]:
+        return {"entries": len(self._entries), "bytes": self._size, "hits": self.hits, "misses": self.misses}
+
+class IndexWatcher:
+    # Polls get_version every interval seconds while the app runs (the last run of the indexer that fills
+    # the index, for instance) and calls every on_change callback when the value changes
+    interval: float
+
+    def __init__(self, get_version: Callable[[], Awaitable[Any]], interval: float = 60.0):
+        self.interval = interval
+        self._get_version = get_version
+        self._callbacks: list[Callable[[], None]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def on_change(self, callback: Callable[[], None]) -> None:
+        self._callbacks.append(callback)
+
+    async def _watch(self) -> None:
+        version = None
+        while True:
+            try:
+                current = await self._get_version()
+                if version is not None and current != version:
+                    for callback in self._callbacks:
+                        callback()
+                version = current
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Couldn't check whether the search index changed", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def attach_to_app(self, app: web.Application) -> None:
+        async def start_watching(app):
+            self._task = asyncio.create_task(self._watch())
+
+        async def stop_watching(app):
+            if self._task is not None:
+                self._task.cancel()
+                self._task = None
+        app.on_startup.append(start_watching)
+        app.on_cleanup.append(stop_watching)
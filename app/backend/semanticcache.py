@@ -0,0 +1,118 @@
+import logging
+import time
+from collections.abc import Awaitable, Hashable
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+import metrics
+from embeddings import Embedder
+
+logger = logging.getLogger("voicerag")
+
+_requests = metrics.counter("voicerag_semantic_cache_requests_total", "Knowledge base searches by semantic cache result: hit, miss or error (the query couldn't be embedded)")
+_similarity = metrics.histogram("voicerag_semantic_cache_similarity", "Cosine similarity of each query to the closest cached one, for tuning the threshold",
+                                buckets=(0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.925, 0.95, 0.975, 0.99, 1.0))
+_entries = metrics.gauge("voicerag_semantic_cache_entries", "Number of queries in the semantic cache")
+
+class SemanticCache:
+    # Reuses the results of an earlier search when a new query means (nearly) the same thing, like "how
+    # many vacation days do I get" and "what's my PTO allowance". Queries are embedded and compared to the
+    # cached ones by cosine similarity, a single matrix-vector product over a preallocated matrix, and the
+    # closest one's results are returned when its similarity is at least threshold.
+    #
+    # At most max_entries queries are kept. Entries expire after ttl seconds, and when the matrix is full
+    # the least recently used one is replaced. Entries belong to a scope (the search configuration), and
+    # only match queries in the same scope.
+    embedder: Embedder
+    threshold: float
+    max_entries: int
+    ttl: float
+
+    def __init__(self, embedder: Embedder, threshold: float = 0.9, max_entries: int = 2048, ttl: float = 300.0):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._vectors = np.zeros((max_entries, embedder.dimensions), dtype=np.float32)
+        # Rows that expired (or were never used) have expires_at 0
+        self._expires_at = np.zeros(max_entries)
+        self._last_used = np.zeros(max_entries)
+        self._scopes = np.full(max_entries, -1, dtype=np.int32)
+        self._queries: list[Optional[str]] = [None] * max_entries
+        self._values: list[Any] = [None] * max_entries
+        self._scope_ids: dict[Hashable, int] = {}
+        # Rows past this one were never filled, lookups don't need to look at them
+        self._rows = 0
+        # Bumped by clear, so searches that started before it don't put their stale results back
+        self._generation = 0
+
+    def _scope_id(self, scope: Hashable) -> int:
+        return self._scope_ids.setdefault(scope, len(self._scope_ids))
+
+    def lookup(self, vector: np.ndarray, scope: Hashable, now: Optional[float] = None) -> tuple[Optional[int], float]:
+        # Row of the closest live entry in the scope and its similarity, the row is None below the threshold
+        now = time.monotonic() if now is None else now
+        rows = self._rows
+        live = (self._expires_at[:rows] > now) & (self._scopes[:rows] == self._scope_id(scope))
+        if not live.any():
+            return None, 0.0
+        similarities = self._vectors[:rows] @ vector
+        similarities[~live] = -np.inf
+        row = int(np.argmax(similarities))
+        similarity = float(similarities[row])
+        return (row if similarity >= self.threshold else None), similarity
+
+    def get(self, row: int, now: Optional[float] = None) -> Any:
+        self._last_used[row] = time.monotonic() if now is None else now
+        return self._values[row]
+
+    def put(self, query: str, vector: np.ndarray, scope: Hashable, value: Any, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        expired = self._expires_at[:self._rows] <= now
+        # An expired row if there is one, then a row never used, and otherwise the least recently used
+        if expired.any():
+            row = int(np.argmax(expired))
+        elif self._rows < self.max_entries:
+            row = self._rows
+            self._rows += 1
+        else:
+            row = int(np.argmin(self._last_used))
+        self._vectors[row] = vector
+        self._expires_at[row] = now + self.ttl
+        self._last_used[row] = now
+        self._scopes[row] = self._scope_id(scope)
+        self._queries[row] = query
+        self._values[row] = value
+        _entries.set(int((self._expires_at[:self._rows] > now).sum()))
+
+    async def get_or_search(self, query: str, scope: Hashable, search: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            vector = (await self.embedder.embed([query]))[0]
+        except Exception:
+            # The cache is an optimization, a failing embedder mustn't fail the search
+            logger.warning("Couldn't embed query for the semantic cache", exc_info=True)
+            _requests.inc(result="error")
+            return await search()
+
+        row, similarity = self.lookup(vector, scope)
+        if similarity > 0:
+            _similarity.observe(similarity)
+        if row is not None:
+            _requests.inc(result="hit")
+            logger.debug("Semantic cache hit for '%s': '%s' (%.3f)", query, self._queries[row], similarity)
+            return self.get(row)
+        _requests.inc(result="miss")
+        generation = self._generation
+        value = await search()
+        if generation == self._generation:
+            self.put(query, vector, scope, value)
+        return value
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._expires_at[:] = 0
+        self._rows = 0
+        self._queries = [None] * self.max_entries
+        self._values = [None] * self.max_entries
+        _entries.set(0)
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from collections.abc import Awaitable
+from multiprocessing.connection import wait
+from typing import Callable, Optional
+
+from aiohttp import web
+
+import metrics
+
+logger = logging.getLogger("voicerag")
+
+# Production entry point that spreads calls over several processes. Every worker runs its own event
+# loop and its own copy of the app, and binds the same port with SO_REUSEPORT so the kernel balances
+# new connections between them. A websocket stays on the worker that accepted it for its whole life.
+# The workers share their metrics through snapshots in a temporary directory, so /metrics adds up all
+# of them whichever worker serves it.
+
+def _install_event_loop(event_loop: str) -> str:
+    # "auto" uses uvloop when it's installed, "uvloop" insists on it and "asyncio" never uses it
+    if event_loop in ("auto", "uvloop"):
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return "uvloop"
+        except ImportError:
+            if event_loop == "uvloop":
+                raise
+    return "asyncio"
+
+def run_worker(app_factory: Callable[[], Awaitable[web.Application]], host: str, port: int,
+               event_loop: str = "auto", shutdown_timeout: float = 60.0, reuse_port: bool = False,
+               metrics_directory: Optional[str] = None) -> None:
+    loop_name = _install_event_loop(event_loop)
+    if metrics_directory is not None:
+        metrics.use_shared_directory(metrics_directory, multiprocessing.current_process().name)
+    logger.info("Worker %d serving on %s:%d using %s", os.getpid(), host, port, loop_name)
+    # On SIGTERM aiohttp stops accepting connections and runs the app's on_shutdown callbacks, which
+    # is where the middle tiers drain their websockets, before waiting up to shutdown_timeout
+    web.run_app(app_factory(), host=host, port=port, reuse_port=reuse_port, shutdown_timeout=shutdown_timeout, print=None)
+
+def serve(app_factory: Callable[[], Awaitable[web.Application]], host: str, port: int, workers: int = 1,
+          event_loop: str = "auto", shutdown_timeout: float = 60.0) -> None:
+    if workers <= 1:
+        run_worker(app_factory, host, port, event_loop, shutdown_timeout)
+        return
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("Running more than one worker needs SO_REUSEPORT, which this platform doesn't support")
+
+    # Spawned rather than forked so workers don't inherit anything the parent has set up
+    context = multiprocessing.get_context("spawn")
+    metrics_directory = tempfile.mkdtemp(prefix="voicerag-metrics-")
+    processes: dict[int, multiprocessing.Process] = {}
+    started_at: dict[int, float] = {}
+    stopping = False
+
+    def start(index: int) -> None:
+        process = context.Process(target=run_worker, name=f"voicerag-worker-{index}",
+                                  args=(app_factory, host, port, event_loop, shutdown_timeout, True, metrics_directory))
+        process.start()
+        processes[index] = process
+        started_at[index] = time.monotonic()
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        # Ctrl+C already reaches every worker through the process group, SIGTERM (docker stop, a
+        # container app revision being replaced) only reaches us and has to be passed on
+        if signum == signal.SIGTERM:
+            for process in processes.values():
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        start(index)
+    logger.info("Started %d workers on %s:%d", workers, host, port)
+
+    while len(processes) > 0:
+        wait([process.sentinel for process in processes.values()], timeout=1.0)
+        for index, process in list(processes.items()):
+            if process.is_alive():
+                continue
+            del processes[index]
+            # Its last snapshot would otherwise keep being added to /metrics, the replacement starts from zero
+            try:
+                os.remove(os.path.join(metrics_directory, f"{process.name}.json"))
+            except FileNotFoundError:
+                pass
+            if stopping:
+                continue
+            logger.warning("Worker %s exited with code %s, restarting it", process.name, process.exitcode)
+            # Don't spin if a worker can't even start, e.g. because the port is taken
+            if time.monotonic() - started_at[index] < 5:
+                time.sleep(1)
+            start(index)
+    shutil.rmtree(metrics_directory, ignore_errors=True)
@@ -0,0 +1,71 @@
+import re
+from typing import Any
+
+# Words and phrases that join the parts of a question asking about several things. Commas between
+# digits are thousands separators, "$1,000" is one amount.
+_CONJUNCTION = re.compile(r"\s*(?:(?<!\d),|,(?!\d)|;|\band\b|\bvs\.?|\bversus\b|\bor\b)\s*", re.IGNORECASE)
+# Leading phrases that only say the question is a comparison
+_COMPARISON = re.compile(r"^\s*(?:compare|comparing|what(?:'s| is| are) the differences? between|difference between|differences between)\s+", re.IGNORECASE)
+# Words after which a list of things is what the question is about
+_PREPOSITIONS = frozenset("about at between by for from in of on regarding to under with".split())
+# Words that start a noun phrase, "the $1,000 and $2,500 plans" starts one part with one and not the other
+_DETERMINERS = frozenset("a an the my our your their this that these those".split())
+# Longest part a question is split into, longer ones are more likely clauses than the names of things
+_MAX_PART_WORDS = 3
+
+def split_query(query: str, max_queries: int = 4) -> list[str]:
+    # Splits a question about several things into one query per thing, keeping the original query first
+    # so chunks that cover all of them still rank well. Only questions whose parts can be told apart for
+    # sure are split, the others are searched as they are:
+    #   "dental coverage for Standard and Plus" is "dental coverage for Standard" and "dental coverage
+    #   for Plus", the list follows a preposition and its parts have as many words each.
+    #   "compare Standard and Plus" is "Standard" and "Plus".
+    #   "compare Standard and Plus dental coverage" is "Standard dental coverage" and "Plus dental
+    #   coverage", the words after the last item of a comparison go with each of them.
+    # In "does the plan cover hearing aids or eyeglasses" it isn't clear which words the parts share, so
+    # they aren't split.
+    if max_queries <= 1:
+        return [query]
+    comparison = _COMPARISON.match(query) is not None
+    stripped = _COMPARISON.sub("", query).strip(" ?.!")
+    parts = [part.split() for part in _CONJUNCTION.split(stripped) if part.strip()]
+    if len(parts) < 2:
+        return [query]
+
+    if comparison and len(parts[-1]) > len(parts[0]) and all(len(part) == len(parts[0]) for part in parts[:-1]):
+        # Nothing comes before a comparison's first item, so the last part is its item and a shared tail
+        length = len(parts[0])
+        tail = parts[-1][length:]
+        if length > _MAX_PART_WORDS or len(tail) > _MAX_PART_WORDS:
+            return [query]
+        items = parts[:-1] + [parts[-1][:length]]
+        if len({item[0].lower() in _DETERMINERS for item in items}) > 1:
+            return [query]
+        return list(dict.fromkeys([query] + [" ".join(item + tail) for item in items]))[:max_queries]
+
+    # Every part after the first is a whole part, so they give the length of the first one
+    length = len(parts[1])
+    if length > _MAX_PART_WORDS or len(parts[0]) < length or any(len(part) != length for part in parts[2:]):
+        return [query]
+    head, first = parts[0][:-length], parts[0][-length:]
+    if comparison:
+        if len(head) > 0:
+            return [query]
+    elif len(head) == 0 or head[-1].lower() not in _PREPOSITIONS:
+        return [query]
+    if len({part[0].lower() in _DETERMINERS for part in [first] + parts[1:]}) > 1:
+        return [query]
+    queries = [" ".join(head + part) for part in [first] + parts[1:]]
+
+    unique = list(dict.fromkeys([query] + queries))
+    return unique[:max_queries]
+
+def fuse_rankings(rankings: list[list[dict[str, Any]]], top: int = 5, k: int = 60) -> list[dict[str, Any]]:
+    # Reciprocal rank fusion of several result lists, chunks found by more than one query come first
+    scores: dict[str, float] = {}
+    docs: dict[str, dict[str, Any]] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            scores[doc["chunk_id"]] = scores.get(doc["chunk_id"], 0.0) + 1.0 / (k + rank + 1)
+            docs.setdefault(doc["chunk_id"], doc)
+    return [docs[chunk_id] for chunk_id in sorted(scores, key=lambda chunk_id: -scores[chunk_id])[:top]]
@@ -0,0 +1,24 @@
+from compression import compress_results, format_results
+
+
+def _doc(chunk_id: str, chunk: str) -> dict:
+    return {"chunk_id": chunk_id, "title": chunk_id, "chunk": chunk}
+
+def test_results_within_budget_are_not_changed():
+    docs = [_doc("a", "Short chunk.")]
+    assert compress_results("anything", docs, 1000) == format_results(docs)
+
+def test_sentence_that_is_a_prefix_of_an_earlier_one_is_kept():
+    docs = [
+        _doc("plus_2", "Northwind Health Plus\nDeductible: $5000\n" + "Other filler sentence about nothing. " * 20),
+        _doc("std_2", "Northwind Standard\nDeductible: $500\n" + "Filler sentence about something else. " * 20),
+    ]
+    compressed = compress_results("deductible for standard and plus", docs, 60)
+    assert "[plus_2]: Northwind Health Plus Deductible: $5000" in compressed
+    assert "[std_2]: Northwind Standard Deductible: $500 " in compressed
+
+def test_repeated_sentences_are_sent_once():
+    repeated = "The deductible is due every year."
+    docs = [_doc("a", repeated + " " + "Filler. " * 40), _doc("b", repeated + " Coverage starts in January.")]
+    compressed = compress_results("deductible", docs, 40)
+    assert compressed.count(repeated) == 1
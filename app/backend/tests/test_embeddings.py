@@ -0,0 +1,37 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from embeddings import CachedEmbedder, HashingEmbedder
+
+
+class SlowEmbedder(HashingEmbedder):
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        await asyncio.sleep(60)
+        return await super().embed(texts)
+
+def test_close_cancels_batches_being_embedded():
+    async def run():
+        embedder = CachedEmbedder(SlowEmbedder(), batch_window=0)
+        waiting = asyncio.create_task(embedder.embed(["what is the deductible"]))
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(embedder.close(), 1)
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    asyncio.run(run())
+
+def test_cache_file_is_loaded_again(tmp_path):
+    path = str(tmp_path / "embeddings.npy")
+
+    async def run():
+        embedder = CachedEmbedder(HashingEmbedder(), max_entries=4, path=path)
+        vectors = await embedder.embed(["What is the deductible?"])
+        await embedder.close()
+        reopened = CachedEmbedder(HashingEmbedder(), max_entries=4, path=path)
+        assert len(reopened) == 1
+        assert np.array_equal(await reopened.embed(["what is the deductible"]), vectors)
+        await reopened.close()
+
+    asyncio.run(run())
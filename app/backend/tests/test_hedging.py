@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from hedging import Hedger
+
+
+def test_max_hedge_rate_must_be_a_fraction():
+    for rate in (-0.1, 1.5):
+        with pytest.raises(ValueError):
+            Hedger("search", max_hedge_rate=rate)
+
+def test_zero_hedge_rate_never_hedges():
+    async def run():
+        calls = 0
+
+        async def slow():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return calls
+
+        hedger = Hedger("search", max_hedge_rate=0, max_delay=0.01)
+        return await hedger.run(slow), calls
+
+    result, calls = asyncio.run(run())
+    assert (result, calls) == (1, 1)
@@ -0,0 +1,42 @@
+import os
+import shutil
+import time
+
+import metrics
+
+
+def test_workers_sharing_a_directory_report_the_sum(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "_shared_directory", str(tmp_path))
+    monkeypatch.setattr(metrics, "_worker", "voicerag-worker-0")
+    calls = metrics.counter("test_shared_calls_total", "Calls")
+    latency = metrics.histogram("test_shared_latency_seconds", "Latency", buckets=(0.1, 1.0))
+    calls.inc(3, tier="acs")
+    latency.observe(0.05, tier="acs")
+    # Another worker that has seen the same
+    metrics.write_snapshot()
+    shutil.copy(os.path.join(tmp_path, "voicerag-worker-0.json"), os.path.join(tmp_path, "voicerag-worker-1.json"))
+    calls.inc(1, tier="acs")
+
+    rendered = metrics.render_prometheus().splitlines()
+    assert 'test_shared_calls_total{tier="acs"} 7' in rendered
+    assert 'test_shared_latency_seconds_bucket{tier="acs",le="0.1"} 2' in rendered
+    assert 'test_shared_latency_seconds_count{tier="acs"} 2' in rendered
+
+def test_scrapes_leave_out_exited_workers_and_dont_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "_shared_directory", str(tmp_path))
+    monkeypatch.setattr(metrics, "_worker", "voicerag-worker-0")
+    monkeypatch.setattr(metrics, "_interval", 1.0)
+    calls = metrics.counter("test_stale_calls_total", "Calls")
+    calls.inc(2)
+    metrics.write_snapshot()
+    for worker in ("voicerag-worker-1", "voicerag-worker-2"):
+        shutil.copy(os.path.join(tmp_path, "voicerag-worker-0.json"), os.path.join(tmp_path, f"{worker}.json"))
+    # Worker 2 stopped writing snapshots a minute ago
+    stale = time.time() - 60
+    os.utime(os.path.join(tmp_path, "voicerag-worker-2.json"), (stale, stale))
+    calls.inc(1)
+    written = os.path.getmtime(os.path.join(tmp_path, "voicerag-worker-0.json"))
+
+    rendered = metrics.render_prometheus().splitlines()
+    assert "test_stale_calls_total 5" in rendered
+    assert os.path.getmtime(os.path.join(tmp_path, "voicerag-worker-0.json")) == written
@@ -0,0 +1,37 @@
+import asyncio
+
+from embeddings import HashingEmbedder
+from semanticcache import SemanticCache
+
+
+def test_search_running_during_clear_is_not_cached():
+    cache = SemanticCache(HashingEmbedder(), threshold=0.9, max_entries=8)
+    searches = []
+
+    async def search():
+        searches.append(1)
+        # The knowledge base changes while this search runs
+        cache.clear()
+        return ["stale"]
+
+    async def run():
+        assert await cache.get_or_search("what is the deductible", "index", search) == ["stale"]
+        assert await cache.get_or_search("what is the deductible", "index", search) == ["stale"]
+
+    asyncio.run(run())
+    assert len(searches) == 2
+
+def test_repeated_query_is_reused():
+    cache = SemanticCache(HashingEmbedder(), threshold=0.9, max_entries=8)
+    searches = []
+
+    async def search():
+        searches.append(1)
+        return ["fresh"]
+
+    async def run():
+        await cache.get_or_search("what is the deductible", "index", search)
+        await cache.get_or_search("what is the deductible", "index", search)
+
+    asyncio.run(run())
+    assert len(searches) == 1
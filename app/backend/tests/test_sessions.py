@@ -0,0 +1,143 @@
+import asyncio
+import base64
+import random
+
+import aiohttp
+from azure.core.credentials import AzureKeyCredential
+
+import codec
+from rtmt import RTMiddleTier
+from rtsession import RTSession, Tool, ToolResult, ToolResultDirection
+
+SESSIONS = 300
+
+class FakeWebSocket:
+    # Both ends of a websocket as the middle tier sees them: what it reads comes from incoming, what
+    # it sends is kept in sent. Closing ends the reads.
+    def __init__(self, on_send=None):
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.sent: list[dict] = []
+        self.closed = False
+        self._on_send = on_send
+
+    def receive(self, message: dict) -> None:
+        self.incoming.put_nowait(aiohttp.WSMessage(aiohttp.WSMsgType.TEXT, codec.dumps(message), None))
+
+    async def send_str(self, data: str) -> None:
+        message = codec.loads(data)
+        self.sent.append(message)
+        if self._on_send is not None:
+            self._on_send(message)
+
+    async def close(self, **kwargs) -> None:
+        if not self.closed:
+            self.closed = True
+            self.incoming.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+class FakeRequest:
+    # Only what _forward_messages reads from the client's request
+    def __init__(self, headers: dict[str, str]):
+        self.headers = headers
+
+def _script(index: int) -> list[tuple[str, dict]]:
+    # What session index goes through, in order: which side sends each message and the message. The
+    # upstream answers with a transcript and a tool call, the client streams audio in between.
+    audio = base64.b64encode(f"audio {index}".encode()).decode("ascii")
+    return [
+        ("client", {"type": "input_audio_buffer.append", "audio": audio}),
+        ("upstream", {"type": "response.audio_transcript.delta", "delta": f"session {index}"}),
+        ("upstream", {"type": "conversation.item.created", "previous_item_id": f"item-{index}",
+                      "item": {"type": "function_call", "call_id": f"call-{index}"}}),
+        ("client", {"type": "input_audio_buffer.append", "audio": audio}),
+        ("upstream", {"type": "response.output_item.done", "response_id": f"response-{index}",
+                      "item": {"type": "function_call", "call_id": f"call-{index}", "name": "remember",
+                               "arguments": codec.dumps({"value": index})}}),
+        ("upstream", {"type": "response.done", "response": {"id": f"response-{index}", "output": [{"type": "function_call"}]}}),
+    ]
+
+def test_concurrent_sessions_are_isolated():
+    async def run():
+        started = 0
+        all_started = asyncio.Event()
+
+        async def remember(args, rt_session):
+            # Only returns once every session's tool is running, so the tool calls overlap
+            nonlocal started
+            started += 1
+            if started == SESSIONS:
+                all_started.set()
+            await all_started.wait()
+            rt_session.tool_state["remember"] = args["value"]
+            await asyncio.sleep(0)
+            return ToolResult({"value": rt_session.tool_state["remember"]}, ToolResultDirection.TO_SERVER)
+
+        tier = RTMiddleTier("https://example.com", "deployment", AzureKeyCredential("key"))
+        tier.tools["remember"] = Tool(target=remember, schema={"type": "function", "name": "remember"}, pass_session=True)
+        done = [asyncio.Event() for _ in range(SESSIONS)]
+        upstreams: dict[int, FakeWebSocket] = {}
+        connected = asyncio.Event()
+
+        async def connect(backend, headers=None):
+            # Sessions are told apart by the request id their client sent
+            index = int(headers["x-ms-client-request-id"])
+
+            def on_send(message):
+                if message["type"] == "response.create":
+                    done[index].set()
+
+            upstreams[index] = FakeWebSocket(on_send)
+            if len(upstreams) == SESSIONS:
+                connected.set()
+            return upstreams[index]
+
+        tier._connect = connect
+        clients = [FakeWebSocket() for _ in range(SESSIONS)]
+        sessions = [RTSession(client, tier._session_config(), tier.tier) for client in clients]
+
+        async def forward(index):
+            await tier._forward_messages(FakeRequest({"x-ms-client-request-id": str(index)}), clients[index], sessions[index])
+
+        async def drive():
+            # Every step of every session's script is delivered in a shuffled order across sessions, so
+            # frames and tool calls of different sessions are interleaved
+            await connected.wait()
+            scripts = [_script(index) for index in range(SESSIONS)]
+            shuffle = random.Random(0)
+            for step in range(len(scripts[0])):
+                order = list(range(SESSIONS))
+                shuffle.shuffle(order)
+                for index in order:
+                    side, message = scripts[index][step]
+                    (clients[index] if side == "client" else upstreams[index]).receive(message)
+                    if shuffle.random() < 0.1:
+                        await asyncio.sleep(0)
+
+        async def hang_up(index):
+            await done[index].wait()
+            await clients[index].close()
+            await upstreams[index].close()
+
+        await asyncio.wait_for(asyncio.gather(drive(), *(forward(i) for i in range(SESSIONS)), *(hang_up(i) for i in range(SESSIONS))), 30)
+        for session in sessions:
+            session.close()
+        return upstreams, clients, sessions
+
+    upstreams, clients, sessions = asyncio.run(run())
+    for index, client in enumerate(clients):
+        upstream = upstreams[index]
+        assert [m["type"] for m in upstream.sent].count("response.create") == 1
+        outputs = [m["item"] for m in upstream.sent if m["type"] == "conversation.item.create"]
+        assert outputs == [{"type": "function_call_output", "call_id": f"call-{index}", "output": codec.dumps({"value": index})}]
+        audio = base64.b64encode(f"audio {index}".encode()).decode("ascii")
+        assert [m["audio"] for m in upstream.sent if m["type"] == "input_audio_buffer.append"] == [audio, audio]
+        assert [m["delta"] for m in client.sent if m["type"] == "response.audio_transcript.delta"] == [f"session {index}"]
+        assert sessions[index].backend is not None
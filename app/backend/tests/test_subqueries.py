@@ -0,0 +1,40 @@
+import pytest
+
+from subqueries import fuse_rankings, split_query
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("dental coverage for Standard and Plus", ["dental coverage for Standard and Plus", "dental coverage for Standard", "dental coverage for Plus"]),
+    ("What's covered for eye exams, dental cleanings and flu shots?",
+     ["What's covered for eye exams, dental cleanings and flu shots?", "What's covered for eye exams", "What's covered for dental cleanings", "What's covered for flu shots"]),
+    ("compare Northwind Standard vs Northwind Plus", ["compare Northwind Standard vs Northwind Plus", "Northwind Standard", "Northwind Plus"]),
+    ("compare Standard and Plus dental coverage", ["compare Standard and Plus dental coverage", "Standard dental coverage", "Plus dental coverage"]),
+    ("difference between Standard, Plus and Premium vision plans",
+     ["difference between Standard, Plus and Premium vision plans", "Standard vision plans", "Plus vision plans", "Premium vision plans"]),
+])
+def test_splits_lists_of_things(query, expected):
+    assert split_query(query) == expected
+
+@pytest.mark.parametrize("query", [
+    "does the plan cover hearing aids or eyeglasses",
+    "What is covered for in-network and out-of-network care",
+    "Is there a deductible for the $1,000 plan",
+    "What is the copay for the $1,000 or $2,000 plan",
+    "limits for the $1,000 and $2,500 plans",
+    "What is covered for dental and how do I file a claim",
+    "What does Contoso Electronics make?",
+])
+def test_leaves_questions_it_cant_split_reliably(query):
+    assert split_query(query) == [query]
+
+def test_thousands_separators_stay_in_place():
+    assert split_query("coverage for the $1,000 plan and the $2,500 plan") == [
+        "coverage for the $1,000 plan and the $2,500 plan", "coverage for the $1,000 plan", "coverage for the $2,500 plan"]
+
+def test_max_queries():
+    assert split_query("dental coverage for Standard and Plus", max_queries=1) == ["dental coverage for Standard and Plus"]
+    assert len(split_query("coverage for dental, vision, hearing, travel and maternity", max_queries=3)) == 3
+
+def test_fuse_rankings_puts_chunks_found_by_several_queries_first():
+    a, b, c = ({"chunk_id": i} for i in "abc")
+    assert [d["chunk_id"] for d in fuse_rankings([[a, b], [c, b]])] == ["b", "a", "c"]
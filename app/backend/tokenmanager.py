@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+from typing import Any, Optional
+
+from azure.core.credentials import AccessToken, TokenCredential
+
+import metrics
+
+logger = logging.getLogger("voicerag")
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+SEARCH_SCOPE = "https://search.azure.com/.default"
+COMMUNICATION_SCOPE = "https://communication.azure.com/.default"
+
+_refresh_latency = metrics.histogram("voicerag_token_refresh_seconds", "Time taken to fetch a new Entra ID token, by scope")
+_refresh_failures = metrics.counter("voicerag_token_refresh_failures_total", "Failed Entra ID token refreshes, by scope")
+
+class AsyncTokenManager:
+    # Serves Entra ID tokens to everything in the backend without ever blocking the event loop. The
+    # azure.identity credentials used here are synchronous (and DefaultAzureCredential may shell out to
+    # the Azure CLI), so they're only ever called from a worker thread, and each scope is refreshed in
+    # the background well before its token expires so callers always get a cached token.
+    #
+    # Implements the AsyncTokenCredential protocol, so it can be handed straight to the async Azure SDK
+    # clients (SearchClient, CallAutomationClient).
+    refresh_margin: float
+    retry_interval: float
+
+    def __init__(self, credential: TokenCredential, refresh_margin: float = 300.0, retry_interval: float = 10.0):
+        self._credential = credential
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._tokens: dict[str, AccessToken] = {}
+        self._refreshing: dict[str, asyncio.Future] = {}
+        self._refresh_tasks: dict[str, asyncio.Task] = {}
+        self._closed = False
+
+    async def start(self, *scopes: str) -> None:
+        # Fetch the tokens we know we'll need up front so the first request doesn't wait for them
+        await asyncio.gather(*(self._refresh(scope) for scope in scopes))
+        for scope in scopes:
+            self._ensure_background_refresh(scope)
+
+    async def get_token(self, *scopes: str, claims: Optional[str] = None, tenant_id: Optional[str] = None, **kwargs: Any) -> AccessToken:
+        if len(scopes) != 1:
+            raise ValueError("AsyncTokenManager only supports requesting one scope at a time")
+        scope = scopes[0]
+        if claims is not None or tenant_id is not None:
+            # Claims challenges and cross-tenant requests are rare and can't be served from the cache
+            return await self._fetch(scope, claims=claims, tenant_id=tenant_id, **kwargs)
+
+        token = self._tokens.get(scope)
+        if token is None or token.expires_on - time.time() < 30:
+            token = await self._refresh(scope)
+        self._ensure_background_refresh(scope)
+        return token
+
+    async def get_bearer_token(self, scope: str) -> str:
+        return (await self.get_token(scope)).token
+
+    async def _fetch(self, scope: str, **kwargs: Any) -> AccessToken:
+        start = time.perf_counter()
+        try:
+            token = await asyncio.to_thread(self._credential.get_token, scope, **kwargs)
+        except Exception:
+            _refresh_failures.inc(scope=scope)
+            raise
+        _refresh_latency.observe(time.perf_counter() - start, scope=scope)
+        return token
+
+    async def _refresh(self, scope: str) -> AccessToken:
+        # Concurrent callers share a single in-flight refresh per scope
+        pending = self._refreshing.get(scope)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._refreshing[scope] = future
+        try:
+            token = await self._fetch(scope)
+            self._tokens[scope] = token
+            future.set_result(token)
+            return token
+        except Exception as e:
+            future.set_exception(e)
+            # Make sure the exception is retrieved even if nobody else was waiting on it
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self._refreshing[scope]
+
+    def _ensure_background_refresh(self, scope: str) -> None:
+        if self._closed or scope in self._refresh_tasks:
+            return
+        self._refresh_tasks[scope] = asyncio.create_task(self._refresh_loop(scope))
+
+    async def _refresh_loop(self, scope: str) -> None:
+        while not self._closed:
+            token = self._tokens.get(scope)
+            delay = token.expires_on - time.time() - self.refresh_margin if token is not None else 0
+            # Credentials that hand back their own cached token could otherwise make this spin
+            await asyncio.sleep(max(delay, self.retry_interval))
+            try:
+                await self._refresh(scope)
+            except Exception:
+                # Keep serving the current token while it's still valid and try again shortly
+                logger.exception("Background token refresh for %s failed", scope)
+
+    async def close(self) -> None:
+        self._closed = True
+        for task in self._refresh_tasks.values():
+            task.cancel()
+        self._refresh_tasks.clear()
+
+    async def __aenter__(self) -> "AsyncTokenManager":
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.close()
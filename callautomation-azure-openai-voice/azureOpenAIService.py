@@ -1,5 +1,4 @@
 import asyncio
-import json
 import logging
 import os
 from typing import Union
@@ -24,6 +23,8 @@ from rtclient import (
 )
 from tools import RTToolCall, Tool, ToolResultDirection, get_tools
 
+import codec
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("voicerag")
 
@@ -174,7 +175,7 @@ async def receive_messages(client: RTLowLevelClient):
                     tool_call = _tools_pending[message.item.call_id]
                     tool = tools[item.name]
                     args = item.arguments
-                    result = await tool.target(json.loads(args))
+                    result = await tool.target(codec.loads(args))
                     await client.send(ItemCreateMessage(
                         item=FunctionCallOutputItem(
                             call_id = item.call_id,
@@ -209,30 +210,13 @@ async def init_websocket(socket):
 
 async def receive_audio_for_outbound(data):
     try:
-        data = {
-            "Kind": "AudioData",
-            "AudioData": {
-                    "Data":  data
-            },
-            "StopAudio": None
-        }
-
-        # Serialize the server streaming data
-        serialized_data = json.dumps(data)
-        await send_message(serialized_data)
+        await send_message(codec.audio_data_message(data))
         
     except Exception as e:
         print(e)
 
 async def stop_audio():
-        stop_audio_data = {
-            "Kind": "StopAudio",
-            "AudioData": None,
-            "StopAudio": {}
-        }
-
-        json_data = json.dumps(stop_audio_data)
-        await send_message(json_data)
+        await send_message(codec.STOP_AUDIO)
 
 async def send_message(message: str):
     global active_websocket
@@ -0,0 +1,28 @@
+import json
+from typing import Any, Callable
+
+# Same approach as app/backend/codec.py: use orjson when it's installed and fall back to
+# the json module, always producing str for the websocket.
+
+def _load_codec() -> tuple[str, Callable[[Any], str], Callable[[str | bytes], Any]]:
+    try:
+        import orjson
+
+        def orjson_dumps(obj: Any) -> str:
+            return orjson.dumps(obj).decode("utf-8")
+        return "orjson", orjson_dumps, orjson.loads
+    except ImportError:
+        pass
+    return "json", json.dumps, json.loads
+
+name, dumps, loads = _load_codec()
+
+STOP_AUDIO = dumps({
+    "Kind": "StopAudio",
+    "AudioData": None,
+    "StopAudio": {}
+})
+
+def audio_data_message(data: str) -> str:
+    # base64 never needs escaping, so the envelope is spliced together instead of being serialized
+    return '{"Kind": "AudioData", "AudioData": {"Data": "' + data + '"}, "StopAudio": null}'
@@ -19,6 +19,7 @@ from azureOpenAIService import init_websocket, start_conversation
 from dotenv import load_dotenv
 from mediaStreamingHandler import process_websocket_message_async
 from quart import Quart, Response, json, redirect, request, websocket
+from tools import close_http_session
 
 if not os.environ.get("RUNNING_IN_PRODUCTION"):
     info("Running in development mode, loading from .env file")
@@ -133,6 +134,10 @@ async def ws():
             print(f"WebSocket connection closed: {e}")
             break
 
+@app.after_serving
+async def shutdown():
+    await close_http_session()
+
 @app.route('/')
 def home():
     return 'Hello ACS CallAutomation!'
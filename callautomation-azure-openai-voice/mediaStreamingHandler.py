@@ -1,9 +1,11 @@
-import json
 from azureOpenAIService import send_audio_to_external_ai
 
+import codec
+
+
 async def process_websocket_message_async(stream_data):
     try:
-        data = json.loads(stream_data)
+        data = codec.loads(stream_data)
         kind = data['kind']
         if kind == "AudioData":
             audio_data = data["audioData"]["data"]
@@ -1,10 +1,11 @@
-import json
 from enum import Enum
 from logging import info
-from typing import Any, Callable, Literal
+from typing import Any, Callable, Literal, Optional
 
 import aiohttp
 
+import codec
+
 
 class ToolResultDirection(Enum):
     TO_SERVER = 1
@@ -21,7 +22,7 @@ class ToolResult:
     def to_text(self) -> str:
         if self.text is None:
             return ""
-        return self.text if isinstance(self.text, str) else json.dumps(self.text)
+        return self.text if isinstance(self.text, str) else codec.dumps(self.text)
 
 class RTToolCall:
     tool_call_id: str
@@ -39,6 +40,23 @@ class Tool:
         self.target = target
         self.schema = schema
 
+# Shared by every tool call, so DNS lookups, keep-alive connections and TLS sessions are reused
+# instead of being thrown away with a per-call ClientSession
+_http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=30)
+        _http_session = aiohttp.ClientSession(connector=connector)
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
 _weather_forecast_tool_schema = {
     "name": "get_weather_forecast",
     "type": "function",
@@ -102,12 +120,11 @@ async def _weather_tool(
         "longitude": args["lng"],
         type: "temperature_2m,wind_speed_10m"
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
-            data = await response.json()
+    async with get_http_session().get(url, params=params) as response:
+        data = await response.json()
 
     info(f"Retrieved weather data: {data}")
-    return ToolResult(json.dumps(data), ToolResultDirection.TO_SERVER)
+    return ToolResult(codec.dumps(data), ToolResultDirection.TO_SERVER)
 
 def get_tools() -> dict[str, Tool]:
     